@@ -1,24 +1,2685 @@
 import streamlit as st
 import vertexai
 from vertexai.generative_models import GenerativeModel
+from google.api_core import exceptions as google_exceptions
+import abc
+import datetime
 import docx
+from docx.table import Table
+import hashlib
 import io
+import json
+import logging
+import math
 import os
+import queue
+import random
 import re # Importado para ayudar a separar las guías
+import sqlite3
+import tempfile
+import threading
+import time
+import unicodedata
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # --- INICIALIZACIÓN DEL ESTADO DE LA SESIÓN ---
-if 'stage' not in st.session_state:
-    st.session_state.stage = "inspiration"
-if 'inspiration_text' not in st.session_state:
-    st.session_state.inspiration_text = ""
-if 'num_actividades' not in st.session_state:
-    st.session_state.num_actividades = 1
-if 'sequence_plan' not in st.session_state:
-    st.session_state.sequence_plan = None
-if 'final_context' not in st.session_state:
-    st.session_state.final_context = ""
-if 'processed_sequence' not in st.session_state:
-    st.session_state.processed_sequence = []
+# Se hace desde main() para que el módulo pueda importarse sin interfaz (benchmarks, scripts).
+def inicializar_estado_sesion():
+    if 'stage' not in st.session_state:
+        st.session_state.stage = "inspiration"
+    # Los textos (inspiración, plan, actividades) viven en el almacén de artefactos;
+    # la sesión solo guarda sus IDs.
+    if 'inspiracion_id' not in st.session_state:
+        st.session_state.inspiracion_id = None
+    if 'num_actividades' not in st.session_state:
+        st.session_state.num_actividades = 1
+    if 'plan_id' not in st.session_state:
+        st.session_state.plan_id = None
+    if 'final_context' not in st.session_state:
+        st.session_state.final_context = ""
+    if 'processed_sequence' not in st.session_state:
+        st.session_state.processed_sequence = []
+    if 'trabajo_id' not in st.session_state:
+        st.session_state.trabajo_id = None
+    if 'nota_inspiracion' not in st.session_state:
+        st.session_state.nota_inspiracion = None
+    if 'especulacion' not in st.session_state:
+        st.session_state.especulacion = None  # {"trabajo_id", "huella"} del trabajo pregenerado en curso
+
+
+# --- MODELOS DISPONIBLES EN VERTEX AI ---
+VERTEX_AI_MODELS = [
+    "gemini-2.5-pro",
+    "gemini-2.5-flash",
+    "gemini-2.5-flash-lite"
+]
+
+
+# --- DICCIONARIO DE LA TAXONOMÍA DE BLOOM (sin cambios) ---
+bloom_taxonomy_detallada = {
+    "RECORDAR": { "definicion": "Recuperar conocimiento relevante de la memoria de largo plazo.", "subprocesos": { "Reconocer": {"nombres_alternativos": "Identificar", "definicion_ejemplo": "Localizar conocimiento..."}, "Evocar": {"nombres_alternativos": "Recuperar", "definicion_ejemplo": "Recuperar conocimiento..."} } },
+    "COMPRENDER": { "definicion": "Construir significado a partir de contenidos educativos.", "subprocesos": { "Interpretar": {"nombres_alternativos": "Aclarar, parafrasear", "definicion_ejemplo": "Transformar de una forma de representación a otra..."}, "Ejemplificar": {"nombres_alternativos": "Ilustrar, citar casos", "definicion_ejemplo": "Poner un ejemplo específico..."}, "Clasificar": {"nombres_alternativos": "Categorizar", "definicion_ejemplo": "Determinar que algo pertenece a una categoría..."}, "Resumir": {"nombres_alternativos": "Abstraer, generalizar", "definicion_ejemplo": "Extraer el tema general..."}, "Inferir": {"nombres_alternativos": "Concluir, predecir", "definicion_ejemplo": "Sacar una conclusión lógica..."}, "Comparar": {"nombres_alternativos": "Contrastar, esquematizar", "definicion_ejemplo": "Detectar correspondencias..."}, "Explicar": {"nombres_alternativos": "Construir modelos", "definicion_ejemplo": "Construir un modelo de causa-efecto..."} } },
+    "APLICAR": { "definicion": "Desarrolar o usar un procedimiento en una situación dada.", "subprocesos": { "Ejecutar": {"nombres_alternativos": "Llevar a cabo", "definicion_ejemplo": "Aplicar un procedimiento a una tarea familiar..."}, "Implementar": {"nombres_alternativos": "Utilizar", "definicion_ejemplo": "Aplicar un procedimiento a una tarea no familiar..."} } },
+    "ANALIZAR": { "definicion": "Despiezar el material en sus partes constituyentes y determinar cómo se relacionan.", "subprocesos": { "Diferenciar": {"nombres_alternativos": "Discriminar, seleccionar", "definicion_ejemplo": "Distinguir las partes relevantes..."}, "Organizar": {"nombres_alternativos": "Integrar, estructurar", "definicion_ejemplo": "Determinar cómo encajan los elementos..."}, "Atribuir": {"nombres_alternativos": "Deconstruir", "definicion_ejemplo": "Determinar los puntos de vista, sesgos..."} } },
+    "EVALUAR": { "definicion": "Formular juicios con base en criterios o parámetros.", "subprocesos": { "Verificar": {"nombres_alternativos": "Detectar, monitorear", "definicion_ejemplo": "Detectar inconsistencias o falacias..."}, "Criticar": {"nombres_alternativos": "Juzgar, argumentar", "definicion_ejemplo": "Detectar inconsistencias con base en criterios externos..."} } },
+    "CREAR": { "definicion": "Agrupar elementos para formar un todo coherente o funcional.", "subprocesos": { "Generar": {"nombres_alternativos": "Formular hipótesis", "definicion_ejemplo": "Formular hipótesis alternativas..."}, "Planear": {"nombres_alternativos": "Diseñar", "definicion_ejemplo": "Idear un procedimiento..."}, "Producir": {"nombres_alternativos": "Construir", "definicion_ejemplo": "Inventar un producto..."} } }
+}
+
+
+# --- SISTEMA DE PROMPTS CENTRALIZADO ---
+def construir_texto_bloom(taxonomia):
+    bloom_text = ""
+    for level, data in taxonomia.items():
+        bloom_text += f"\n### {level}: {data['definicion']}\n"
+        for subprocess, sub_data in data.get('subprocesos', {}).items():
+            alt_names = sub_data.get('nombres_alternativos', '')
+            bloom_text += f"- **{subprocess} ({alt_names}):** {sub_data.get('definicion_ejemplo', '')}\n"
+    return bloom_text
+
+
+# La taxonomía es estática: su texto se construye una sola vez al importar el módulo.
+BLOOM_TEXT = construir_texto_bloom(bloom_taxonomy_detallada)
+
+
+def get_master_prompt_system(contexto_narrativo=None):
+    # Sin contexto, el modelo es idéntico para todas las sesiones y secuencias, y cada prompt aporta
+    # su propio CONTEXTO NARRATIVO (ver anteponer_contexto_narrativo).
+    capa_0 = f"Toda la actividad debe estar inmersa en esta historia:\n---\n{contexto_narrativo}\n---" if contexto_narrativo else \
+        "Toda la actividad debe estar inmersa en la historia del CONTEXTO NARRATIVO que acompaña a cada tarea."
+    return f"""
+# MODELO PEDAGÓGICO INTEGRAL
+## CAPA 0: CONTEXTO NARRATIVO
+{capa_0}
+## CAPA 1: FILOSOFÍA (Círculos de Aprendizaje)
+Entorno colaborativo. El facilitador guía con preguntas.
+## CAPA 2: ESTRUCTURA (Bruner)
+Viaje: Enactivo (hacer) -> Icónico (representar) -> Simbólico (abstraer).
+## CAPA 3: COHESIÓN (Hilo Conductor)
+El producto de una fase es el insumo de la siguiente.
+## CAPA 4: DIFERENCIACIÓN (Piso Bajo, Techo Alto)
+Accesible para todos, desafiante para los más avanzados.
+## CAPA 5: INTENCIÓN COGNITIVA (Bloom)
+Las tareas deben provocar procesos de pensamiento específicos y ascender en la taxonomía.
+## CAPA 6: DETALLE DE PROCESOS COGNITIVOS
+Usa los siguientes verbos y definiciones con precisión.
+{BLOOM_TEXT}
+"""
+
+
+# --- REGISTRO DE VERTEX AI (uno por proceso) ---
+class RegistroVertex:
+    """Inicializa Vertex AI una sola vez y reutiliza un GenerativeModel por modelo.
+
+    Cada GenerativeModel crea su cliente gRPC la primera vez que se usa; al compartir
+    la instancia entre sesiones y usuarios, la autenticación y el canal se reutilizan.
+    """
+
+    def __init__(self, project, location, model_names):
+        vertexai.init(project=project, location=location)
+        self._lock = threading.Lock()
+        self._modelos = {model_name: GenerativeModel(model_name) for model_name in model_names}
+
+    def modelo(self, model_name):
+        with self._lock:
+            modelo = self._modelos.get(model_name)
+            if modelo is None:
+                modelo = self._modelos[model_name] = GenerativeModel(model_name)
+            return modelo
+
+    def precalentar(self):
+        # count_tokens no genera texto (no tiene coste) pero fuerza la autenticación
+        # y la apertura del canal de cada modelo antes de la primera petición real.
+        for model_name in list(self._modelos):
+            try:
+                self.modelo(model_name).count_tokens("ping")
+            except Exception as e:
+                logging.warning("No se pudo precalentar el modelo %s: %s", model_name, e)
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_registro_vertex(project, location):
+    registro = RegistroVertex(project, location, VERTEX_AI_MODELS)
+    if os.environ.get("VERTEX_WARMUP", "").lower() in ("1", "true", "si", "sí"):
+        # En segundo plano: la primera visita no espera, y el calentamiento coincide
+        # con el tiempo que el docente tarda en escribir su tema.
+        threading.Thread(target=registro.precalentar, name="precalentar-vertex", daemon=True).start()
+    return registro
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_backend_simulado():
+    return BackendSimulado(tasa_aprobacion=float(os.environ.get("LLM_SIMULADO_TASA_APROBACION", "0.7")))
+
+
+# --- LÍMITE DE TASA POR MODELO (compartido por todos los usuarios del proceso) ---
+class LimitadorDeTasa:
+    """Cubeta de fichas por modelo: admite ráfagas cortas y, en promedio, N solicitudes por minuto.
+
+    La tasa se adapta al servidor: cada 429 la reduce a la mitad (con un mínimo del 10%
+    de la configurada) y cada llamada correcta recupera un 5%, hasta volver a la configurada.
+    """
+
+    def __init__(self, llamadas_por_minuto=120, rafaga=5):
+        self._lock = threading.Lock()
+        self._fichas = float(rafaga)
+        self._ultima_recarga = time.monotonic()
+        self.configurar(llamadas_por_minuto, rafaga)
+
+    def configurar(self, llamadas_por_minuto, rafaga=None):
+        with self._lock:
+            tasa = max(1, llamadas_por_minuto) / 60.0
+            if getattr(self, "_tasa_configurada", None) != tasa:
+                self._tasa_configurada = tasa
+                self._tasa = tasa
+            if rafaga is not None:
+                self._capacidad = float(max(1, rafaga))
+
+    @property
+    def llamadas_por_minuto(self):
+        return self._tasa * 60.0
+
+    def _recargar(self, ahora):
+        self._fichas = min(self._capacidad, self._fichas + (ahora - self._ultima_recarga) * self._tasa)
+        self._ultima_recarga = ahora
+
+    def esperar_turno(self):
+        # La ficha se reserva dentro del lock (el saldo puede quedar negativo: es la cola de espera)
+        # y se duerme fuera de él, para que los demás hilos puedan reservar las siguientes.
+        with self._lock:
+            self._recargar(time.monotonic())
+            self._fichas -= 1
+            espera = -self._fichas / self._tasa if self._fichas < 0 else 0.0
+        if espera > 0:
+            time.sleep(espera)
+
+    def penalizar(self):
+        with self._lock:
+            self._recargar(time.monotonic())
+            self._tasa = max(self._tasa_configurada * 0.1, self._tasa * 0.5)
+
+    def registrar_exito(self):
+        with self._lock:
+            if self._tasa < self._tasa_configurada:
+                self._recargar(time.monotonic())
+                self._tasa = min(self._tasa_configurada, self._tasa + self._tasa_configurada * 0.05)
+
+
+def llamadas_por_minuto_configuradas(model_name):
+    # LLM_RPM fija el límite de todos los modelos; p. ej. LLM_RPM_GEMINI_2_5_PRO lo ajusta para uno solo.
+    variable = "LLM_RPM_" + re.sub(r"[^A-Z0-9]+", "_", model_name.upper())
+    return int(os.environ.get(variable, os.environ.get("LLM_RPM", "120")))
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_limitador(model_name):
+    # st.cache_resource sobrevive a los reruns: un único limitador por modelo y por proceso.
+    # La tasa se lee de la configuración una sola vez; ningún usuario puede cambiarla desde la interfaz.
+    return LimitadorDeTasa(llamadas_por_minuto_configuradas(model_name))
+
+
+# --- CACHÉ DE RESPUESTAS DEL MODELO (memoria + disco) ---
+class CacheRespuestas:
+    """Caché de respuestas direccionada por contenido: (modelo, prompt, configuración) -> texto.
+
+    Un primer nivel LRU en memoria y un segundo nivel en SQLite con tamaño máximo,
+    caducidad (TTL) y expulsión de las entradas usadas hace más tiempo.
+    """
+
+    def __init__(self, ruta, max_entradas_memoria=256, max_bytes_disco=200 * 1024 * 1024, ttl_segundos=72 * 3600):
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()
+        self._max_entradas_memoria = max_entradas_memoria
+        self._max_bytes_disco = max_bytes_disco
+        self._ttl = ttl_segundos
+        self.aciertos_memoria = 0
+        self.aciertos_disco = 0
+        self.fallos = 0
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS respuestas ("
+            "clave TEXT PRIMARY KEY, valor TEXT NOT NULL, bytes INTEGER NOT NULL, "
+            "creado REAL NOT NULL, ultimo_acceso REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_ultimo_acceso ON respuestas (ultimo_acceso)")
+        self._db.commit()
+
+    @staticmethod
+    def calcular_clave(model_name, prompt, generation_config=None):
+        material = json.dumps([model_name, prompt, generation_config or {}], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+    def obtener(self, clave):
+        ahora = time.time()
+        with self._lock:
+            entrada = self._memoria.get(clave)
+            if entrada is not None and ahora - entrada[1] < self._ttl:
+                self._memoria.move_to_end(clave)
+                self.aciertos_memoria += 1
+                return entrada[0]
+            self._memoria.pop(clave, None)
+
+            fila = self._db.execute("SELECT valor, creado FROM respuestas WHERE clave = ?", (clave,)).fetchone()
+            if fila is None or ahora - fila[1] >= self._ttl:
+                if fila is not None:
+                    self._db.execute("DELETE FROM respuestas WHERE clave = ?", (clave,))
+                    self._db.commit()
+                self.fallos += 1
+                return None
+            self._db.execute("UPDATE respuestas SET ultimo_acceso = ? WHERE clave = ?", (ahora, clave))
+            self._db.commit()
+            self._guardar_en_memoria(clave, fila[0], fila[1])
+            self.aciertos_disco += 1
+            return fila[0]
+
+    def guardar(self, clave, valor):
+        ahora = time.time()
+        with self._lock:
+            self._guardar_en_memoria(clave, valor, ahora)
+            self._db.execute(
+                "INSERT OR REPLACE INTO respuestas (clave, valor, bytes, creado, ultimo_acceso) VALUES (?, ?, ?, ?, ?)",
+                (clave, valor, len(valor.encode("utf-8")), ahora, ahora)
+            )
+            self._expulsar(ahora)
+            self._db.commit()
+
+    def vaciar(self):
+        with self._lock:
+            self._memoria.clear()
+            self._db.execute("DELETE FROM respuestas")
+            self._db.commit()
+
+    def estadisticas(self):
+        with self._lock:
+            entradas, total_bytes = self._db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()
+        return {
+            "aciertos_memoria": self.aciertos_memoria,
+            "aciertos_disco": self.aciertos_disco,
+            "fallos": self.fallos,
+            "entradas_disco": entradas,
+            "bytes_disco": total_bytes,
+        }
+
+    def _guardar_en_memoria(self, clave, valor, creado):
+        self._memoria[clave] = (valor, creado)
+        self._memoria.move_to_end(clave)
+        while len(self._memoria) > self._max_entradas_memoria:
+            self._memoria.popitem(last=False)
+
+    def _expulsar(self, ahora):
+        # Primero lo caducado; después, las entradas menos usadas hasta volver bajo el límite.
+        self._db.execute("DELETE FROM respuestas WHERE creado <= ?", (ahora - self._ttl,))
+        total_bytes = self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM respuestas").fetchone()[0]
+        if total_bytes <= self._max_bytes_disco:
+            return
+        for clave, tamano in self._db.execute("SELECT clave, bytes FROM respuestas ORDER BY ultimo_acceso").fetchall():
+            self._db.execute("DELETE FROM respuestas WHERE clave = ?", (clave,))
+            total_bytes -= tamano
+            if total_bytes <= self._max_bytes_disco:
+                break
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_cache_respuestas():
+    return CacheRespuestas(
+        ruta=os.environ.get("LLM_CACHE_PATH", os.path.join(tempfile.gettempdir(), "cache_respuestas_llm.sqlite3")),
+        max_bytes_disco=int(os.environ.get("LLM_CACHE_MAX_MB", "200")) * 1024 * 1024,
+        ttl_segundos=int(os.environ.get("LLM_CACHE_TTL_HORAS", "72")) * 3600,
+    )
+
+
+# --- ALMACÉN DE ARTEFACTOS (textos comprimidos y direccionados por contenido) ---
+class AlmacenArtefactos:
+    """Guarda inspiraciones, planes y actividades fuera de `st.session_state`.
+
+    Cada artefacto se identifica por el SHA-256 de su contenido, así que un mismo plan o
+    actividad se guarda una sola vez aunque lo usen varios usuarios. En SQLite se guarda
+    comprimido con zlib; en memoria solo se mantiene un LRU pequeño de los más usados. Los
+    artefactos que nadie lee durante `ttl_segundos` caducan, y si el disco supera el límite
+    se expulsan primero los usados hace más tiempo.
+    """
+
+    def __init__(self, ruta, max_entradas_memoria=64, max_bytes_disco=500 * 1024 * 1024, ttl_segundos=7 * 24 * 3600):
+        self._lock = threading.Lock()
+        self._memoria = OrderedDict()
+        self._max_entradas_memoria = max_entradas_memoria
+        self._max_bytes_disco = max_bytes_disco
+        self._ttl = ttl_segundos
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS artefactos ("
+            "id TEXT PRIMARY KEY, contenido BLOB NOT NULL, bytes INTEGER NOT NULL, "
+            "bytes_originales INTEGER NOT NULL, ultimo_acceso REAL NOT NULL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_artefactos_acceso ON artefactos (ultimo_acceso)")
+        self._db.commit()
+
+    def guardar(self, texto):
+        """Guarda el texto (si no existía ya) y devuelve su ID."""
+        datos = texto.encode("utf-8")
+        artefacto_id = hashlib.sha256(datos).hexdigest()
+        ahora = time.time()
+        with self._lock:
+            self._guardar_en_memoria(artefacto_id, texto)
+            actualizado = self._db.execute("UPDATE artefactos SET ultimo_acceso = ? WHERE id = ?", (ahora, artefacto_id)).rowcount
+            if not actualizado:
+                comprimido = zlib.compress(datos, 6)
+                self._db.execute(
+                    "INSERT INTO artefactos (id, contenido, bytes, bytes_originales, ultimo_acceso) VALUES (?, ?, ?, ?, ?)",
+                    (artefacto_id, comprimido, len(comprimido), len(datos), ahora)
+                )
+                self._expulsar(ahora)
+            self._db.commit()
+        return artefacto_id
+
+    def obtener(self, artefacto_id):
+        """Devuelve el texto del artefacto, o None si no existe o ya caducó."""
+        if not artefacto_id:
+            return None
+        with self._lock:
+            texto = self._memoria.get(artefacto_id)
+            if texto is not None:
+                self._memoria.move_to_end(artefacto_id)
+                return texto
+            fila = self._db.execute("SELECT contenido FROM artefactos WHERE id = ?", (artefacto_id,)).fetchone()
+            if fila is None:
+                return None
+            self._db.execute("UPDATE artefactos SET ultimo_acceso = ? WHERE id = ?", (time.time(), artefacto_id))
+            self._db.commit()
+            texto = zlib.decompress(fila[0]).decode("utf-8")
+            self._guardar_en_memoria(artefacto_id, texto)
+            return texto
+
+    def guardar_actividad(self, resultado):
+        """Sustituye el texto y la estructura de un resultado de sesión por el ID de su artefacto."""
+        contenido = {"activity_text": resultado.get("activity_text") or "", "estructura": resultado.get("estructura")}
+        return {
+            "status": resultado["status"],
+            "title": resultado["title"],
+            "actividad_id": self.guardar(json.dumps(contenido, ensure_ascii=False, sort_keys=True)),
+        }
+
+    def cargar_actividad(self, resultado):
+        """Inverso de guardar_actividad. Los resultados que aún traen el texto se devuelven tal cual;
+        si el artefacto caducó, la actividad vuelve vacía y marcada como `caducada`."""
+        if "actividad_id" not in resultado:
+            return resultado
+        contenido = self.obtener(resultado["actividad_id"])
+        datos = json.loads(contenido) if contenido else {"activity_text": "", "estructura": None, "caducada": True}
+        return {**resultado, **datos}
+
+    def estadisticas(self):
+        with self._lock:
+            entradas, comprimidos, originales = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(bytes), 0), COALESCE(SUM(bytes_originales), 0) FROM artefactos"
+            ).fetchone()
+        return {"entradas": entradas, "bytes": comprimidos, "bytes_originales": originales}
+
+    def _guardar_en_memoria(self, artefacto_id, texto):
+        self._memoria[artefacto_id] = texto
+        self._memoria.move_to_end(artefacto_id)
+        while len(self._memoria) > self._max_entradas_memoria:
+            self._memoria.popitem(last=False)
+
+    def _expulsar(self, ahora):
+        # Primero lo caducado; después, lo menos usado hasta volver bajo el límite.
+        caducados = [fila[0] for fila in self._db.execute("SELECT id FROM artefactos WHERE ultimo_acceso <= ?", (ahora - self._ttl,))]
+        total_bytes = self._db.execute("SELECT COALESCE(SUM(bytes), 0) FROM artefactos").fetchone()[0]
+        expulsados = caducados
+        if total_bytes > self._max_bytes_disco:
+            for artefacto_id, tamano in self._db.execute("SELECT id, bytes FROM artefactos ORDER BY ultimo_acceso").fetchall():
+                expulsados.append(artefacto_id)
+                total_bytes -= tamano
+                if total_bytes <= self._max_bytes_disco:
+                    break
+        for artefacto_id in expulsados:
+            self._db.execute("DELETE FROM artefactos WHERE id = ?", (artefacto_id,))
+            self._memoria.pop(artefacto_id, None)
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_almacen_artefactos():
+    return AlmacenArtefactos(
+        ruta=os.environ.get("ARTEFACTOS_DB_PATH", os.path.join(tempfile.gettempdir(), "artefactos.sqlite3")),
+        max_bytes_disco=int(os.environ.get("ARTEFACTOS_MAX_MB", "500")) * 1024 * 1024,
+        ttl_segundos=int(os.environ.get("ARTEFACTOS_TTL_DIAS", "7")) * 24 * 3600,
+    )
+
+
+# --- MÉTRICAS DE LLAMADAS AL MODELO (latencia, tokens y coste) ---
+# USD por millón de tokens (precio público de Vertex AI para prompts de hasta 200k tokens).
+# Los tokens de razonamiento se facturan como salida y los cacheados con descuento.
+PRECIOS_MODELOS = {
+    "gemini-2.5-pro": {"entrada": 1.25, "cacheados": 0.31, "salida": 10.0},
+    "gemini-2.5-flash": {"entrada": 0.30, "cacheados": 0.075, "salida": 2.50},
+    "gemini-2.5-flash-lite": {"entrada": 0.10, "cacheados": 0.025, "salida": 0.40},
+}
+
+BUCKETS_LATENCIA = (0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+
+registro_metricas = logging.getLogger("circoap.metricas")
+
+
+def configurar_registro_metricas(destino=None):
+    """Escribe una línea JSON por span en `destino`: "stderr" o la ruta de un archivo.
+
+    Por defecto se lee de METRICAS_LOG; sin destino, el logger no tiene handler y las líneas se
+    descartan. Streamlit reejecuta el módulo en cada rerun, así que el handler se añade una sola vez.
+    """
+    destino = destino or os.environ.get("METRICAS_LOG")
+    if not destino or registro_metricas.handlers:
+        return
+    handler = logging.StreamHandler() if destino == "stderr" else logging.FileHandler(destino, encoding="utf-8")
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    registro_metricas.addHandler(handler)
+    registro_metricas.setLevel(logging.INFO)
+    # Las líneas ya son JSON completos: no se repiten con el formato del logger raíz.
+    registro_metricas.propagate = False
+
+
+configurar_registro_metricas()
+
+
+def estimar_coste(model_name, tokens_entrada, tokens_cacheados, tokens_salida, tokens_razonamiento):
+    precios = PRECIOS_MODELOS.get(model_name)
+    if not precios:
+        return 0.0
+    return (
+        (tokens_entrada - tokens_cacheados) * precios["entrada"]
+        + tokens_cacheados * precios["cacheados"]
+        + (tokens_salida + tokens_razonamiento) * precios["salida"]
+    ) / 1_000_000
+
+
+class MetricasLLM:
+    """Registro de una medición (span) por cada llamada al modelo.
+
+    Cada span lleva el modelo, la etapa (plan, generacion, refinamiento, auditoria), la
+    secuencia, la sesión y el intento, junto con la duración, la espera en el limitador,
+    los tokens de `usage_metadata` y el coste estimado. Se escribe como una línea JSON en el
+    logger `circoap.metricas` (ver configurar_registro_metricas) y se agrega en contadores
+    que se exportan en formato Prometheus.
+    """
+
+    def __init__(self, max_spans=2000, max_sesiones=500, ruta_prometheus=None, intervalo_escritura=5.0):
+        self._lock = threading.Lock()
+        self._spans = deque(maxlen=max_spans)
+        self._sesiones = OrderedDict()
+        self._max_sesiones = max_sesiones
+        self._contadores = {}
+        self._espera_limitador = {}
+        self._ruta_prometheus = ruta_prometheus
+        self._intervalo_escritura = intervalo_escritura
+        self._ultima_escritura = 0.0
+
+    def registrar(self, span):
+        registro_metricas.info(json.dumps(span, ensure_ascii=False))
+        clave = (span["modelo"], span["etapa"])
+        with self._lock:
+            self._spans.append(span)
+            contador = self._contadores.setdefault(clave, {
+                "resultados": {}, "buckets": [0] * len(BUCKETS_LATENCIA), "segundos": 0.0, "observaciones": 0,
+                "tokens": {"entrada": 0, "cacheados": 0, "salida": 0, "razonamiento": 0}, "coste_usd": 0.0,
+                "reintentos": 0, "coberturas": 0,
+            })
+            contador["resultados"][span["resultado"]] = contador["resultados"].get(span["resultado"], 0) + 1
+            if span["resultado"] != "cache":
+                # Los aciertos de caché no pasan por el modelo: se cuentan, pero no en la latencia.
+                contador["segundos"] += span["duracion_s"]
+                contador["observaciones"] += 1
+                for i, limite in enumerate(BUCKETS_LATENCIA):
+                    if span["duracion_s"] <= limite:
+                        contador["buckets"][i] += 1
+            for tipo in contador["tokens"]:
+                contador["tokens"][tipo] += span[f"tokens_{tipo}"]
+            contador["coste_usd"] += span["coste_usd"]
+            contador["reintentos"] += span.get("reintentos", 0)
+            contador["coberturas"] += "cobertura" in span
+            self._espera_limitador[span["modelo"]] = self._espera_limitador.get(span["modelo"], 0.0) + span["espera_s"]
+
+            # El plan se etiqueta con su secuencia pero sin sesión: cuenta en el coste de la secuencia.
+            if span.get("sesion") is not None or span.get("secuencia") is not None:
+                clave_sesion = (span.get("secuencia"), span["sesion"])
+                sesion = self._sesiones.pop(clave_sesion, None) or {
+                    "secuencia": span.get("secuencia"), "sesion": span["sesion"], "intentos": 0, "llamadas": 0,
+                    "reintentos": 0, "errores": 0, "segundos": 0.0, "tokens": 0, "coste_usd": 0.0,
+                }
+                sesion["intentos"] = max(sesion["intentos"], span.get("intento") or 0)
+                sesion["llamadas"] += 1
+                sesion["reintentos"] += span.get("reintentos", 0)
+                sesion["errores"] += span["resultado"] == "error"
+                sesion["segundos"] += span["duracion_s"]
+                sesion["tokens"] += span["tokens_entrada"] + span["tokens_salida"] + span["tokens_razonamiento"]
+                sesion["coste_usd"] += span["coste_usd"]
+                self._sesiones[clave_sesion] = sesion
+                while len(self._sesiones) > self._max_sesiones:
+                    self._sesiones.popitem(last=False)
+
+        if self._ruta_prometheus and time.time() - self._ultima_escritura >= self._intervalo_escritura:
+            self.escribir_prometheus(self._ruta_prometheus)
+
+    def resumen_por_etapa(self):
+        """Latencia p50/p95 (sobre los spans recientes), tokens y coste acumulados por etapa."""
+        with self._lock:
+            spans = list(self._spans)
+            contadores = {clave: {**c, "tokens": dict(c["tokens"])} for clave, c in self._contadores.items()}
+        filas = {}
+        for (_, etapa), contador in contadores.items():
+            fila = filas.setdefault(etapa, {"etapa": etapa, "llamadas": 0, "reintentos": 0, "coberturas": 0, "errores": 0,
+                                            "tokens": 0, "coste_usd": 0.0})
+            fila["llamadas"] += sum(contador["resultados"].values())
+            fila["reintentos"] += contador["reintentos"]
+            fila["coberturas"] += contador["coberturas"]
+            fila["errores"] += contador["resultados"].get("error", 0)
+            fila["tokens"] += contador["tokens"]["entrada"] + contador["tokens"]["salida"] + contador["tokens"]["razonamiento"]
+            fila["coste_usd"] += contador["coste_usd"]
+        for etapa, fila in filas.items():
+            duraciones = sorted(s["duracion_s"] for s in spans if s["etapa"] == etapa and s["resultado"] != "cache")
+            fila["p50_s"] = round(duraciones[len(duraciones) // 2], 2) if duraciones else None
+            fila["p95_s"] = round(duraciones[min(len(duraciones) - 1, int(len(duraciones) * 0.95))], 2) if duraciones else None
+            fila["coste_usd"] = round(fila["coste_usd"], 4)
+        return list(filas.values())
+
+    def resumen_por_sesion(self, secuencia):
+        with self._lock:
+            sesiones = [dict(s) for (sec, num), s in self._sesiones.items() if sec == secuencia and num is not None]
+        for sesion in sesiones:
+            sesion["segundos"] = round(sesion["segundos"], 2)
+            sesion["coste_usd"] = round(sesion["coste_usd"], 4)
+        return sorted(sesiones, key=lambda s: s["sesion"])
+
+    def coste_secuencia(self, secuencia):
+        """Coste de una secuencia: sus sesiones más las llamadas sin sesión, como el plan."""
+        with self._lock:
+            return sum(s["coste_usd"] for (sec, _), s in self._sesiones.items() if sec == secuencia)
+
+    def coste_total(self):
+        with self._lock:
+            return sum(c["coste_usd"] for c in self._contadores.values())
+
+    def exportar_prometheus(self):
+        """Métricas acumuladas en el formato de texto de Prometheus."""
+        with self._lock:
+            contadores = {clave: {**c, "resultados": dict(c["resultados"]), "buckets": list(c["buckets"]), "tokens": dict(c["tokens"])}
+                          for clave, c in self._contadores.items()}
+            espera = dict(self._espera_limitador)
+
+        lineas = [
+            "# HELP circoap_llm_llamadas_total Llamadas al modelo por resultado (ok, error, cache).",
+            "# TYPE circoap_llm_llamadas_total counter",
+        ]
+        for (modelo, etapa), c in sorted(contadores.items()):
+            for resultado, total in sorted(c["resultados"].items()):
+                lineas.append(f'circoap_llm_llamadas_total{{modelo="{modelo}",etapa="{etapa}",resultado="{resultado}"}} {total}')
+        lineas += [
+            "# HELP circoap_llm_duracion_segundos Duración de las llamadas al modelo.",
+            "# TYPE circoap_llm_duracion_segundos histogram",
+        ]
+        for (modelo, etapa), c in sorted(contadores.items()):
+            etiquetas = f'modelo="{modelo}",etapa="{etapa}"'
+            for limite, total in zip(BUCKETS_LATENCIA, c["buckets"]):
+                lineas.append(f'circoap_llm_duracion_segundos_bucket{{{etiquetas},le="{limite}"}} {total}')
+            lineas.append(f'circoap_llm_duracion_segundos_bucket{{{etiquetas},le="+Inf"}} {c["observaciones"]}')
+            lineas.append(f'circoap_llm_duracion_segundos_sum{{{etiquetas}}} {c["segundos"]:.3f}')
+            lineas.append(f'circoap_llm_duracion_segundos_count{{{etiquetas}}} {c["observaciones"]}')
+        lineas += [
+            "# HELP circoap_llm_tokens_total Tokens según usage_metadata, por tipo.",
+            "# TYPE circoap_llm_tokens_total counter",
+        ]
+        for (modelo, etapa), c in sorted(contadores.items()):
+            for tipo, total in c["tokens"].items():
+                lineas.append(f'circoap_llm_tokens_total{{modelo="{modelo}",etapa="{etapa}",tipo="{tipo}"}} {total}')
+        lineas += [
+            "# HELP circoap_llm_coste_usd_total Coste estimado en USD.",
+            "# TYPE circoap_llm_coste_usd_total counter",
+        ]
+        for (modelo, etapa), c in sorted(contadores.items()):
+            lineas.append(f'circoap_llm_coste_usd_total{{modelo="{modelo}",etapa="{etapa}"}} {c["coste_usd"]:.6f}')
+        lineas += [
+            "# HELP circoap_llm_reintentos_total Reintentos tras errores transitorios, 429 o plazos vencidos.",
+            "# TYPE circoap_llm_reintentos_total counter",
+        ]
+        for (modelo, etapa), c in sorted(contadores.items()):
+            lineas.append(f'circoap_llm_reintentos_total{{modelo="{modelo}",etapa="{etapa}"}} {c["reintentos"]}')
+        lineas += [
+            "# HELP circoap_llm_coberturas_total Llamadas en las que se lanzó la petición de respaldo (hedging).",
+            "# TYPE circoap_llm_coberturas_total counter",
+        ]
+        for (modelo, etapa), c in sorted(contadores.items()):
+            lineas.append(f'circoap_llm_coberturas_total{{modelo="{modelo}",etapa="{etapa}"}} {c["coberturas"]}')
+        lineas += [
+            "# HELP circoap_llm_espera_limitador_segundos_total Tiempo esperando turno en el limitador de tasa.",
+            "# TYPE circoap_llm_espera_limitador_segundos_total counter",
+        ]
+        for modelo, segundos in sorted(espera.items()):
+            lineas.append(f'circoap_llm_espera_limitador_segundos_total{{modelo="{modelo}"}} {segundos:.3f}')
+        return "\n".join(lineas) + "\n"
+
+    def escribir_prometheus(self, ruta):
+        # Escritura atómica, apta para el textfile collector de node_exporter.
+        self._ultima_escritura = time.time()
+        temporal = f"{ruta}.tmp"
+        try:
+            with open(temporal, "w", encoding="utf-8") as f:
+                f.write(self.exportar_prometheus())
+            os.replace(temporal, ruta)
+        except OSError as e:
+            logging.warning("No se pudieron escribir las métricas en %s: %s", ruta, e)
+
+    def servir_prometheus(self, puerto):
+        """Expone las métricas en http://0.0.0.0:<puerto>/metrics desde un hilo en segundo plano."""
+        metricas = self
+
+        class Manejador(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                cuerpo = metricas.exportar_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(cuerpo)))
+                self.end_headers()
+                self.wfile.write(cuerpo)
+
+            def log_message(self, formato, *args):
+                pass
+
+        servidor = ThreadingHTTPServer(("0.0.0.0", puerto), Manejador)
+        threading.Thread(target=servidor.serve_forever, daemon=True).start()
+        return servidor
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_metricas():
+    metricas = MetricasLLM(ruta_prometheus=os.environ.get("METRICAS_PROMETHEUS_PATH") or None)
+    puerto = os.environ.get("METRICAS_PUERTO")
+    if puerto:
+        try:
+            metricas.servir_prometheus(int(puerto))
+        except (OSError, ValueError) as e:
+            logging.warning("No se pudo abrir el endpoint de métricas en el puerto %s: %s", puerto, e)
+    return metricas
+
+
+# --- CAPA DE ACCESO A LOS MODELOS (backends intercambiables) ---
+class BackendLLM(abc.ABC):
+    """Interfaz mínima que la app necesita de un proveedor de modelos.
+
+    `generar` devuelve el texto completo y `generar_stream` un generador de fragmentos
+    de texto (cerrarlo cancela la generación). Los errores se propagan como excepciones
+    de google.api_core, igual que en Vertex AI. Si se pasa el dict `uso`, el backend anota
+    en él los tokens consumidos (`tokens_entrada`, `tokens_cacheados`, `tokens_salida`,
+    `tokens_razonamiento`).
+    """
+
+    @abc.abstractmethod
+    def generar(self, model_name, prompt, prefijo=None, generation_config=None, uso=None):
+        pass
+
+    def generar_stream(self, model_name, prompt, prefijo=None, generation_config=None, uso=None):
+        # Por defecto, un único fragmento con la respuesta completa.
+        yield self.generar(model_name, prompt, prefijo, generation_config, uso)
+
+
+class BackendVertex(BackendLLM):
+    """Modelos Gemini de Vertex AI.
+
+    El prefijo (el modelo pedagógico) viaja en línea, al principio del prompt. No se usa ninguna
+    caché de contexto: con unos 660 tokens, queda por debajo del mínimo tanto de CachedContent
+    como de la caché implícita de Gemini (1024 tokens en Flash y 2048 en Pro).
+    """
+
+    def __init__(self, registro):
+        self._registro = registro
+
+    def _modelo_y_prompt(self, model_name, prompt, prefijo):
+        return self._registro.modelo(model_name), (f"{prefijo}\n{prompt}" if prefijo else prompt)
+
+    @staticmethod
+    def _anotar_uso(respuesta, uso):
+        metadatos = getattr(respuesta, "usage_metadata", None)
+        if uso is None or not metadatos or not getattr(metadatos, "prompt_token_count", 0):
+            return
+        uso["tokens_entrada"] = metadatos.prompt_token_count
+        uso["tokens_cacheados"] = getattr(metadatos, "cached_content_token_count", 0)
+        uso["tokens_salida"] = getattr(metadatos, "candidates_token_count", 0)
+        uso["tokens_razonamiento"] = getattr(metadatos, "thoughts_token_count", 0)
+
+    def generar(self, model_name, prompt, prefijo=None, generation_config=None, uso=None):
+        modelo, prompt = self._modelo_y_prompt(model_name, prompt, prefijo)
+        respuesta = modelo.generate_content(prompt, generation_config=generation_config)
+        self._anotar_uso(respuesta, uso)
+        return respuesta.text
+
+    def generar_stream(self, model_name, prompt, prefijo=None, generation_config=None, uso=None):
+        modelo, prompt = self._modelo_y_prompt(model_name, prompt, prefijo)
+        fragmentos = modelo.generate_content(prompt, generation_config=generation_config, stream=True)
+        try:
+            for fragmento in fragmentos:
+                # El uso acumulado llega en los metadatos de los fragmentos (completo en el último).
+                self._anotar_uso(fragmento, uso)
+                try:
+                    yield fragmento.text
+                except ValueError:
+                    continue  # Fragmento sin texto (p. ej. solo metadatos de cierre)
+        finally:
+            fragmentos.close()  # Si el consumidor corta antes, se cancela el resto de la generación
+
+
+def latencia_fija(segundos):
+    return lambda rng: segundos
+
+
+def latencia_lognormal(mediana, sigma=0.5):
+    # Log-normal: la mayoría de las llamadas cerca de la mediana y una cola larga, como un servicio real.
+    return lambda rng: rng.lognormvariate(math.log(mediana), sigma)
+
+
+class BackendSimulado(BackendLLM):
+    """Backend local y determinista para pruebas de carga y perfiles sin un proyecto de GCP.
+
+    Reconoce el tipo de llamada (plan, actividad, auditoría, refinamiento o resumen) por el prompt y responde con
+    textos predefinidos en el formato que espera la app. La latencia de cada tipo sale de una
+    distribución configurable, y se pueden inyectar errores 429 y fallos transitorios.
+    Cada respuesta se sortea con una semilla derivada del prompt y de cuántas veces se ha
+    visto, así que el resultado no depende del orden en que lleguen los hilos.
+    """
+
+    def __init__(self, latencias=None, tasa_aprobacion=0.7, tasa_429=0.0, tasa_fallos=0.0, semilla=0, fragmentos_por_respuesta=20,
+                 tasa_actividad_incompleta=0.0):
+        self.latencias = {
+            "plan": latencia_lognormal(0.2),
+            "actividad": latencia_lognormal(0.3),
+            "auditoria": latencia_lognormal(0.2),
+            "refinamiento": latencia_lognormal(0.1),
+            "resumen": latencia_lognormal(0.15),
+            **(latencias or {})
+        }
+        self.tasa_aprobacion = tasa_aprobacion
+        self.tasa_429 = tasa_429
+        self.tasa_fallos = tasa_fallos
+        self.tasa_actividad_incompleta = tasa_actividad_incompleta
+        self.semilla = semilla
+        self.fragmentos_por_respuesta = fragmentos_por_respuesta
+        self._lock = threading.Lock()
+        self._vistos = {}
+        self.llamadas_por_tipo = {"plan": 0, "actividad": 0, "auditoria": 0, "refinamiento": 0, "resumen": 0}
+
+    @property
+    def llamadas(self):
+        return sum(self.llamadas_por_tipo.values())
+
+    def generar(self, model_name, prompt, prefijo=None, generation_config=None, uso=None):
+        latencia, error, texto = self._preparar(model_name, prompt, prefijo, generation_config)
+        if error:
+            time.sleep(latencia * 0.1)
+            raise error
+        time.sleep(latencia)
+        self._anotar_uso(prompt, prefijo, texto, uso)
+        return texto
+
+    def generar_stream(self, model_name, prompt, prefijo=None, generation_config=None, uso=None):
+        latencia, error, texto = self._preparar(model_name, prompt, prefijo, generation_config)
+        if error:
+            time.sleep(latencia * 0.1)
+            raise error
+        self._anotar_uso(prompt, prefijo, texto, uso)
+        # El primer fragmento tarda ~30% de la latencia; el resto se reparte entre los demás.
+        time.sleep(latencia * 0.3)
+        tamano = max(1, len(texto) // self.fragmentos_por_respuesta)
+        for inicio in range(0, len(texto), tamano):
+            if inicio:
+                time.sleep(latencia * 0.7 / self.fragmentos_por_respuesta)
+            yield texto[inicio:inicio + tamano]
+
+    @staticmethod
+    def _anotar_uso(prompt, prefijo, texto, uso):
+        # Unos 4 caracteres por token, como aproximación de usage_metadata.
+        if uso is not None:
+            uso["tokens_entrada"] = (len(prompt) + len(prefijo or "")) // 4
+            uso["tokens_cacheados"] = 0
+            uso["tokens_salida"] = len(texto) // 4
+            uso["tokens_razonamiento"] = 0
+
+    def _preparar(self, model_name, prompt, prefijo, generation_config=None):
+        prompt_completo = f"{prefijo}\n{prompt}" if prefijo else prompt
+        tipo = self._clasificar(prompt_completo)
+        huella = hashlib.sha256(f"{model_name}\n{prompt_completo}".encode("utf-8")).hexdigest()
+        with self._lock:
+            vista = self._vistos.get(huella, 0)
+            self._vistos[huella] = vista + 1
+            self.llamadas_por_tipo[tipo] += 1
+        rng = random.Random(f"{self.semilla}:{huella}:{vista}")
+        latencia = max(0.0, self.latencias[tipo](rng))
+        sorteo = rng.random()
+        error = None
+        if sorteo < self.tasa_429:
+            error = google_exceptions.ResourceExhausted(f"429 simulado para {model_name}")
+        elif sorteo < self.tasa_429 + self.tasa_fallos:
+            error = google_exceptions.ServiceUnavailable(f"Fallo transitorio simulado para {model_name}")
+        return latencia, error, self._responder(tipo, prompt_completo, rng, generation_config)
+
+    @staticmethod
+    def _clasificar(prompt):
+        if "Eres un auditor" in prompt:
+            return "auditoria"
+        if "Eres un experto en diseño curricular" in prompt:
+            return "plan"
+        if "Reescribe SOLO las secciones" in prompt:
+            return "refinamiento"
+        if "Eres un asistente de síntesis curricular" in prompt:
+            return "resumen"
+        return "actividad"
+
+    def _responder(self, tipo, prompt, rng, generation_config=None):
+        if tipo == "plan":
+            return self._plan_simulado(prompt)
+        if tipo == "resumen":
+            parte = re.search(r"\((?:parte|grupo) (\d+) de (\d+)\)", prompt)
+            return f"- Ideas clave simuladas de la {'parte ' + parte.group(1) if parte else 'sección'} del documento."
+        if tipo == "refinamiento":
+            session_num = re.search(r"Sesión número (\d+)", prompt)
+            nivel = re.search(r"Objetivo Cognitivo \(Bloom\) de esta sesión:\*\*\s*(\w+)", prompt)
+            secciones = dividir_en_secciones(
+                self._actividad_simulada(session_num.group(1) if session_num else "1", nivel.group(1) if nivel else "CREAR")
+            )
+            claves = re.findall(r"^\s*<<<(\w+)>>>", prompt, re.MULTILINE)
+            return "\n".join(f"<<<{clave}>>>\n{secciones[clave]}" for clave in claves if clave in secciones)
+        if tipo == "actividad":
+            session_num = re.search(r"Generar la Sesión número (\d+)", prompt)
+            nivel = re.search(r"Objetivo Cognitivo \(Bloom\) de esta sesión:\*\*\s*(\w+)", prompt)
+            actividad = self._actividad_simulada(session_num.group(1) if session_num else "1", nivel.group(1) if nivel else "CREAR")
+            if rng.random() < self.tasa_actividad_incompleta:
+                # Actividad truncada: sin Guía para el Docente (la detecta la validación local).
+                actividad = actividad.split("### GUÍA PARA EL DOCENTE")[0]
+            return actividad
+        estructurada = (generation_config or {}).get("response_mime_type") == "application/json"
+        return self._auditoria_simulada(rng.random() < self.tasa_aprobacion, estructurada)
+
+    @staticmethod
+    def _plan_simulado(prompt):
+        num_sesiones = re.search(r"\*\*Número de Sesiones:\*\*\s*(\d+)", prompt)
+        num_sesiones = int(num_sesiones.group(1)) if num_sesiones else 3
+        nivel_final = re.search(r"\*\*Nivel Cognitivo Final Deseado \(Bloom\):\*\*\s*(\w+)", prompt)
+        niveles = list(bloom_taxonomy_detallada)
+        tope = niveles.index(nivel_final.group(1)) if nivel_final and nivel_final.group(1) in niveles else len(niveles) - 1
+        texto = "### Plan de Secuencia de Aprendizaje\n\n**Hilo Conductor Narrativo:** Una expedición simulada que avanza sesión a sesión.\n\n---\n"
+        for i in range(1, num_sesiones + 1):
+            nivel = niveles[min(tope, 1 + (tope - 1) * (i - 1) // max(1, num_sesiones - 1))] if tope > 1 else niveles[tope]
+            texto += (
+                f"\n**Sesión {i}: Etapa {i} de la expedición**\n"
+                f"- **Concepto Clave:** Concepto simulado {i}.\n"
+                f"- **Objetivo Cognitivo (Bloom):** {nivel}\n"
+            )
+        return texto
+
+    @staticmethod
+    def _actividad_simulada(session_num, nivel):
+        subprocesos = list(bloom_taxonomy_detallada.get(nivel, bloom_taxonomy_detallada["CREAR"])["subprocesos"])
+        return f"""---
+### GUÍA RÁPIDA (PARA EL AULA / FICHA)
+- **Sesión:** {session_num}
+- **Título:** Etapa {session_num} de la expedición
+- **Propósito (1-2 líneas):** Actividad simulada para pruebas de carga.
+- **Materiales Esenciales:** Papel, lápices.
+- **Momentos Clave (Tiempos Aprox.):**
+    - **Momento Enactivo (Hacer):** Los equipos manipulan materiales. (20 min)
+    - **Momento Icónico (Representar):** Dibujan lo observado. (20 min)
+    - **Momento Simbólico (Abstraer):** Formalizan una regla. (15 min)
+    - **Cierre (Reflexionar):** Comparten conclusiones. (5 min)
+---
+### GUÍA PARA EL DOCENTE (ACOMPAÑAMIENTO)
+
+**1. Descripción Detallada:**
+   - **Propósito Pedagógico:** Recorrer las tres fases de Bruner.
+   - **Pasos por Fase:**
+     - **Enactiva:** Manipular y preguntar.
+     - **Icónica:** Representar lo manipulado.
+     - **Simbólica:** Abstraer a partir de la representación: los equipos deben {subprocesos[0].lower()} y justificar.
+   - **Cierre:** Síntesis guiada.
+
+**2. Evaluación Formativa:**
+   - **Evidencias a Observar:** Productos de cada fase.
+   - **Logros (Criterios de Desempeño):** El grupo formula la regla.
+   - **Errores Típicos y Microintervenciones:** Confundir observación con conclusión.
+
+**3. Cohesión y Metacognición:**
+   - **Bitácora de Secuencia:** Retoma la sesión anterior y prepara la siguiente.
+   - **Prompts de Metacognición:** ¿Qué cambió en tu forma de verlo?
+
+**4. Herramientas de Evaluación:**
+   - **Rúbrica Analítica Simple:**
+
+| Criterio | Inicial | Logrado |
+|---|---|---|
+| Fase Enactiva | Manipula sin propósito | Manipula con una pregunta |
+| Fase Simbólica | Repite la regla | Formula la regla |
+"""
+
+    @staticmethod
+    def _auditoria_simulada(aprobada, estructurada=False):
+        if estructurada:
+            return json.dumps({
+                "criterios": [
+                    {"criterio": "contexto_narrativo", "cumple": True},
+                    {"criterio": "hilo_conductor", "cumple": aprobada,
+                     "comentario": "" if aprobada else "El producto de la fase icónica no se usa en la simbólica."},
+                    {"criterio": "intencion_cognitiva", "cumple": True},
+                ],
+                "dictamen": "CUMPLE" if aprobada else "RECHAZADO",
+                "correcciones": [] if aprobada else ["Conectar la representación icónica con la formalización simbólica."],
+            }, ensure_ascii=False)
+        if aprobada:
+            return (
+                "1. **Contexto Narrativo (Capa 0):** ✅\n"
+                "2. **Hilo Conductor (Capa 3):** ✅\n"
+                "3. **Intención Cognitiva (Capa 5):** ✅\n"
+                "**DICTAMEN FINAL:** ✅ CUMPLE\n"
+                "**OBSERVACIONES FINALES:** Ninguna."
+            )
+        return (
+            "1. **Contexto Narrativo (Capa 0):** ✅\n"
+            "2. **Hilo Conductor (Capa 3):** ❌ El producto de la fase icónica no se usa en la simbólica.\n"
+            "3. **Intención Cognitiva (Capa 5):** ✅\n"
+            "**DICTAMEN FINAL:** ❌ RECHAZADO\n"
+            "**OBSERVACIONES FINALES:** Falla la Capa 3 (Hilo Conductor): conectar la representación con la formalización."
+        )
+
+
+# --- REINTENTOS, PLAZOS Y COBERTURA (hedging) DE LAS LLAMADAS ---
+def clasificar_error(error):
+    """Clasifica un error del modelo: `limite` (429), `plazo`, `transitorio` o `permanente` (no se reintenta)."""
+    if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+        return "limite"
+    if isinstance(error, (google_exceptions.DeadlineExceeded, TimeoutError)):
+        return "plazo"
+    if isinstance(error, (google_exceptions.ServerError, google_exceptions.Aborted, ConnectionError)):
+        return "transitorio"
+    return "permanente"
+
+
+class PoliticaReintentos:
+    """Cuántas veces se reintenta una llamada y cuánto se espera entre intentos.
+
+    La espera crece exponencialmente con jitter (la mitad fija y la otra mitad al azar) y
+    parte de una base mayor tras un 429. `plazo_llamada` limita cada intento y `plazo_total`
+    la llamada completa, reintentos incluidos.
+    """
+
+    def __init__(self, max_intentos=4, espera_base=1.0, espera_maxima=30.0, plazo_llamada=180.0, plazo_total=420.0):
+        self.max_intentos = max_intentos
+        self.espera_base = espera_base
+        self.espera_maxima = espera_maxima
+        self.plazo_llamada = plazo_llamada
+        self.plazo_total = plazo_total
+
+    def espera(self, intento, clase_error):
+        base = self.espera_base * (4 if clase_error == "limite" else 1)
+        tope = min(self.espera_maxima, base * 2 ** (intento - 1))
+        return tope / 2 + random.uniform(0, tope / 2)
+
+
+def ejecutar_en_hilo(funcion):
+    # Hilo propio (daemon) por llamada: si vence el plazo se abandona la espera sin bloquear
+    # un pool compartido; la respuesta tardía simplemente se descarta.
+    futuro = Future()
+
+    def ejecutar():
+        if not futuro.set_running_or_notify_cancel():
+            return
+        try:
+            futuro.set_result(funcion())
+        except BaseException as e:
+            futuro.set_exception(e)
+
+    threading.Thread(target=ejecutar, daemon=True).start()
+    return futuro
+
+
+class ClienteLLM:
+    """Punto único de acceso a los modelos para toda la app.
+
+    Añade sobre cualquier BackendLLM la caché de respuestas, el límite de tasa por modelo,
+    los reintentos con plazo, la cobertura con un modelo más rápido, la entrega en streaming
+    hacia un notificador y la medición de cada llamada.
+
+    `cobertura` asocia un modelo a (modelo_respaldo, presupuesto_s): si una llamada sin
+    streaming no ha respondido en ese presupuesto, se lanza la misma petición al modelo de
+    respaldo y se usa la primera respuesta que llegue.
+    """
+
+    def __init__(self, backend, cache=None, limitador_para=None, metricas=None, reintentos=None, cobertura=None):
+        self.backend = backend
+        self.cache = cache
+        self.limitador_para = limitador_para
+        self.metricas = metricas
+        self.reintentos = reintentos or PoliticaReintentos()
+        self.cobertura = cobertura or {}
+
+    def generar_texto(self, model_name, prompt, notificar=None, streaming=False, titulo=None, expandido=False,
+                      detener_cuando=None, generation_config=None, usar_cache=True, prefijo=None, etiquetas=None):
+        # `prefijo` es la parte del prompt que se repite entre llamadas (modelo pedagógico + plan).
+        # `etiquetas` agrupa la medición: etapa, secuencia, sesión e intento.
+        notificar = notificar or crear_notificador_en_pantalla()
+        span = self._nuevo_span(model_name, etiquetas, streaming)
+        prompt_completo = f"{prefijo}\n{prompt}" if prefijo else prompt
+        clave_cache = CacheRespuestas.calcular_clave(model_name, prompt_completo, generation_config)
+        if self.cache and usar_cache:
+            texto_en_cache = self.cache.obtener(clave_cache)
+            if texto_en_cache is not None:
+                if streaming:
+                    notificar("stream", texto_en_cache, titulo, expandido)
+                self._cerrar_span(span, "cache")
+                return texto_en_cache
+
+        texto = self._llamar(model_name, prompt, prefijo, notificar, streaming, titulo, expandido, detener_cuando, generation_config, span)
+        # Una respuesta del modelo de respaldo no se guarda con la clave del modelo pedido.
+        if texto and self.cache and "modelo_respuesta" not in span:
+            self.cache.guardar(clave_cache, texto)
+        return texto
+
+    def _llamar(self, model_name, prompt, prefijo, notificar, streaming, titulo, expandido, detener_cuando, generation_config, span):
+        politica = self.reintentos
+        limite_total = time.monotonic() + politica.plazo_total
+        intento = 0
+        while True:
+            intento += 1
+            uso = {}
+            plazo = min(politica.plazo_llamada, limite_total - time.monotonic())
+            try:
+                if streaming:
+                    texto = self._llamar_stream(model_name, prompt, prefijo, notificar, titulo, expandido, detener_cuando,
+                                                generation_config, span, uso, plazo)
+                else:
+                    texto = self._llamar_con_cobertura(model_name, prompt, prefijo, generation_config, span, uso, plazo)
+                if self.limitador_para:
+                    self.limitador_para(span.get("modelo_respuesta", model_name)).registrar_exito()
+                self._cerrar_span(span, "ok", uso=uso, texto=texto if streaming else None)
+                return texto or None
+            except Exception as e:
+                clase = clasificar_error(e)
+                if clase == "limite" and self.limitador_para:
+                    self.limitador_para(model_name).penalizar()
+                espera = politica.espera(intento, clase)
+                if clase == "permanente" or intento >= politica.max_intentos or time.monotonic() + espera >= limite_total:
+                    self._cerrar_span(span, "error", uso=uso, error=e)
+                    notificar("error", f"Ocurrió un error al llamar al modelo {model_name}: {e}")
+                    return None
+                span["reintentos"] += 1
+                notificar("warning", f"Error {clase} en {model_name} ({type(e).__name__}); reintento {intento}/{politica.max_intentos - 1} en {espera:.1f} s.")
+                time.sleep(espera)
+
+    def _esperar_turno(self, model_name, span=None):
+        if self.limitador_para:
+            inicio = time.perf_counter()
+            self.limitador_para(model_name).esperar_turno()
+            if span is not None:
+                span["espera_s"] = round(span["espera_s"] + time.perf_counter() - inicio, 3)
+
+    def _llamar_stream(self, model_name, prompt, prefijo, notificar, titulo, expandido, detener_cuando, generation_config, span, uso, plazo):
+        # Modo streaming: se muestra la respuesta a medida que llegan los fragmentos. El stream se
+        # lee en otro hilo y aquí se espera cada fragmento con el tiempo que queda de plazo, así que
+        # un stream que se queda colgado (incluso antes del primer fragmento) también vence.
+        # No hay cobertura: la respuesta ya se está mostrando.
+        self._esperar_turno(model_name, span)
+        limite = time.monotonic() + plazo
+        cola = queue.Queue()
+        fin = object()
+        abandonado = threading.Event()
+
+        def leer():
+            fragmentos = self.backend.generar_stream(model_name, prompt, prefijo, generation_config, uso)
+            try:
+                for fragmento in fragmentos:
+                    if abandonado.is_set():
+                        break
+                    cola.put(fragmento)
+            except Exception as e:
+                cola.put(e)
+            finally:
+                fragmentos.close()  # Si se deja de leer antes, se cancela el resto de la generación
+                cola.put(fin)
+
+        ejecutar_en_hilo(leer)
+        texto = ""
+        try:
+            while True:
+                try:
+                    elemento = cola.get(timeout=max(0.0, limite - time.monotonic()))
+                except queue.Empty:
+                    fase = "terminó la respuesta" if texto else "empezó a responder"
+                    raise google_exceptions.DeadlineExceeded(f"{model_name} no {fase} en {plazo:.0f} s") from None
+                if elemento is fin:
+                    break
+                if isinstance(elemento, Exception):
+                    raise elemento
+                if not texto:
+                    span["primer_fragmento_s"] = round(time.perf_counter() - span["_inicio"] - span["espera_s"], 3)
+                texto += elemento
+                notificar("stream", texto, titulo, expandido)
+                if detener_cuando and detener_cuando(texto):
+                    break
+        finally:
+            abandonado.set()
+        return texto
+
+    def _llamar_con_cobertura(self, model_name, prompt, prefijo, generation_config, span, uso, plazo):
+        self._esperar_turno(model_name, span)
+        limite = time.monotonic() + plazo
+        usos = {}
+
+        def lanzar(modelo):
+            usos[modelo] = {}
+
+            def llamada():
+                if modelo != model_name:
+                    self._esperar_turno(modelo)
+                return self.backend.generar(modelo, prompt, prefijo, generation_config, usos[modelo])
+            return ejecutar_en_hilo(llamada)
+
+        futuros = {lanzar(model_name): model_name}
+        respaldo = self.cobertura.get(model_name)
+        if respaldo and respaldo[1] < plazo:
+            modelo_respaldo, presupuesto = respaldo
+            hechos, _ = wait(futuros, timeout=presupuesto)
+            if not hechos:
+                futuros[lanzar(modelo_respaldo)] = modelo_respaldo
+                span["cobertura"] = modelo_respaldo
+
+        pendientes = set(futuros)
+        error = None
+        while pendientes:
+            hechos, pendientes = wait(pendientes, timeout=max(0.0, limite - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not hechos:
+                raise google_exceptions.DeadlineExceeded(f"{model_name} no respondió en {plazo:.0f} s")
+            for futuro in hechos:
+                if futuro.exception() is None:
+                    modelo = futuros[futuro]
+                    if modelo != model_name:
+                        span["modelo_respuesta"] = modelo
+                    uso.update(usos[modelo])
+                    return futuro.result()
+                error = futuro.exception()
+        raise error
+
+    @staticmethod
+    def _nuevo_span(model_name, etiquetas, streaming):
+        etiquetas = etiquetas or {}
+        return {
+            "modelo": model_name,
+            "etapa": etiquetas.get("etapa", "otra"),
+            "secuencia": etiquetas.get("secuencia"),
+            "sesion": etiquetas.get("sesion"),
+            "intento": etiquetas.get("intento"),
+            "streaming": streaming,
+            "espera_s": 0.0,
+            "reintentos": 0,
+            "_inicio": time.perf_counter(),
+        }
+
+    def _cerrar_span(self, span, resultado, uso=None, texto=None, error=None):
+        if not self.metricas:
+            return
+        uso = uso or {}
+        if texto and not uso.get("tokens_salida"):
+            # Corte anticipado del streaming: sin usage_metadata, se estima por la longitud.
+            uso = {**uso, "tokens_salida": len(texto) // 4}
+        span["duracion_s"] = round(time.perf_counter() - span.pop("_inicio") - span["espera_s"], 3)
+        span["resultado"] = resultado
+        if error is not None:
+            span["error"] = type(error).__name__
+        for tipo in ("entrada", "cacheados", "salida", "razonamiento"):
+            span[f"tokens_{tipo}"] = uso.get(f"tokens_{tipo}") or 0
+        span["coste_usd"] = round(estimar_coste(
+            span.get("modelo_respuesta", span["modelo"]), span["tokens_entrada"], span["tokens_cacheados"], span["tokens_salida"], span["tokens_razonamiento"]
+        ), 6)
+        span["fecha"] = datetime.datetime.now(datetime.timezone.utc).isoformat(timespec="milliseconds")
+        self.metricas.registrar(span)
+
+
+# --- NOTIFICADORES DE PROGRESO ---
+def notificar_nada(tipo, texto, titulo=None, expandido=False):
+    # Para ejecuciones sin interfaz (benchmarks, scripts).
+    pass
+
+
+def crear_notificador_en_pantalla():
+    # Destino por defecto de los mensajes de progreso: se pintan directamente en la página.
+    # Cada expander reserva un marcador por título, de modo que los fragmentos en streaming
+    # y el texto final de una misma respuesta se escriben en el mismo sitio.
+    marcadores = {}
+
+    def notificar(tipo, texto, titulo=None, expandido=False):
+        if tipo in ("stream", "expander"):
+            marcador = marcadores.get(titulo)
+            if marcador is None:
+                if titulo:
+                    with st.expander(titulo, expanded=expandido):
+                        marcador = st.empty()
+                else:
+                    marcador = st.empty()
+                marcadores[titulo] = marcador
+            marcador.markdown(texto)
+        else:
+            getattr(st, tipo)(texto)
+    return notificar
+
+
+# --- INGESTA DE DOCUMENTOS (.docx) ---
+MAX_BYTES_DOCX = int(os.environ.get("DOCX_MAX_MB", "20")) * 1024 * 1024
+MAX_CARACTERES_DOCX = 1_000_000      # Lo que exceda se descarta (se avisa como documento truncado)
+UMBRAL_RESUMEN_CARACTERES = 12_000   # Por debajo, el texto se usa tal cual como inspiración
+TAMANO_FRAGMENTO_CARACTERES = 12_000
+MAX_CARACTERES_INSPIRACION = 6_000   # Tope del resumen que entra en el prompt de planificación
+
+
+def iterar_bloques_docx(documento):
+    """Produce, en el orden del documento, el texto de cada párrafo y de cada fila de tabla."""
+    for bloque in documento.iter_inner_content():
+        if isinstance(bloque, Table):
+            for fila in bloque.rows:
+                # Las celdas combinadas se repiten en cada columna que ocupan: se toman una vez.
+                celdas, vistas = [], set()
+                for celda in fila.cells:
+                    if id(celda._tc) not in vistas:
+                        vistas.add(id(celda._tc))
+                        celdas.append(" ".join(celda.text.split()))
+                if any(celdas):
+                    yield " | ".join(celdas)
+        elif bloque.text.strip():
+            yield bloque.text.strip()
+
+
+def extraer_texto_docx(archivo, max_bytes=MAX_BYTES_DOCX, max_caracteres=MAX_CARACTERES_DOCX):
+    """Devuelve (bloques, truncado) de un .docx; lanza ValueError si el archivo supera `max_bytes`."""
+    archivo.seek(0, io.SEEK_END)
+    tamano = archivo.tell()
+    archivo.seek(0)
+    if tamano > max_bytes:
+        raise ValueError(f"El archivo pesa {tamano / (1024 * 1024):.1f} MB y el máximo es {max_bytes / (1024 * 1024):.0f} MB.")
+
+    bloques, total = [], 0
+    for bloque in iterar_bloques_docx(docx.Document(archivo)):
+        if total + len(bloque) > max_caracteres:
+            return bloques, True
+        bloques.append(bloque)
+        total += len(bloque) + 1
+    return bloques, False
+
+
+def huella_archivo(archivo):
+    # SHA-256 leído por bloques de 1 MB, sin cargar el archivo entero en memoria.
+    huella = hashlib.sha256()
+    archivo.seek(0)
+    for bloque in iter(lambda: archivo.read(1024 * 1024), b""):
+        huella.update(bloque)
+    archivo.seek(0)
+    return huella.hexdigest()
+
+
+def agrupar_en_fragmentos(bloques, tamano_fragmento=TAMANO_FRAGMENTO_CARACTERES):
+    fragmentos, actual, longitud = [], [], 0
+    for bloque in bloques:
+        if actual and longitud + len(bloque) > tamano_fragmento:
+            fragmentos.append("\n".join(actual))
+            actual, longitud = [], 0
+        actual.append(bloque[:tamano_fragmento])
+        longitud += len(actual[-1]) + 1
+    if actual:
+        fragmentos.append("\n".join(actual))
+    return fragmentos
+
+
+def resumir_documento(llm, bloques, model_name, notificar=None, usar_cache=True, max_concurrencia=4,
+                      max_caracteres=MAX_CARACTERES_INSPIRACION):
+    """Map-reduce: resume en paralelo cada fragmento del documento y combina los resúmenes por
+    rondas hasta que caben en `max_caracteres`. Devuelve None si no se obtuvo ningún resumen."""
+    notificar = notificar or notificar_nada
+    palabras_resumen = max(100, max_caracteres // 7)
+
+    def resumir(indice_y_fragmento, total, combinar):
+        indice, fragmento = indice_y_fragmento
+        if combinar:
+            tarea = (f"Integra los siguientes resúmenes parciales (grupo {indice + 1} de {total}) de un mismo documento en un único "
+                     f"resumen sin repeticiones, de como máximo {palabras_resumen} palabras.")
+        else:
+            tarea = (f"Resume el siguiente fragmento (parte {indice + 1} de {total}) de un documento curricular en como máximo "
+                     f"{max(60, palabras_resumen // 4)} palabras.")
+        prompt_resumen = f"""
+        Eres un asistente de síntesis curricular. {tarea}
+        Conserva el tema central, los objetivos, los contenidos y conceptos clave, las actividades sugeridas
+        y los criterios de evaluación. Responde solo con el resumen, en viñetas breves.
+        ---
+        {fragmento}
+        """
+        return llm.generar_texto(model_name, prompt_resumen, notificar, usar_cache=usar_cache,
+                                 etiquetas={"etapa": "resumen"})
+
+    def ronda(fragmentos, combinar):
+        with ThreadPoolExecutor(max_workers=max(1, min(max_concurrencia, len(fragmentos)))) as executor:
+            resumenes = list(executor.map(lambda f: resumir(f, len(fragmentos), combinar), enumerate(fragmentos)))
+        return [r.strip() for r in resumenes if r]
+
+    nivel = ronda(agrupar_en_fragmentos(bloques), combinar=False)
+    while nivel:
+        texto = "\n\n".join(nivel)
+        if len(texto) <= max_caracteres:
+            return texto
+        grupos = agrupar_en_fragmentos(nivel) if len(nivel) > 1 else [nivel[0]]
+        siguiente = ronda(grupos, combinar=True)
+        if not siguiente or len("\n\n".join(siguiente)) >= len(texto):
+            # El modelo ya no reduce más: se recorta para respetar el tope.
+            return texto[:max_caracteres]
+        nivel = siguiente
+    return None
+
+
+def preparar_inspiracion_desde_docx(llm, archivo, model_name, cache=None, notificar=None, usar_cache=True):
+    """Convierte un .docx subido en el texto de inspiración para la planificación.
+
+    Los documentos pequeños pasan tal cual (párrafos y tablas); los grandes se resumen con
+    `resumir_documento` en un texto acotado, que se guarda en la caché de respuestas con la
+    huella del archivo para que volver a subirlo no cueste ninguna llamada. Devuelve un dict
+    con `texto`, `caracteres_originales`, `resumido`, `truncado` y `desde_cache`.
+    """
+    notificar = notificar or notificar_nada
+    clave = CacheRespuestas.calcular_clave(model_name, f"inspiracion-docx:{huella_archivo(archivo)}", {"max_caracteres": MAX_CARACTERES_INSPIRACION})
+    if cache and usar_cache:
+        en_cache = cache.obtener(clave)
+        if en_cache is not None:
+            return {"texto": en_cache, "caracteres_originales": None, "resumido": True, "truncado": False, "desde_cache": True}
+
+    bloques, truncado = extraer_texto_docx(archivo)
+    texto = "\n".join(bloques)
+    resultado = {"texto": texto, "caracteres_originales": len(texto), "resumido": False, "truncado": truncado, "desde_cache": False}
+    if len(texto) <= UMBRAL_RESUMEN_CARACTERES:
+        return resultado
+
+    resumen = resumir_documento(llm, bloques, model_name, notificar, usar_cache=usar_cache)
+    if not resumen:
+        notificar("warning", "No se pudo resumir el documento; se usará solo su comienzo como inspiración.")
+        resultado["texto"] = texto[:MAX_CARACTERES_INSPIRACION]
+        return resultado
+    if cache:
+        cache.guardar(clave, resumen)
+    resultado.update(texto=resumen, resumido=True)
+    return resultado
+
+
+# --- NUEVA FUNCIÓN "CEREBRO" PARA PLANIFICAR LA SECUENCIA ---
+def planificar_secuencia(llm, inspiration_text, num_actividades, nivel_salida_final, model_name, streaming=False, usar_cache=True, notificar=None,
+                         secuencia=None):
+    # `secuencia` etiqueta la medición de la llamada para sumarla al coste de esa secuencia.
+    notificar = notificar or crear_notificador_en_pantalla()
+    notificar("info", f"Diseñando un plan de vuelo para {num_actividades} sesiones...")
+    prompt_planificacion = f"""
+    Eres un experto en diseño curricular. Basado en la siguiente inspiración y requisitos, crea un plan de secuencia de aprendizaje.
+
+    **Inspiración Inicial:** {inspiration_text}
+    **Número de Sesiones:** {num_actividades}
+    **Nivel Cognitivo Final Deseado (Bloom):** {nivel_salida_final}
+
+    **Tu Tarea:**
+    1.  **Define un Hilo Conductor Narrativo:** Crea una historia o misión global que conecte todas las sesiones.
+    2.  **Secuencia los Objetivos Cognitivos:** Distribuye los niveles de la Taxonomía de Bloom a lo largo de las {num_actividades} sesiones. Empieza con niveles bajos (Recordar, Comprender) y progresa hacia el nivel final ({nivel_salida_final}). Sé explícito sobre qué nivel de Bloom es el foco principal de cada sesión.
+    3.  **Desglosa los Contenidos:** Para cada sesión, define brevemente el sub-tema o concepto específico que se abordará.
+
+    **Formato de Salida (Usa Markdown):**
+    
+    ### Plan de Secuencia de Aprendizaje
+    
+    **Hilo Conductor Narrativo:** [Describe la historia o misión global aquí.]
+    
+    ---
+    
+    **Sesión 1: [Título de la Sesión 1]**
+    - **Concepto Clave:** [Describe el concepto de esta sesión.]
+    - **Objetivo Cognitivo (Bloom):** COMPRENDER
+    
+    **Sesión 2: [Título de la Sesión 2]**
+    - **Concepto Clave:** [Describe el concepto de esta sesión.]
+    - **Objetivo Cognitivo (Bloom):** APLICAR
+    
+    ... (continúa para todas las sesiones hasta la {num_actividades})
+    """
+    plan = llm.generar_texto(model_name, prompt_planificacion, notificar, streaming=streaming, usar_cache=usar_cache,
+                             etiquetas={"etapa": "plan", "secuencia": secuencia})
+    return plan
+
+# --- PLAN ESTRUCTURADO Y PRESUPUESTO DE TOKENS ---
+patron_sesion_plan = re.compile(r"^\s*\*\*Sesi[oó]n\s+(\d+)\s*:?\s*(.*?)\*\*\s*$", re.MULTILINE | re.IGNORECASE)
+patron_hilo_conductor = re.compile(r"\*\*Hilo Conductor Narrativo:?\*\*:?\s*(.*?)(?=\n\s*-{3,}|\n\s*\*\*Sesi[oó]n\s+\d+|\Z)", re.DOTALL | re.IGNORECASE)
+patron_concepto_clave = re.compile(r"\*\*Concepto Clave:?\*\*:?\s*(.+)", re.IGNORECASE)
+patron_nivel_bloom = re.compile(r"\*\*Objetivo Cognitivo \(Bloom\):?\*\*:?\s*\**([A-Za-zÁÉÍÓÚáéíóú]+)", re.IGNORECASE)
+
+
+def interpretar_plan(plan_secuencia):
+    """Extrae del plan el hilo conductor y una ficha por sesión (`numero`, `titulo`, `concepto`,
+    `nivel_bloom` y el `texto` Markdown de la sesión). Si no reconoce el formato, `sesiones` queda vacío."""
+    plan_secuencia = plan_secuencia or ""
+    hilo = patron_hilo_conductor.search(plan_secuencia)
+    encabezados = list(patron_sesion_plan.finditer(plan_secuencia))
+    sesiones = []
+    for i, encabezado in enumerate(encabezados):
+        fin = encabezados[i + 1].start() if i + 1 < len(encabezados) else len(plan_secuencia)
+        texto = plan_secuencia[encabezado.start():fin].strip()
+        concepto = patron_concepto_clave.search(texto)
+        nivel = patron_nivel_bloom.search(texto)
+        nivel = normalizar_texto(nivel.group(1)).upper() if nivel else None
+        sesiones.append({
+            "numero": int(encabezado.group(1)),
+            "titulo": encabezado.group(2).strip(" :"),
+            "concepto": concepto.group(1).strip() if concepto else "",
+            "nivel_bloom": nivel if nivel in bloom_taxonomy_detallada else None,
+            "texto": texto,
+        })
+    return {"hilo_conductor": hilo.group(1).strip() if hilo else "", "sesiones": sesiones}
+
+
+def recortar_texto(texto, max_caracteres):
+    # Recorta por el último salto de línea (o espacio) antes del límite para no partir una frase.
+    if len(texto) <= max_caracteres:
+        return texto
+    corte = max(texto.rfind("\n", 0, max_caracteres), texto.rfind(" ", 0, max_caracteres))
+    return texto[:corte if corte > max_caracteres // 2 else max_caracteres].rstrip() + " […]"
+
+
+def variantes_contexto_sesion(plan_estructurado, session_num, plan_secuencia=""):
+    """Contexto narrativo (Capa 0) de una sesión, de la versión más completa a la más compacta.
+
+    1. Hilo conductor + sesión anterior, actual y siguiente.
+    2. Hilo conductor + sesión actual, con solo el título de la anterior y la siguiente.
+    3. Hilo conductor recortado + sesión actual.
+    Si el plan no tiene el formato esperado, la única variante es el plan completo.
+    """
+    por_numero = {sesion["numero"]: sesion for sesion in plan_estructurado["sesiones"]}
+    actual = por_numero.get(session_num)
+    if not actual:
+        return [plan_secuencia or plan_estructurado["hilo_conductor"]]
+
+    hilo = f"**Hilo Conductor Narrativo:** {plan_estructurado['hilo_conductor']}"
+    anterior, siguiente = por_numero.get(session_num - 1), por_numero.get(session_num + 1)
+    vecinas = [f"(Sesión anterior)\n{anterior['texto']}"] if anterior else []
+    vecinas += [f"(Sesión actual)\n{actual['texto']}"]
+    vecinas += [f"(Sesión siguiente)\n{siguiente['texto']}"] if siguiente else []
+    titulos = [f"- Sesión anterior: {anterior['titulo']}"] if anterior else []
+    titulos += [f"- Sesión siguiente: {siguiente['titulo']}"] if siguiente else []
+    return [
+        "\n\n".join([hilo] + vecinas),
+        "\n\n".join([hilo, actual["texto"]] + (["\n".join(titulos)] if titulos else [])),
+        "\n\n".join([recortar_texto(hilo, 600), actual["texto"]]),
+    ]
+
+
+class PresupuestoTokens:
+    """Estima localmente el tamaño de los prompts (sin llamar a count_tokens) y elige la variante
+    de contexto más completa que cabe en el presupuesto; si ni la más compacta cabe, la recorta."""
+
+    def __init__(self, max_tokens=None, caracteres_por_token=4.0):
+        self.max_tokens = max_tokens or int(os.environ.get("PROMPT_MAX_TOKENS", "8000"))
+        self.caracteres_por_token = caracteres_por_token
+
+    def estimar(self, *textos):
+        return sum(math.ceil(len(texto or "") / self.caracteres_por_token) for texto in textos)
+
+    def elegir_contexto(self, variantes, *resto_del_prompt):
+        """Devuelve (contexto, compactado): `compactado` es True si no cupo la variante más completa."""
+        disponible = self.max_tokens - self.estimar(*resto_del_prompt)
+        for i, variante in enumerate(variantes):
+            if self.estimar(variante) <= disponible:
+                return variante, i > 0
+        return recortar_texto(variantes[-1], max(200, int(disponible * self.caracteres_por_token))), True
+
+
+def variantes_de_params(params):
+    # Los parámetros guardados antes de existir el plan estructurado solo traen el plan completo.
+    if params.get("contexto_sesion"):
+        return params["contexto_sesion"]
+    return variantes_contexto_sesion(interpretar_plan(params["plan_secuencia"]), params["session_num"], params["plan_secuencia"])
+
+
+def anteponer_contexto_narrativo(prompt, variantes, prefijo, presupuesto=None):
+    """Antepone al prompt el contexto narrativo que quepa en el presupuesto. Devuelve (prompt, compactado)."""
+    presupuesto = presupuesto or PresupuestoTokens()
+    contexto, compactado = presupuesto.elegir_contexto(variantes, prefijo, prompt)
+    return f"\n    --- CONTEXTO NARRATIVO (Capa 0) ---\n{contexto}\n    ---\n{prompt}", compactado
+
+
+# --- VALIDACIÓN LOCAL PREVIA A LA AUDITORÍA ---
+# Secciones que exige el FORMATO ESTRICTO DE SALIDA del prompt de generación: (patrón, problema si falta).
+SECCIONES_OBLIGATORIAS = [
+    (r"###\s*GU[IÍ]A R[AÁ]PIDA", "Falta el encabezado '### GUÍA RÁPIDA (PARA EL AULA / FICHA)'."),
+    (r"\*\*T[ií]tulo:\*\*", "Falta el campo '**Título:**' en la Guía Rápida."),
+    (r"Momento Enactivo", "Falta el 'Momento Enactivo (Hacer)' en los Momentos Clave."),
+    (r"Momento Ic[oó]nico", "Falta el 'Momento Icónico (Representar)' en los Momentos Clave."),
+    (r"Momento Simb[oó]lico", "Falta el 'Momento Simbólico (Abstraer)' en los Momentos Clave."),
+    (r"###\s*GU[IÍ]A PARA EL DOCENTE", "Falta el encabezado '### GUÍA PARA EL DOCENTE (ACOMPAÑAMIENTO)'."),
+    (r"\*\*Enactiva:\*\*", "Faltan los pasos de la fase Enactiva en la Guía para el Docente."),
+    (r"\*\*Ic[oó]nica:\*\*", "Faltan los pasos de la fase Icónica en la Guía para el Docente."),
+    (r"\*\*Simb[oó]lica:\*\*", "Faltan los pasos de la fase Simbólica en la Guía para el Docente."),
+    (r"Evaluaci[oó]n Formativa", "Falta la sección '2. Evaluación Formativa'."),
+    (r"Cohesi[oó]n y Metacognici[oó]n", "Falta la sección '3. Cohesión y Metacognición'."),
+]
+
+
+def normalizar_texto(texto):
+    # Minúsculas y sin tildes, para comparar verbos sin depender de la acentuación.
+    return "".join(c for c in unicodedata.normalize("NFD", texto.lower()) if unicodedata.category(c) != "Mn")
+
+
+# Terminaciones verbales (sin tildes) que pueden seguir a la raíz: infinitivo, presente, subjuntivo,
+# imperativo, gerundio, participio, pretérito, futuro y condicional, más los pronombres enclíticos.
+TERMINACIONES_VERBALES = {
+    "ar": "ar|a|as|an|amos|ad|ando|ado|ada|ados|adas|e|es|en|emos|o|aron|ara|aras|aran|aremos|aba|aban|aria|arian",
+    "er_ir": "er|ir|e|es|en|emos|imos|o|a|as|an|amos|iendo|ido|ida|idos|idas|io|ieron|iera|ieran|ia|ian|era|eran|ira|iran|eria|iria",
+}
+ENCLITICOS = "lo|la|los|las|le|les|se|nos"
+
+
+def patron_verbo(verbo):
+    # "Diseñar" -> r"\bdisen(?:ar|a|an|...)\b": la raíz solo cuenta al principio de una palabra y seguida
+    # de una terminación verbal, así "generar" no encaja con "general" ni "crear" con "creativo".
+    # En los verbos de varias palabras ("Llevar a cabo") se exige también el complemento.
+    infinitivo, *complemento = normalizar_texto(verbo).split()
+    terminaciones = TERMINACIONES_VERBALES["ar" if infinitivo.endswith("ar") else "er_ir"]
+    if infinitivo.endswith("uir"):
+        terminaciones += "|y(?:e|es|en|o|a|an|endo|eron)"  # construir -> construyen, atribuir -> atribuyo
+    patron = rf"\b{infinitivo[:-2]}(?:{terminaciones})(?:{ENCLITICOS})?\b"
+    if complemento:
+        patron += r"(?:\s+\w+){0,2}?\s+" + r"\s+".join(complemento) + r"\b"
+    return patron
+
+
+# Verbos de cada nivel de Bloom (el nivel, sus subprocesos y sus nombres alternativos), compilados una vez.
+VERBOS_BLOOM = {
+    nivel: re.compile("|".join(sorted({patron_verbo(nivel)} | {
+        patron_verbo(verbo)
+        for subproceso, sub_data in data["subprocesos"].items()
+        for verbo in [subproceso] + sub_data.get("nombres_alternativos", "").split(",") if verbo.strip()
+    })))
+    for nivel, data in bloom_taxonomy_detallada.items()
+}
+
+patron_encabezado_fase = re.compile(
+    r"^([ \t]*)([-*+][ \t]+)?\*\*(?:Fase[ \t]+)?(Enactiva|Ic[oó]nica|Simb[oó]lica):?\*\*:?[ \t]*(.*)$", re.IGNORECASE
+)
+
+
+def extraer_fases(texto):
+    """Devuelve [(fase, bloque)] para cada paso '**Enactiva:**', '**Icónica:**' o '**Simbólica:**' del texto.
+
+    El bloque incluye las sub-viñetas anidadas (instrucciones, preguntas, variantes) y termina en la
+    siguiente fase, en un encabezado o separador, o en la primera línea con la misma sangría o menos.
+    """
+    lineas = texto.splitlines()
+    fases = []
+    for i, linea in enumerate(lineas):
+        encabezado = patron_encabezado_fase.match(linea)
+        if not encabezado:
+            continue
+        sangria, es_vineta = len(encabezado.group(1)), bool(encabezado.group(2))
+        bloque = [encabezado.group(4)]
+        for siguiente in lineas[i + 1:]:
+            contenido = siguiente.strip()
+            if not contenido:
+                bloque.append("")
+                continue
+            sangria_siguiente = len(siguiente) - len(siguiente.lstrip())
+            # Un encabezado sin viñeta ("**Simbólica:**" solo) admite viñetas hijas con su misma sangría.
+            hija_de_encabezado = not es_vineta and sangria_siguiente == sangria and re.match(r"[-*+]\s", contenido)
+            if (patron_encabezado_fase.match(siguiente) or contenido.startswith("#") or re.fullmatch(r"-{3,}", contenido)
+                    or sangria_siguiente < sangria or (sangria_siguiente == sangria and not hija_de_encabezado)):
+                break
+            bloque.append(siguiente.rstrip())
+        fases.append((normalizar_texto(encabezado.group(3)), "\n".join(bloque).strip()))
+    return fases
+
+
+def validar_actividad_localmente(actividad_texto, nivel_salida):
+    """Comprueba sin llamar a ningún modelo la estructura de la actividad y los verbos del nivel de Bloom.
+
+    Devuelve la lista de problemas encontrados (vacía si la actividad puede pasar a la auditoría).
+    """
+    problemas = [mensaje for patron, mensaje in SECCIONES_OBLIGATORIAS if not re.search(patron, actividad_texto, re.IGNORECASE)]
+
+    rubrica = re.search(r"R[uú]brica", actividad_texto, re.IGNORECASE)
+    if not rubrica:
+        problemas.append("Falta la 'Rúbrica Analítica Simple' en Herramientas de Evaluación.")
+    elif not re.search(r"^\s*\|.+\|", actividad_texto[rubrica.end():], re.MULTILINE):
+        problemas.append("La rúbrica debe ser una tabla con criterios y descriptores.")
+
+    verbos = VERBOS_BLOOM.get((nivel_salida or "").upper())
+    if verbos:
+        # El nivel se busca donde debe culminar: en el momento simbólico de la Guía Rápida y en todo el
+        # bloque de la fase simbólica, sub-viñetas incluidas (no en los encabezados fijos de la
+        # plantilla, como "Evaluación Formativa").
+        tramos_simbolicos = re.findall(r"Momento Simb[oó]lico.*", actividad_texto, re.IGNORECASE)
+        tramos_simbolicos += [bloque for fase, bloque in extraer_fases(actividad_texto) if fase == "simbolica"]
+        texto_normalizado = normalizar_texto(" ".join(tramos_simbolicos) or actividad_texto)
+        if not verbos.search(texto_normalizado):
+            problemas.append(
+                f"No aparece ningún verbo del nivel {nivel_salida.upper()} de Bloom "
+                f"({', '.join(bloom_taxonomy_detallada[nivel_salida.upper()]['subprocesos'])})."
+            )
+    return problemas
+
+
+class EstadisticasValidacion:
+    """Cuántas actividades pasaron por la validación local y cuántas auditorías remotas evitó."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.evaluadas = 0
+        self.rechazadas = 0
+
+    def registrar(self, aprobada):
+        with self._lock:
+            self.evaluadas += 1
+            if not aprobada:
+                self.rechazadas += 1
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_estadisticas_validacion():
+    return EstadisticasValidacion()
+
+
+# --- FUNCIÓN DE AUDITORÍA (sin cambios en su lógica interna) ---
+# Una vez emitido un dictamen aprobatorio, el resto del informe no cambia nada y se puede cortar.
+# Si es un rechazo se sigue leyendo, porque las OBSERVACIONES FINALES alimentan el refinamiento.
+patron_dictamen_aprobado = re.compile(r"DICTAMEN FINAL:\**\s*\[?\s*✅ CUMPLE")
+
+# Criterios que valida la auditoría: (clave, nombre de la capa, pregunta).
+CRITERIOS_AUDITORIA = [
+    ("contexto_narrativo", "Contexto Narrativo (Capa 0)", "¿La actividad está completamente inmersa en la historia y usa su lenguaje?"),
+    ("hilo_conductor", "Hilo Conductor (Capa 3)", "¿El producto de cada fase se usa explícitamente como insumo de la siguiente?"),
+    ("intencion_cognitiva", "Intención Cognitiva (Capa 5)", "¿La actividad culmina exitosamente en el nivel de Bloom esperado en la fase simbólica?"),
+]
+
+# Auditoría estructurada: JSON restringido por esquema, sin prosa y con un tope de tokens de salida.
+ESQUEMA_AUDITORIA = {
+    "type": "OBJECT",
+    "properties": {
+        "criterios": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "criterio": {"type": "STRING", "enum": [clave for clave, _, _ in CRITERIOS_AUDITORIA]},
+                    "cumple": {"type": "BOOLEAN"},
+                    "comentario": {"type": "STRING"},
+                },
+                "required": ["criterio", "cumple"],
+            },
+        },
+        "dictamen": {"type": "STRING", "enum": ["CUMPLE", "RECHAZADO"]},
+        "correcciones": {"type": "ARRAY", "items": {"type": "STRING"}, "max_items": 3},
+    },
+    "required": ["criterios", "dictamen", "correcciones"],
+}
+
+CONFIG_AUDITORIA_ESTRUCTURADA = {
+    "temperature": 0,
+    "max_output_tokens": int(os.environ.get("AUDITORIA_MAX_TOKENS", "1536")),
+    "response_mime_type": "application/json",
+    "response_schema": ESQUEMA_AUDITORIA,
+    # En los modelos 2.5 el razonamiento interno cuenta dentro de max_output_tokens.
+    "thinking_config": {"thinking_budget": 512},
+}
+
+
+def interpretar_auditoria_texto(auditoria_texto):
+    # Protocolo original: informe libre en Markdown con el dictamen y las observaciones al final.
+    observaciones_start = auditoria_texto.find("OBSERVACIONES FINALES:")
+    criterios_fallidos = []
+    for clave, nombre, _ in CRITERIOS_AUDITORIA:
+        linea = re.search(rf"{re.escape(nombre)}.*", auditoria_texto)
+        if linea and "❌" in linea.group(0):
+            criterios_fallidos.append(clave)
+    return {
+        "aprobada": "✅ CUMPLE" in auditoria_texto,
+        "criterios_fallidos": criterios_fallidos,
+        "observaciones": auditoria_texto[observaciones_start:] if observaciones_start != -1 else "No se pudo extraer observaciones.",
+        "informe": auditoria_texto,
+    }
+
+
+def interpretar_auditoria_json(auditoria_json):
+    """Convierte la respuesta JSON de la auditoría estructurada; devuelve None si no es válida."""
+    try:
+        datos = json.loads(auditoria_json)
+        criterios = {c["criterio"]: c for c in datos["criterios"]}
+        dictamen = datos["dictamen"]
+        correcciones = [str(c) for c in datos.get("correcciones", [])][:3]
+    except (ValueError, KeyError, TypeError):
+        return None
+    # Sin veredicto para los tres criterios no se puede aprobar: se recurre al informe de texto libre.
+    if dictamen not in ("CUMPLE", "RECHAZADO") or any(clave not in criterios for clave, _, _ in CRITERIOS_AUDITORIA):
+        return None
+
+    # La decisión se toma por criterio; así un dictamen mal formateado no provoca un rechazo falso.
+    criterios_fallidos = [clave for clave, _, _ in CRITERIOS_AUDITORIA if not criterios[clave].get("cumple")]
+    aprobada = not criterios_fallidos
+
+    lineas = []
+    for clave, nombre, _ in CRITERIOS_AUDITORIA:
+        comentario = criterios[clave].get("comentario", "")
+        marca = "✅" if clave not in criterios_fallidos else "❌"
+        lineas.append(f"- **{nombre}:** {marca} {comentario}".rstrip())
+    lineas.append(f"\n**DICTAMEN FINAL:** {'✅ CUMPLE' if aprobada else '❌ RECHAZADO'}")
+    if correcciones:
+        lineas.append("**CORRECCIONES:**\n" + "\n".join(f"- {c}" for c in correcciones))
+
+    fallos = [f"{nombre}: {criterios[clave].get('comentario', '')}" for clave, nombre, _ in CRITERIOS_AUDITORIA if clave in criterios_fallidos]
+    return {
+        "aprobada": aprobada,
+        "criterios_fallidos": criterios_fallidos,
+        "observaciones": "OBSERVACIONES FINALES: " + " | ".join(fallos + correcciones),
+        "informe": "\n".join(lineas),
+    }
+
+
+def auditar_actividad(llm, actividad_generada, nivel_salida_esperado, contexto_narrativo, audit_model_name, notificar=None,
+                      streaming=False, titulo=None, usar_cache=True, estructurada=True, etiquetas=None):
+    """Audita una actividad y devuelve un dict con `aprobada`, `criterios_fallidos`,
+    `observaciones` (para el refinamiento) e `informe` (Markdown para mostrar), o None si falla.
+
+    `contexto_narrativo` es el texto de la Capa 0 o una lista de variantes de más completa a
+    más compacta (ver variantes_contexto_sesion); se usa la mayor que quepa en el presupuesto.
+
+    Con `estructurada` se pide primero la respuesta en JSON; si no llega un JSON válido
+    se repite la auditoría con el protocolo de texto libre.
+    """
+    notificar = notificar or crear_notificador_en_pantalla()
+    # El modelo pedagógico va como prefijo, antes del contexto narrativo y de la actividad.
+    master_prompt_ref = get_master_prompt_system()
+    variantes_contexto = contexto_narrativo if isinstance(contexto_narrativo, list) else [contexto_narrativo]
+
+    if estructurada:
+        preguntas = "\n".join(f"- `{clave}` ({nombre}): {pregunta}" for clave, nombre, pregunta in CRITERIOS_AUDITORIA)
+        auditoria_prompt_json = f"""
+    Eres un auditor experto en diseño instruccional. Audita RIGUROSAMENTE la siguiente actividad individual
+    según el MODELO PEDAGÓGICO INTEGRAL descrito arriba.
+    --- OBJETIVO COGNITIVO PARA ESTA SESIÓN ---
+    El nivel de Bloom esperado es **{nivel_salida_esperado}**.
+    --- ACTIVIDAD A AUDITAR ---
+    {actividad_generada}
+    ---
+    **CRITERIOS:**
+    {preguntas}
+
+    Responde SOLO con el JSON del esquema: un elemento en `criterios` por cada criterio, con un
+    `comentario` de una frase solo si no cumple; en `correcciones`, como máximo 3 acciones concretas.
+    """
+        auditoria_prompt_json, _ = anteponer_contexto_narrativo(auditoria_prompt_json, variantes_contexto, master_prompt_ref)
+        auditoria_json = llm.generar_texto(
+            audit_model_name, auditoria_prompt_json, notificar,
+            generation_config=CONFIG_AUDITORIA_ESTRUCTURADA, usar_cache=usar_cache, prefijo=master_prompt_ref,
+            etiquetas={**(etiquetas or {}), "etapa": "auditoria"}
+        )
+        resultado = interpretar_auditoria_json(auditoria_json) if auditoria_json else None
+        if resultado:
+            return resultado
+        notificar("warning", "La auditoría estructurada no devolvió un JSON válido; se repite en formato de texto.")
+
+    auditoria_prompt = f"""
+    Eres un auditor experto en diseño instruccional. Audita RIGUROSAMENTE la siguiente actividad individual.
+    --- MODELO PEDAGÓGICO DE REFERENCIA ---
+    Es el MODELO PEDAGÓGICO INTEGRAL descrito arriba.
+    --- OBJETIVO COGNITIVO PARA ESTA SESIÓN ---
+    El nivel de salida esperado es **{nivel_salida_esperado}**.
+    --- ACTIVIDAD A AUDITAR ---
+    {actividad_generada}
+    ---
+    **VALIDACIÓN DE CRITERIOS (Responde con ✅/❌ y un comentario breve si es ❌):**
+    1.  **Contexto Narrativo (Capa 0):** ¿La actividad está completamente inmersa en la historia y usa su lenguaje?
+    2.  **Hilo Conductor (Capa 3):** ¿El producto de cada fase se usa explícitamente como insumo de la siguiente?
+    3.  **Intención Cognitiva (Capa 5):** ¿La actividad culmina exitosamente en el nivel de **{nivel_salida_esperado}** en la fase simbólica?
+    **DICTAMEN FINAL:** [✅ CUMPLE / ❌ RECHAZADO]
+    **OBSERVACIONES FINALES:** [Si es ❌, sé específico en qué capa del modelo falló.]
+    """
+    auditoria_prompt, _ = anteponer_contexto_narrativo(auditoria_prompt, variantes_contexto, master_prompt_ref)
+    auditoria_texto = llm.generar_texto(
+        audit_model_name, auditoria_prompt, notificar,
+        streaming=streaming, titulo=titulo, expandido=True,
+        detener_cuando=patron_dictamen_aprobado.search, usar_cache=usar_cache,
+        prefijo=master_prompt_ref, etiquetas={**(etiquetas or {}), "etapa": "auditoria"}
+    )
+    return interpretar_auditoria_texto(auditoria_texto) if auditoria_texto else None
+
+# --- REFINAMIENTO POR SECCIONES ---
+# Secciones de la actividad en el orden de la plantilla. Cada una empieza en su encabezado y
+# llega hasta el de la siguiente, así que unirlas reproduce el texto original.
+SECCIONES_ACTIVIDAD = [
+    ("guia_rapida", "Guía Rápida (para el aula)", r"###\s*GU[IÍ]A R[AÁ]PIDA"),
+    ("encabezado_docente", "Encabezado de la Guía para el Docente", r"###\s*GU[IÍ]A PARA EL DOCENTE"),
+    ("descripcion_detallada", "1. Descripción Detallada", r"\*\*1\.\s*Descripci[oó]n Detallada"),
+    ("evaluacion_formativa", "2. Evaluación Formativa", r"\*\*2\.\s*Evaluaci[oó]n Formativa"),
+    ("cohesion", "3. Cohesión y Metacognición", r"\*\*3\.\s*Cohesi[oó]n"),
+    ("herramientas", "4. Herramientas de Evaluación", r"\*\*4\.\s*Herramientas de Evaluaci[oó]n"),
+]
+
+# Secciones que se reescriben cuando falla cada criterio de la auditoría.
+SECCIONES_POR_CRITERIO = {
+    "contexto_narrativo": ["guia_rapida", "descripcion_detallada"],
+    "hilo_conductor": ["descripcion_detallada", "cohesion"],
+    "intencion_cognitiva": ["descripcion_detallada", "evaluacion_formativa"],
+}
+
+
+def dividir_en_secciones(actividad_texto):
+    """Divide la actividad en un OrderedDict clave -> texto, o devuelve None si falta algún encabezado
+    o no aparecen en el orden de la plantilla. Lo anterior a la Guía Rápida queda en `preambulo`."""
+    posiciones = []
+    for clave, _, patron in SECCIONES_ACTIVIDAD:
+        encontrado = re.search(patron, actividad_texto, re.IGNORECASE)
+        if not encontrado:
+            return None
+        posiciones.append((clave, encontrado.start()))
+    if [inicio for _, inicio in posiciones] != sorted(inicio for _, inicio in posiciones):
+        return None
+
+    secciones = OrderedDict(preambulo=actividad_texto[:posiciones[0][1]])
+    for i, (clave, inicio) in enumerate(posiciones):
+        fin = posiciones[i + 1][1] if i + 1 < len(posiciones) else len(actividad_texto)
+        secciones[clave] = actividad_texto[inicio:fin]
+    return secciones
+
+
+def _separar_cola(texto):
+    # Separa el cuerpo de la sección de su cola (espacios y el separador '---' que precede a la
+    # siguiente guía), para conservar la del original al reemplazar la sección.
+    cola = re.search(r"(?:\s*^-{3,}\s*)?\s*\Z", texto, re.MULTILINE)
+    return texto[:cola.start()], texto[cola.start():]
+
+
+def refinar_secciones(llm, actividad_texto, criterios_fallidos, observaciones, params, prefijo, notificar, titulo=None, etiquetas=None):
+    """Reescribe solo las secciones ligadas a los criterios fallidos y las vuelve a insertar en la actividad.
+
+    Devuelve el texto refinado, o None si la actividad no se puede dividir en secciones o la
+    respuesta no trae ninguna sección utilizable; en ese caso hay que regenerar la actividad entera.
+    """
+    secciones = dividir_en_secciones(actividad_texto)
+    claves = [clave for clave, _, _ in SECCIONES_ACTIVIDAD
+              if any(clave in SECCIONES_POR_CRITERIO.get(criterio, []) for criterio in criterios_fallidos)]
+    if not secciones or not claves:
+        return None
+
+    nombres = {clave: nombre for clave, nombre, _ in SECCIONES_ACTIVIDAD}
+    formato = "\n".join(f"<<<{clave}>>>\n[Versión corregida de la sección '{nombres[clave]}', empezando por su encabezado original.]" for clave in claves)
+    prompt_refinamiento = f"""
+        Eres un diseñador instruccional de élite. La Sesión número {params["session_num"]} de la secuencia fue rechazada
+        por el auditor y debes corregirla SIN regenerarla entera.
+
+        - **Grupo:** {params["grupo"]}
+        - **Objetivo Cognitivo (Bloom) de esta sesión:** {params["nivel_salida"]}
+        - **Observaciones del auditor:** {observaciones}
+        ---
+        **ACTIVIDAD ACTUAL:**
+        {actividad_texto}
+        ---
+        Reescribe SOLO las secciones indicadas abajo para corregir las observaciones, manteniendo el título,
+        la narrativa del CONTEXTO NARRATIVO y la coherencia con las secciones que no cambian. No devuelvas ninguna otra sección.
+        Usa EXACTAMENTE este formato, con cada marcador en su propia línea:
+
+        {formato}
+        """
+    prompt_refinamiento, _ = anteponer_contexto_narrativo(
+        prompt_refinamiento, variantes_de_params(params), prefijo, PresupuestoTokens(params.get("max_tokens_prompt"))
+    )
+    respuesta = llm.generar_texto(
+        params["gen_model"], prompt_refinamiento, notificar,
+        streaming=params.get("streaming", False), titulo=titulo, expandido=params.get("streaming", False),
+        usar_cache=params.get("usar_cache", True), prefijo=prefijo, etiquetas={**(etiquetas or {}), "etapa": "refinamiento"}
+    )
+    if not respuesta:
+        return None
+
+    partes = re.split(r"^\s*<<<(\w+)>>>\s*$", respuesta, flags=re.MULTILINE)
+    patrones = {clave: patron for clave, _, patron in SECCIONES_ACTIVIDAD}
+    reemplazadas = []
+    for clave, nuevo in zip(partes[1::2], partes[2::2]):
+        # Solo se aceptan las secciones pedidas y que conservan su encabezado.
+        if clave not in claves or not re.match(r"\s*" + patrones[clave], nuevo, re.IGNORECASE):
+            continue
+        cuerpo, _ = _separar_cola(nuevo.strip("\n"))
+        _, cola = _separar_cola(secciones[clave])
+        secciones[clave] = cuerpo + cola
+        reemplazadas.append(nombres[clave])
+    if not reemplazadas:
+        return None
+    notificar("info", f"Sesión {params['session_num']}: se refinaron solo las secciones {', '.join(reemplazadas)}.")
+    return "".join(secciones.values())
+
+
+# --- FUNCIÓN DE GENERACIÓN (PROMPT ACTUALIZADO) ---
+def generar_actividad_con_auditoria(llm, params, notificar=None):
+    notificar = notificar or crear_notificador_en_pantalla()
+    # El modelo pedagógico es idéntico para todas las sesiones, intentos y secuencias y va como
+    # prefijo. Cada prompt lleva solo la parte del plan de su sesión.
+    master_prompt = get_master_prompt_system()
+    variantes_contexto = variantes_de_params(params)
+    presupuesto = PresupuestoTokens(params.get("max_tokens_prompt"))
+    current_activity_text = ""
+    audit_observations = ""
+    criterios_fallidos = []
+    max_attempts = 3
+    attempt = 0
+
+    gen_model = params["gen_model"]
+    audit_model = params["audit_model"]
+    streaming = params.get("streaming", False)
+    usar_cache = params.get("usar_cache", True)
+
+    while attempt < max_attempts:
+        attempt += 1
+        notificar("info", f"--- Generando/Refinando Sesión {params['session_num']} (Intento {attempt}/{max_attempts}) ---")
+        
+        # PROMPT ACTUALIZADO PARA GENERAR DOBLE GUÍA
+        prompt_generacion = f"""
+        Eres un diseñador instruccional de élite. Tu tarea es generar UNA ÚNICA actividad detallada que forma parte de una secuencia mayor.
+
+        ---
+        **CONTEXTO DE LA SECUENCIA:** Es el CONTEXTO NARRATIVO (Capa 0) de arriba: el hilo conductor y las sesiones vecinas de esta.
+        ---
+        **TAREA ESPECÍFICA: Generar la Sesión número {params["session_num"]}**
+        ---
+        - **Grupo:** {params["grupo"]}
+        - **Nivel de Entrada para esta sesión:** {params["nivel_entrada"]}
+        - **Objetivo Cognitivo (Bloom) de esta sesión:** {params["nivel_salida"]}
+        - **Modelo Pedagógico Base:** El MODELO PEDAGÓGICO INTEGRAL descrito arriba.
+        ---
+
+        **FORMATO ESTRICTO DE SALIDA (Genera AMBOS documentos usando Markdown):**
+
+        ---
+        ### GUÍA RÁPIDA (PARA EL AULA / FICHA)
+        - **Sesión:** {params["session_num"]}
+        - **Título:** [Título Atractivo]
+        - **Propósito (1-2 líneas):** [Resumen muy breve del objetivo de la sesión.]
+        - **Materiales Esenciales:** [Lista simple.]
+        - **Momentos Clave (Tiempos Aprox.):**
+            - **Momento Enactivo (Hacer):** [Descripción breve de la actividad principal.] (20 min)
+            - **Momento Icónico (Representar):** [Descripción breve de cómo se visualizará.] (20 min)
+            - **Momento Simbólico (Abstraer):** [Descripción breve de la formalización.] (15 min)
+            - **Cierre (Reflexionar):** [Descripción breve.] (5 min)
+        ---
+        ### GUÍA PARA EL DOCENTE (ACOMPAÑAMIENTO)
+
+        **1. Descripción Detallada:**
+           - **Propósito Pedagógico:** [Explicación detallada del porqué de esta actividad.]
+           - **Pasos por Fase:**
+             - **Enactiva:** [Instrucciones detalladas, preguntas del facilitador, variantes piso-medio-techo.]
+             - **Icónica:** [Instrucciones detalladas, preguntas, variantes.]
+             - **Simbólica:** [Instrucciones detalladas, preguntas, variantes.]
+           - **Cierre:** [Instrucciones para guiar la síntesis, metacognición y próximos pasos.]
+
+        **2. Evaluación Formativa:**
+           - **Evidencias a Observar:** [Qué deben producir o decir los estudiantes en cada fase como prueba de comprensión.]
+           - **Logros (Criterios de Desempeño):** [Cómo saber si el grupo alcanzó el objetivo cognitivo de la sesión.]
+           - **Errores Típicos y Microintervenciones:** [Lista de 2-3 errores comunes y cómo el docente puede intervenir sutilmente.]
+
+        **3. Cohesión y Metacognición:**
+           - **Bitácora de Secuencia:** [Cómo esta actividad conecta con la sesión ANTERIOR y prepara la SIGUIENTE.]
+           - **Prompts de Metacognición:** [2-3 preguntas específicas para que los estudiantes reflexionen sobre su proceso de aprendizaje al final.]
+
+        **4. Herramientas de Evaluación:**
+           - **Rúbrica Analítica Simple:** [Tabla con 2-3 criterios y descriptores observables para las fases clave (ej. Enactiva y Simbólica).]
+        """
+
+        if attempt > 1:
+            prompt_generacion += f"\n--- RETROALIMENTACIÓN PARA REFINAMIENTO ---\nLa versión anterior fue rechazada. Observaciones del auditor: {audit_observations}\nPor favor, genera una nueva versión que corrija estos puntos.\n"
+
+        prompt_generacion, compactado = anteponer_contexto_narrativo(prompt_generacion, variantes_contexto, master_prompt, presupuesto)
+        if compactado:
+            notificar("info", f"Sesión {params['session_num']}: el contexto del plan se compactó para no superar {presupuesto.max_tokens} tokens.")
+
+        titulo_actividad = f"Ver Actividad Generada - Sesión {params['session_num']} (Intento {attempt})"
+        etiquetas = {"secuencia": params.get("trabajo_id"), "sesion": params["session_num"], "intento": attempt}
+        actividad_refinada = None
+        if criterios_fallidos and params.get("refinamiento_por_secciones", True):
+            # Si la auditoría señaló criterios concretos, se reescriben solo sus secciones.
+            actividad_refinada = refinar_secciones(
+                llm, current_activity_text, criterios_fallidos, audit_observations, params, master_prompt, notificar,
+                titulo=titulo_actividad, etiquetas=etiquetas
+            )
+        current_activity_text = actividad_refinada or llm.generar_texto(
+            gen_model, prompt_generacion, notificar,
+            streaming=streaming, titulo=titulo_actividad, expandido=streaming, usar_cache=usar_cache,
+            prefijo=master_prompt, etiquetas={**etiquetas, "etapa": "generacion"}
+        )
+        criterios_fallidos = []
+        if not current_activity_text:
+            notificar("error", "Fallo en la generación de texto.")
+            break
+
+        notificar("expander", current_activity_text, titulo_actividad, expandido=streaming)
+
+        # Validación local: si falla la estructura, se regenera directamente sin gastar una auditoría remota.
+        if params.get("validacion_local", True):
+            problemas = validar_actividad_localmente(current_activity_text, params["nivel_salida"])
+            obtener_estadisticas_validacion().registrar(not problemas)
+            if problemas:
+                audit_observations = "OBSERVACIONES FINALES (validación automática): " + " ".join(problemas)
+                notificar("warning", f"La Sesión {params['session_num']} no pasó la validación local (se omite la auditoría):\n- " + "\n- ".join(problemas))
+                continue
+        
+        # La auditoría ahora usa el plan como contexto narrativo
+        titulo_auditoria = f"Ver Resultado de Auditoría - Sesión {params['session_num']} (Intento {attempt})"
+        auditoria = auditar_actividad(
+            llm, current_activity_text, params["nivel_salida"], variantes_contexto, audit_model, notificar,
+            streaming=streaming, titulo=titulo_auditoria, usar_cache=usar_cache,
+            estructurada=params.get("auditoria_estructurada", True), etiquetas=etiquetas
+        )
+        if not auditoria:
+            notificar("error", "Fallo en la auditoría.")
+            break
+
+        notificar("expander", auditoria["informe"], titulo_auditoria, expandido=True)
+
+        if auditoria["aprobada"]:
+            notificar("success", f"¡Sesión {params['session_num']} generada y aprobada en el intento {attempt}!")
+            # La actividad se estructura una sola vez; la interfaz y la exportación reutilizan el resultado.
+            estructura = estructurar_actividad(current_activity_text)
+            title = estructura["titulo"] or f"Sesión {params['session_num']}"
+            return {"activity_text": current_activity_text, "status": "✅ CUMPLE", "title": title, "estructura": estructura}
+        else:
+            audit_observations = auditoria["observaciones"]
+            criterios_fallidos = auditoria["criterios_fallidos"]
+            notificar("warning", f"La Sesión {params['session_num']} necesita refinamiento...")
+    
+    notificar("error", f"No se pudo generar una actividad aprobada para la Sesión {params['session_num']} después de {max_attempts} intentos.")
+    return {"activity_text": current_activity_text, "status": "❌ RECHAZADO", "title": f"Sesión {params['session_num']} (Fallida)",
+            "estructura": estructurar_actividad(current_activity_text)}
+
+
+def construir_params_sesiones(plan_secuencia, num_actividades, nivel_entrada, grupo, gen_model, audit_model, streaming=False, usar_cache=True,
+                              auditoria_estructurada=True, validacion_local=True, refinamiento_por_secciones=True):
+    # El plan se interpreta una vez: nivel de Bloom y contexto narrativo recortado por sesión
+    plan_estructurado = interpretar_plan(plan_secuencia)
+    niveles_por_sesion = {sesion["numero"]: sesion["nivel_bloom"] for sesion in plan_estructurado["sesiones"]}
+
+    lista_params = []
+    for i in range(1, num_actividades + 1):
+        lista_params.append({
+            "plan_secuencia": plan_secuencia,
+            "contexto_sesion": variantes_contexto_sesion(plan_estructurado, i, plan_secuencia),
+            "session_num": i,
+            "grupo": grupo,
+            "nivel_entrada": nivel_entrada, # Se puede hacer más dinámico en el futuro
+            "nivel_salida": niveles_por_sesion.get(i) or "CREAR",
+            "gen_model": gen_model,
+            "audit_model": audit_model,
+            "streaming": streaming,
+            "usar_cache": usar_cache,
+            "auditoria_estructurada": auditoria_estructurada,
+            "validacion_local": validacion_local,
+            "refinamiento_por_secciones": refinamiento_por_secciones
+        })
+    return lista_params
+
+
+# --- MODELO ESTRUCTURADO DE LA ACTIVIDAD ---
+patron_titulo = re.compile(r"\*\*T[ií]tulo:\*\*\s*(.+)")
+patron_guia_docente = re.compile(r"(?:^\s*-{3,}\s*\n)?\s*###\s*GU[IÍ]A PARA EL DOCENTE[^\n]*\n?", re.IGNORECASE | re.MULTILINE)
+patron_guia_rapida = re.compile(r"^\s*(?:-{3,}\s*\n\s*)?###\s*GU[IÍ]A R[AÁ]PIDA[^\n]*\n?", re.IGNORECASE)
+
+
+def estructurar_actividad(actividad_texto):
+    """Convierte el Markdown de una actividad en un dict con `titulo`, `guia_rapida`, `guia_docente`,
+    `fases` (enactiva, iconica, simbolica) y `rubrica` (encabezados y filas, o None).
+
+    Se calcula una sola vez al generar la actividad; la interfaz y la exportación a Word usan
+    este dict en lugar de volver a dividir el texto.
+    """
+    actividad_texto = actividad_texto or ""
+    titulo = patron_titulo.search(actividad_texto)
+    separador = patron_guia_docente.search(actividad_texto)
+    if separador:
+        guia_rapida = patron_guia_rapida.sub("", actividad_texto[:separador.start()]).strip()
+        guia_docente = actividad_texto[separador.end():].strip()
+    else:
+        guia_rapida, guia_docente = actividad_texto.strip(), ""  # Sin separador: todo va a la guía rápida
+
+    fases = {}
+    for nombre, descripcion in extraer_fases(guia_docente):
+        fases.setdefault(nombre, descripcion)
+
+    return {
+        "titulo": titulo.group(1).strip().strip("*").strip() if titulo else None,
+        "guia_rapida": guia_rapida,
+        "guia_docente": guia_docente,
+        "fases": fases,
+        "rubrica": extraer_rubrica(guia_docente),
+    }
+
+
+def _celdas(linea):
+    return [celda.strip() for celda in linea.strip().strip("|").split("|")]
+
+
+def extraer_rubrica(texto):
+    # Primera tabla Markdown después de la palabra "Rúbrica".
+    rubrica = re.search(r"R[uú]brica", texto, re.IGNORECASE)
+    if not rubrica:
+        return None
+    tabla = re.search(r"(?:^\s*\|.*\|\s*$\n?)+", texto[rubrica.end():], re.MULTILINE)
+    if not tabla:
+        return None
+    filas = [_celdas(linea) for linea in tabla.group(0).strip().splitlines()]
+    filas = [fila for fila in filas if not all(re.fullmatch(r":?-{2,}:?", celda) for celda in fila)]
+    if not filas:
+        return None
+    return {"encabezados": filas[0], "filas": filas[1:]}
+
+
+# --- EXPORTACIÓN A WORD ---
+def _agregar_texto_con_formato(parrafo, texto):
+    # Negritas (**...**) y cursivas (*...*) de Markdown como runs de Word.
+    for trozo in re.split(r"(\*\*[^*]+\*\*|\*[^*\s][^*]*\*)", texto):
+        if trozo.startswith("**") and trozo.endswith("**") and len(trozo) > 4:
+            parrafo.add_run(trozo[2:-2]).bold = True
+        elif trozo.startswith("*") and trozo.endswith("*") and len(trozo) > 2:
+            parrafo.add_run(trozo[1:-1]).italic = True
+        elif trozo:
+            parrafo.add_run(trozo)
+
+
+def _agregar_tabla(doc, filas):
+    columnas = max(len(fila) for fila in filas)
+    tabla = doc.add_table(rows=len(filas), cols=columnas)
+    tabla.style = "Table Grid"
+    for i, fila in enumerate(filas):
+        for j, celda in enumerate(fila):
+            parrafo = tabla.cell(i, j).paragraphs[0]
+            _agregar_texto_con_formato(parrafo, celda)
+            if i == 0:
+                for run in parrafo.runs:
+                    run.bold = True
+
+
+def agregar_markdown_a_docx(doc, texto, nivel_base=3):
+    """Añade Markdown al documento con estilos de Word: encabezados, listas (con anidación por
+    sangría), tablas y negritas/cursivas. Una línea que es solo texto en negrita, como
+    '**2. Evaluación Formativa:**', se trata como encabezado de nivel `nivel_base`.
+    """
+    lineas = texto.splitlines()
+    sangrias = []
+    i = 0
+    while i < len(lineas):
+        linea = lineas[i]
+        contenido = linea.strip()
+        lista = re.match(r"^(\s*)([-*+]|\d+[.)])\s+(.*)$", linea)
+        encabezado = re.match(r"^(#{1,6})\s+(.*)$", contenido)
+        if not lista:
+            sangrias = []
+
+        if not contenido or re.fullmatch(r"-{3,}|\*{3,}", contenido):
+            pass
+        elif contenido.startswith("|"):
+            filas = []
+            while i < len(lineas) and lineas[i].strip().startswith("|"):
+                fila = _celdas(lineas[i])
+                if not all(re.fullmatch(r":?-{2,}:?", celda) for celda in fila):
+                    filas.append(fila)
+                i += 1
+            if filas:
+                _agregar_tabla(doc, filas)
+            continue
+        elif encabezado:
+            # '###' corresponde a `nivel_base`; los niveles más profundos bajan a partir de ahí.
+            doc.add_heading(encabezado.group(2).strip("* "), level=min(9, nivel_base + max(0, len(encabezado.group(1)) - 3)))
+        elif re.fullmatch(r"\*\*[^*]+\*\*:?", contenido):
+            doc.add_heading(contenido.strip("*: ").rstrip(":"), level=nivel_base)
+        elif lista:
+            sangria = len(lista.group(1).replace("\t", "    "))
+            while sangrias and sangria < sangrias[-1]:
+                sangrias.pop()
+            if not sangrias or sangria > sangrias[-1]:
+                sangrias.append(sangria)
+            nivel = min(3, len(sangrias))
+            estilo = "List Number" if lista.group(2)[0].isdigit() else "List Bullet"
+            _agregar_texto_con_formato(doc.add_paragraph(style=estilo if nivel == 1 else f"{estilo} {nivel}"), lista.group(3))
+        else:
+            _agregar_texto_con_formato(doc.add_paragraph(), contenido)
+        i += 1
+
+
+def exportar_secuencia_a_word(plan_secuencia, secuencia):
+    """Construye el .docx de la secuencia a partir de las actividades estructuradas y devuelve sus bytes."""
+    doc = docx.Document()
+    doc.add_heading('Secuencia de Aprendizaje Generada con IA', level=1)
+
+    if plan_secuencia:
+        doc.add_heading('Plan de Vuelo de la Secuencia', level=2)
+        agregar_markdown_a_docx(doc, plan_secuencia, nivel_base=3)
+        doc.add_page_break()
+
+    for i, activity_data in enumerate(secuencia):
+        estructura = activity_data.get("estructura") or estructurar_actividad(activity_data.get("activity_text"))
+        doc.add_heading(f"Sesión {i+1}: {estructura['titulo'] or activity_data.get('title', 'Sin Título')}", level=2)
+
+        doc.add_heading('Guía Rápida (Ficha de Aula)', level=3)
+        agregar_markdown_a_docx(doc, estructura["guia_rapida"], nivel_base=4)
+
+        doc.add_heading('Guía para el Docente (Acompañamiento)', level=3)
+        agregar_markdown_a_docx(doc, estructura["guia_docente"], nivel_base=4)
+
+        if i < len(secuencia) - 1:
+            doc.add_page_break()
+
+    buffer = io.BytesIO()
+    doc.save(buffer)
+    return buffer.getvalue()
+
+
+class CacheDocumentos:
+    """Memoriza los .docx ya construidos por huella del contenido (LRU pequeño, en memoria)."""
+
+    def __init__(self, max_entradas=16):
+        self._lock = threading.Lock()
+        self._documentos = OrderedDict()
+        self._max_entradas = max_entradas
+
+    @staticmethod
+    def huella(plan_secuencia, secuencia):
+        contenido = json.dumps(
+            [plan_secuencia, [(a.get("title"), a.get("activity_text")) for a in secuencia]], ensure_ascii=False
+        )
+        return hashlib.sha256(contenido.encode("utf-8")).hexdigest()
+
+    def docx_de_secuencia(self, plan_secuencia, secuencia):
+        clave = self.huella(plan_secuencia, secuencia)
+        with self._lock:
+            if clave in self._documentos:
+                self._documentos.move_to_end(clave)
+                return self._documentos[clave]
+        documento = exportar_secuencia_a_word(plan_secuencia, secuencia)
+        with self._lock:
+            self._documentos[clave] = documento
+            while len(self._documentos) > self._max_entradas:
+                self._documentos.popitem(last=False)
+        return documento
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_cache_documentos():
+    return CacheDocumentos()
+
+
+# --- COLA DE TRABAJOS EN SEGUNDO PLANO ---
+ESTADOS_TERMINALES = ("completado", "interrumpido", "cancelado")
+
+
+class TrabajoSecuencia:
+    """Generación de una secuencia completa que corre fuera del hilo del script de Streamlit.
+
+    Guarda el resultado de cada sesión y un registro de sus mensajes de progreso, que la
+    interfaz vuelve a pintar en cada consulta. En el registro, los fragmentos en streaming
+    de una misma respuesta se sobrescriben en lugar de acumularse.
+
+    Un trabajo especulativo lleva un `presupuesto`: antes de cada sesión se consulta y, si
+    ya no alcanza, el trabajo se cancela. Su gasto se carga a `usuario`. Al adoptarlo pasa a
+    ser un trabajo normal.
+    `heredadas` indica las sesiones que otro trabajo (uno especulativo cancelado) todavía
+    está generando: en lugar de generarlas otra vez, se espera su resultado.
+    """
+
+    def __init__(self, trabajo_id, lista_params, max_concurrencia, estado="en_cola", resultados=None, creado=None, presupuesto=None,
+                 heredadas=None, usuario=None):
+        self.id = trabajo_id
+        self.lista_params = lista_params
+        self.max_concurrencia = max_concurrencia
+        self.estado = estado
+        self.resultados = resultados or [None] * len(lista_params)
+        self.en_curso = set()
+        self.registro = [[] for _ in lista_params]
+        self.creado = creado or time.time()
+        self.actualizado = self.creado
+        self.presupuesto = presupuesto
+        self.heredadas = heredadas or {}
+        self.usuario = usuario
+        self.cancelado = False
+        self._lock = threading.Lock()
+        self._sesion_terminada = threading.Condition(self._lock)
+
+    def notificador(self, indice):
+        def notificar(tipo, texto, titulo=None, expandido=False):
+            with self._lock:
+                entradas = self.registro[indice]
+                if tipo in ("stream", "expander") and titulo:
+                    for entrada in entradas:
+                        if entrada[0] in ("stream", "expander") and entrada[2] == titulo:
+                            entrada[1] = texto
+                            return
+                entradas.append([tipo, texto, titulo, expandido])
+        return notificar
+
+    def empezar_sesion(self, indice):
+        # La comprobación y el alta en `en_curso` van juntas: tras una cancelación, `en_curso`
+        # contiene exactamente las sesiones que todavía van a terminar.
+        with self._lock:
+            if not self.cancelado and self.presupuesto is not None and not self.presupuesto(self):
+                self.cancelado = True
+            if self.cancelado:
+                return False
+            self.en_curso.add(indice)
+            self.actualizado = time.time()
+            return True
+
+    def terminar_sesion(self, indice, resultado):
+        with self._lock:
+            self.en_curso.discard(indice)
+            self.resultados[indice] = resultado
+            # Los textos en streaming ya están en el resultado; del registro solo quedan los avisos.
+            self.registro[indice] = [entrada for entrada in self.registro[indice] if entrada[0] not in ("stream", "expander")]
+            self.actualizado = time.time()
+            self._sesion_terminada.notify_all()
+
+    def esperar_sesion(self, indice):
+        with self._lock:
+            while indice in self.en_curso:
+                self._sesion_terminada.wait()
+            return self.resultados[indice]
+
+    def cancelar(self):
+        with self._lock:
+            self.cancelado = True
+
+    def adoptar(self):
+        # Falla si el trabajo ya se canceló: lo generado se conserva, pero lo pendiente no avanzará.
+        with self._lock:
+            if self.cancelado:
+                return False
+            self.presupuesto = None
+            return True
+
+    def instantanea(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "estado": self.estado,
+                "lista_params": self.lista_params,
+                "resultados": list(self.resultados),
+                "en_curso": set(self.en_curso),
+                "registro": [[list(entrada) for entrada in entradas] for entradas in self.registro],
+            }
+
+    def a_json(self):
+        with self._lock:
+            return json.dumps({
+                "lista_params": self.lista_params,
+                "max_concurrencia": self.max_concurrencia,
+                "resultados": self.resultados,
+            }, ensure_ascii=False)
+
+
+class GestorTrabajos:
+    """Pool de hilos compartido por todos los usuarios para generar secuencias en segundo plano.
+
+    El estado de cada trabajo (parámetros y resultados por sesión) se guarda en SQLite al
+    terminar cada sesión, de modo que un rerun, una recarga del navegador o una caída del
+    websocket no pierden el trabajo: la interfaz solo consulta el estado por el ID.
+    Con un `almacen`, el plan y el texto de cada actividad van al almacén de artefactos y el
+    trabajo solo guarda sus IDs. Los trabajos terminados se borran de SQLite pasada
+    `retencion_disco_segundos`. Los trabajos especulativos se ejecutan en un pool aparte,
+    de `max_trabajos_especulativos` hilos, y el coste de cada una de sus sesiones se anota en
+    SQLite por usuario (ver gasto_especulativo).
+    """
+
+    def __init__(self, ruta, max_trabajos=8, retencion_memoria_segundos=3600, almacen=None, retencion_disco_segundos=7 * 24 * 3600,
+                 max_trabajos_especulativos=2):
+        self._almacen = almacen
+        self._retencion_disco = retencion_disco_segundos
+        self._executor = ThreadPoolExecutor(max_workers=max_trabajos, thread_name_prefix="trabajo")
+        self._executor_especulativo = ThreadPoolExecutor(max_workers=max_trabajos_especulativos, thread_name_prefix="especulativo")
+        self._trabajos = {}
+        self._lock = threading.Lock()
+        self._retencion = retencion_memoria_segundos
+        self._db = sqlite3.connect(ruta, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS trabajos ("
+            "id TEXT PRIMARY KEY, estado TEXT NOT NULL, creado REAL NOT NULL, "
+            "actualizado REAL NOT NULL, datos TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS gasto_especulativo ("
+            "trabajo_id TEXT NOT NULL, sesion INTEGER NOT NULL, usuario TEXT NOT NULL, "
+            "coste_usd REAL NOT NULL, fecha REAL NOT NULL, PRIMARY KEY (trabajo_id, sesion))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_gasto_usuario ON gasto_especulativo (usuario, fecha)")
+        # Lo que estaba en marcha cuando se detuvo el proceso anterior ya no avanzará.
+        self._db.execute("UPDATE trabajos SET estado = 'interrumpido' WHERE estado NOT IN ('completado', 'interrumpido', 'cancelado')")
+        self._db.commit()
+
+    def enviar(self, llm, lista_params, max_concurrencia, resultados=None, presupuesto=None, heredadas=None, usuario=None):
+        # Las sesiones que ya traen resultado se conservan; solo se generan las que están a None.
+        lista_params = [self._compactar_params(params) for params in lista_params]
+        trabajo = TrabajoSecuencia(uuid.uuid4().hex[:12], lista_params, max_concurrencia, resultados=resultados,
+                                   presupuesto=presupuesto, heredadas=heredadas, usuario=usuario)
+        with self._lock:
+            self._purgar()
+            self._trabajos[trabajo.id] = trabajo
+        self._persistir(trabajo)
+        # Los especulativos van a su propio pool: nunca ocupan el turno de un trabajo pedido por un usuario.
+        executor = self._executor_especulativo if presupuesto is not None else self._executor
+        executor.submit(self._ejecutar, trabajo, llm)
+        return trabajo.id
+
+    def reanudar(self, llm, trabajo_id, indices=None, max_concurrencia=None):
+        """Crea un trabajo nuevo a partir de otro, regenerando solo algunas sesiones.
+
+        Sin `indices` se regeneran las sesiones que faltan o que fueron rechazadas. Las que
+        ya tenían un resultado se generan sin caché de respuestas, porque la caché repetiría
+        exactamente los mismos intentos. Devuelve el ID del trabajo nuevo, o None si no hay nada que hacer.
+        """
+        anterior = self.obtener(trabajo_id)
+        if anterior is None:
+            return None
+        if indices is None:
+            indices = [i for i, resultado in enumerate(anterior.resultados)
+                       if resultado is None or resultado["status"] != "✅ CUMPLE"]
+        if not indices:
+            return None
+        lista_params = [dict(params) for params in anterior.lista_params]
+        resultados = list(anterior.resultados)
+        for indice in indices:
+            if resultados[indice] is not None:
+                lista_params[indice]["usar_cache"] = False
+            resultados[indice] = None
+        return self.enviar(llm, lista_params, max_concurrencia or anterior.max_concurrencia, resultados=resultados)
+
+    def cancelar(self, trabajo_id):
+        """Las sesiones que no han empezado ya no se generan; las que están en marcha terminan."""
+        with self._lock:
+            trabajo = self._trabajos.get(trabajo_id)
+        if trabajo is not None:
+            trabajo.cancelar()
+
+    def adoptar(self, llm, trabajo_id):
+        """Convierte un trabajo especulativo en uno normal y devuelve el ID que hay que seguir.
+
+        Si ya está en marcha, sigue como está. Si el presupuesto lo canceló, o si aún espera
+        turno en el pool especulativo, sus sesiones pasan a un trabajo nuevo del pool normal:
+        las terminadas se reutilizan, las que estaban en curso se esperan y solo las demás se
+        generan.
+        """
+        trabajo = self.obtener(trabajo_id)
+        if trabajo is None:
+            return None
+        if trabajo.estado != "en_cola" and trabajo.adoptar():
+            return trabajo_id
+        trabajo.cancelar()
+        vista = trabajo.instantanea()
+        if None not in vista["resultados"]:
+            return trabajo_id
+        heredadas = {indice: trabajo for indice in vista["en_curso"]}
+        return self.enviar(llm, trabajo.lista_params, trabajo.max_concurrencia, resultados=vista["resultados"], heredadas=heredadas)
+
+    def gasto_especulativo(self, usuario, desde=0.0):
+        """USD gastados por `usuario` en sesiones especulativas desde la fecha `desde` (epoch)."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT COALESCE(SUM(coste_usd), 0) FROM gasto_especulativo WHERE usuario = ? AND fecha >= ?", (usuario, desde)
+            ).fetchone()[0]
+
+    def obtener(self, trabajo_id):
+        with self._lock:
+            trabajo = self._trabajos.get(trabajo_id)
+            if trabajo is not None:
+                return trabajo
+            fila = self._db.execute("SELECT estado, creado, datos FROM trabajos WHERE id = ?", (trabajo_id,)).fetchone()
+        if fila is None:
+            return None
+        datos = json.loads(fila[2])
+        return TrabajoSecuencia(trabajo_id, datos["lista_params"], datos["max_concurrencia"],
+                                estado=fila[0], resultados=datos["resultados"], creado=fila[1])
+
+    def _ejecutar(self, trabajo, llm):
+        trabajo.estado = "en_curso"
+        self._persistir(trabajo)
+        # Cada sesión solo comparte el plan (de solo lectura), así que pueden generarse en paralelo.
+        with ThreadPoolExecutor(max_workers=trabajo.max_concurrencia, thread_name_prefix=f"sesion-{trabajo.id}") as executor:
+            futuros = [
+                executor.submit(self._ejecutar_sesion, trabajo, llm, indice)
+                for indice, resultado in enumerate(trabajo.resultados) if resultado is None
+            ]
+            for futuro in futuros:
+                futuro.result()
+        trabajo.estado = "cancelado" if None in trabajo.instantanea()["resultados"] else "completado"
+        self._persistir(trabajo)
+
+    def _ejecutar_sesion(self, trabajo, llm, indice):
+        if not trabajo.empezar_sesion(indice):
+            return
+        origen = trabajo.heredadas.get(indice)
+        resultado = origen.esperar_sesion(indice) if origen is not None else None
+        if resultado is not None:
+            trabajo.terminar_sesion(indice, resultado)
+            self._persistir(trabajo)
+            return
+        params = trabajo.lista_params[indice]
+        notificar = trabajo.notificador(indice)
+        try:
+            # El ID del trabajo agrupa las métricas de la secuencia; no se guarda en los parámetros persistidos.
+            resultado = generar_actividad_con_auditoria(llm, {**self._expandir_params(params), "trabajo_id": trabajo.id}, notificar)
+        except Exception as e:
+            notificar("error", f"Error inesperado en la Sesión {params['session_num']}: {e}")
+            resultado = {"activity_text": "", "status": "❌ RECHAZADO", "title": f"Sesión {params['session_num']} (Fallida)"}
+        if self._almacen is not None:
+            resultado = self._almacen.guardar_actividad(resultado)
+        if trabajo.presupuesto is not None and trabajo.usuario is not None:
+            self._registrar_gasto(trabajo, llm, params["session_num"])
+        trabajo.terminar_sesion(indice, resultado)
+        self._persistir(trabajo)
+
+    def _registrar_gasto(self, trabajo, llm, session_num):
+        # Las métricas son un LRU en memoria, pero la sesión que acaba de terminar es su entrada más
+        # reciente. Su coste se copia a SQLite, que no se reinicia con una recarga ni con el proceso.
+        metricas = getattr(llm, "metricas", None)
+        sesiones = metricas.resumen_por_sesion(trabajo.id) if metricas else []
+        coste = sum(sesion["coste_usd"] for sesion in sesiones if sesion["sesion"] == session_num)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO gasto_especulativo (trabajo_id, sesion, usuario, coste_usd, fecha) VALUES (?, ?, ?, ?, ?)",
+                (trabajo.id, session_num, trabajo.usuario, coste, time.time())
+            )
+            self._db.commit()
+
+    def _persistir(self, trabajo):
+        datos = trabajo.a_json()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO trabajos (id, estado, creado, actualizado, datos) VALUES (?, ?, ?, ?, ?)",
+                (trabajo.id, trabajo.estado, trabajo.creado, time.time(), datos)
+            )
+            self._db.commit()
+
+    def _compactar_params(self, params):
+        # El plan se guarda una vez en el almacén; el contexto de cada sesión se recalcula a partir
+        # de él (ver variantes_de_params). Así ni la memoria ni SQLite repiten el plan por sesión.
+        if self._almacen is None or "plan_secuencia" not in params:
+            return params
+        compactos = {clave: valor for clave, valor in params.items() if clave not in ("plan_secuencia", "contexto_sesion")}
+        compactos["plan_id"] = self._almacen.guardar(params["plan_secuencia"])
+        return compactos
+
+    def _expandir_params(self, params):
+        if "plan_id" not in params:
+            return params
+        plan_secuencia = self._almacen.obtener(params["plan_id"])
+        if plan_secuencia is None:
+            raise LookupError("El plan de la secuencia ya no está en el almacén (caducó).")
+        return {**params, "plan_secuencia": plan_secuencia}
+
+    def _purgar(self):
+        # Los trabajos terminados siguen disponibles en SQLite; en memoria solo se guardan un rato
+        # y en disco, hasta `retencion_disco_segundos`.
+        ahora = time.time()
+        for trabajo_id, trabajo in list(self._trabajos.items()):
+            if trabajo.estado in ESTADOS_TERMINALES and trabajo.actualizado < ahora - self._retencion:
+                del self._trabajos[trabajo_id]
+        self._db.execute(
+            f"DELETE FROM trabajos WHERE estado IN ({', '.join('?' * len(ESTADOS_TERMINALES))}) AND actualizado < ?",
+            (*ESTADOS_TERMINALES, ahora - self._retencion_disco)
+        )
+        self._db.execute("DELETE FROM gasto_especulativo WHERE fecha < ?", (ahora - self._retencion_disco,))
+        self._db.commit()
+
+
+@st.cache_resource(show_spinner=False)
+def obtener_gestor_trabajos():
+    return GestorTrabajos(
+        ruta=os.environ.get("TRABAJOS_DB_PATH", os.path.join(tempfile.gettempdir(), "trabajos_secuencias.sqlite3")),
+        max_trabajos=int(os.environ.get("MAX_TRABAJOS_CONCURRENTES", "8")),
+        almacen=obtener_almacen_artefactos(),
+        retencion_disco_segundos=int(os.environ.get("TRABAJOS_RETENCION_DIAS", "7")) * 24 * 3600,
+        max_trabajos_especulativos=int(os.environ.get("MAX_TRABAJOS_ESPECULATIVOS", "2")),
+    )
+
+
+# --- PREGENERACIÓN ESPECULATIVA (mientras el docente revisa el plan) ---
+NIVEL_ENTRADA_POR_DEFECTO = "Los estudiantes pueden describir un objeto simple."
+
+
+def huella_params(lista_params):
+    # Si el plan, el nivel de entrada o la configuración cambian, cambia la huella y lo pregenerado no sirve.
+    return hashlib.sha256(json.dumps(lista_params, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def tope_especulativo_configurado():
+    # ESPECULACION_MAX_USD es el gasto máximo de cada usuario en la ventana de ESPECULACION_VENTANA_HORAS;
+    # como el límite de tasa, solo se fija en el servidor.
+    return float(os.environ.get("ESPECULACION_MAX_USD", "0.5")), int(os.environ.get("ESPECULACION_VENTANA_HORAS", "24")) * 3600
+
+
+def identificar_usuario():
+    """Clave del usuario para el tope de gasto: no cambia al recargar la página ni al abrir otra pestaña."""
+    if st.user.get("is_logged_in") and st.user.get("email"):
+        return st.user.get("email")
+    # Detrás de IAP (p. ej. en Cloud Run) el proxy identifica al usuario en esta cabecera.
+    email_iap = st.context.headers.get("X-Goog-Authenticated-User-Email")
+    if email_iap:
+        return email_iap.split(":")[-1]
+    # Sin autenticación, la IP de la conexión (no hay IP en localhost ni fuera de un navegador).
+    ip = st.context.ip_address
+    return ip if isinstance(ip, str) else "local"
+
+
+def crear_presupuesto_especulativo(gestor, usuario, tope_usd, ventana_segundos):
+    """Comprobación que hace el gestor antes de cada sesión especulativa de un usuario.
+
+    Suma lo que ese usuario gastó en pregeneración durante la ventana, según el registro en
+    SQLite del gestor. Las sesiones ya empezadas terminan, así que el tope puede superarse como
+    mucho en lo que cuestan las sesiones en paralelo.
+    """
+    def presupuesto(trabajo):
+        return gestor.gasto_especulativo(usuario, time.time() - ventana_segundos) < tope_usd
+    return presupuesto
 
 
 # --- FUNCIÓN PRINCIPAL QUE ENVUELVE LA APP ---
@@ -29,34 +2690,37 @@ def main():
         page_icon="🎼",
         layout="wide"
     )
+    inicializar_estado_sesion()
     st.title("🎼 Orquestador de Secuencias Pedagógicas con IA 🧠")
     st.markdown("Un co-piloto para diseñar unidades didácticas completas, coherentes e inmersivas.")
 
     # --- INICIALIZACIÓN Y CONFIGURACIÓN DE VERTEX AI ---
     st.sidebar.header("Configuración de Vertex AI")
-    try:
-        GCP_PROJECT_ID = os.environ.get("GCP_PROJECT")
-        GCP_LOCATION = os.environ.get("GCP_LOCATION")
+    if os.environ.get("LLM_BACKEND", "vertex").lower() == "simulado":
+        # Permite recorrer la app completa sin un proyecto de GCP (demos, pruebas de carga de la interfaz).
+        backend = obtener_backend_simulado()
+        st.sidebar.warning("🧪 Backend simulado: las respuestas son de prueba.")
+    else:
+        try:
+            GCP_PROJECT_ID = os.environ.get("GCP_PROJECT")
+            GCP_LOCATION = os.environ.get("GCP_LOCATION")
 
-        if not GCP_PROJECT_ID or not GCP_LOCATION:
-            st.sidebar.error("Variables de entorno GCP_PROJECT y GCP_LOCATION no encontradas.")
-            st.error("Configura tus variables de entorno de Google Cloud para continuar.")
-            st.stop()
+            if not GCP_PROJECT_ID or not GCP_LOCATION:
+                st.sidebar.error("Variables de entorno GCP_PROJECT y GCP_LOCATION no encontradas.")
+                st.error("Configura tus variables de entorno de Google Cloud para continuar.")
+                st.stop()
 
-        vertexai.init(project=GCP_PROJECT_ID, location=GCP_LOCATION)
-        st.sidebar.success(f"✅ Conectado a Vertex AI\nProyecto: {GCP_PROJECT_ID}")
-    except Exception as e:
-        st.sidebar.error(f"Error al inicializar Vertex AI: {e}")
-        st.error("No se pudo conectar con Vertex AI. Verifica la configuración del proyecto y tu autenticación.")
-        st.stop()
+            registro_vertex = obtener_registro_vertex(GCP_PROJECT_ID, GCP_LOCATION)
+            backend = BackendVertex(registro_vertex)
+            st.sidebar.success(f"✅ Conectado a Vertex AI\nProyecto: {GCP_PROJECT_ID}")
+        except Exception as e:
+            st.sidebar.error(f"Error al inicializar Vertex AI: {e}")
+            st.error("No se pudo conectar con Vertex AI. Verifica la configuración del proyecto y tu autenticación.")
+            st.stop()
     
     # --- BLOQUE DE CONFIGURACIÓN DE MODELOS EN LA BARRA LATERAL ---
     st.sidebar.subheader("Selección de Modelos")
-    vertex_ai_models = [
-        "gemini-2.5-pro",
-        "gemini-2.5-flash",
-        "gemini-2.5-flash-lite"
-    ]
+    vertex_ai_models = VERTEX_AI_MODELS
     st.session_state.gen_model_name = st.sidebar.selectbox(
         "**Modelo para Generación y Planificación**",
         vertex_ai_models, index=1, key="gen_vertex_name_sidebar"
@@ -66,266 +2730,232 @@ def main():
         vertex_ai_models, index=0, key="audit_vertex_name_sidebar",
         help="Se recomienda un modelo potente (ej. Pro) para la auditoría."
     )
-    
-    # --- DICCIONARIO DE LA TAXONOMÍA DE BLOOM (sin cambios) ---
-    bloom_taxonomy_detallada = {
-        "RECORDAR": { "definicion": "Recuperar conocimiento relevante de la memoria de largo plazo.", "subprocesos": { "Reconocer": {"nombres_alternativos": "Identificar", "definicion_ejemplo": "Localizar conocimiento..."}, "Evocar": {"nombres_alternativos": "Recuperar", "definicion_ejemplo": "Recuperar conocimiento..."} } },
-        "COMPRENDER": { "definicion": "Construir significado a partir de contenidos educativos.", "subprocesos": { "Interpretar": {"nombres_alternativos": "Aclarar, parafrasear", "definicion_ejemplo": "Transformar de una forma de representación a otra..."}, "Ejemplificar": {"nombres_alternativos": "Ilustrar, citar casos", "definicion_ejemplo": "Poner un ejemplo específico..."}, "Clasificar": {"nombres_alternativos": "Categorizar", "definicion_ejemplo": "Determinar que algo pertenece a una categoría..."}, "Resumir": {"nombres_alternativos": "Abstraer, generalizar", "definicion_ejemplo": "Extraer el tema general..."}, "Inferir": {"nombres_alternativos": "Concluir, predecir", "definicion_ejemplo": "Sacar una conclusión lógica..."}, "Comparar": {"nombres_alternativos": "Contrastar, esquematizar", "definicion_ejemplo": "Detectar correspondencias..."}, "Explicar": {"nombres_alternativos": "Construir modelos", "definicion_ejemplo": "Construir un modelo de causa-efecto..."} } },
-        "APLICAR": { "definicion": "Desarrolar o usar un procedimiento en una situación dada.", "subprocesos": { "Ejecutar": {"nombres_alternativos": "Llevar a cabo", "definicion_ejemplo": "Aplicar un procedimiento a una tarea familiar..."}, "Implementar": {"nombres_alternativos": "Utilizar", "definicion_ejemplo": "Aplicar un procedimiento a una tarea no familiar..."} } },
-        "ANALIZAR": { "definicion": "Despiezar el material en sus partes constituyentes y determinar cómo se relacionan.", "subprocesos": { "Diferenciar": {"nombres_alternativos": "Discriminar, seleccionar", "definicion_ejemplo": "Distinguir las partes relevantes..."}, "Organizar": {"nombres_alternativos": "Integrar, estructurar", "definicion_ejemplo": "Determinar cómo encajan los elementos..."}, "Atribuir": {"nombres_alternativos": "Deconstruir", "definicion_ejemplo": "Determinar los puntos de vista, sesgos..."} } },
-        "EVALUAR": { "definicion": "Formular juicios con base en criterios o parámetros.", "subprocesos": { "Verificar": {"nombres_alternativos": "Detectar, monitorear", "definicion_ejemplo": "Detectar inconsistencias o falacias..."}, "Criticar": {"nombres_alternativos": "Juzgar, argumentar", "definicion_ejemplo": "Detectar inconsistencias con base en criterios externos..."} } },
-        "CREAR": { "definicion": "Agrupar elementos para formar un todo coherente o funcional.", "subprocesos": { "Generar": {"nombres_alternativos": "Formular hipótesis", "definicion_ejemplo": "Formular hipótesis alternativas..."}, "Planear": {"nombres_alternativos": "Diseñar", "definicion_ejemplo": "Idear un procedimiento..."}, "Producir": {"nombres_alternativos": "Construir", "definicion_ejemplo": "Inventar un producto..."} } }
-    }
 
+    # --- BLOQUE DE CONFIGURACIÓN DE EJECUCIÓN CONCURRENTE ---
+    st.sidebar.subheader("Ejecución")
+    st.session_state.max_concurrencia = st.sidebar.slider(
+        "**Sesiones generadas en paralelo**",
+        min_value=1, max_value=10, value=4, key="max_concurrencia_sidebar",
+        help="Con 1 las sesiones se generan una tras otra."
+    )
+    # Solo lectura: el límite es del servidor (LLM_RPM) y lo comparten todos los usuarios conectados.
+    lineas_limite = []
+    for model_name in vertex_ai_models:
+        configurado = llamadas_por_minuto_configuradas(model_name)
+        actual = obtener_limitador(model_name).llamadas_por_minuto
+        reducido = f" (reducido a {actual:.0f} tras errores 429)" if actual < configurado else ""
+        lineas_limite.append(f"{model_name}: {configurado}/min{reducido}")
+    st.sidebar.caption("Límite de llamadas por minuto (común a todos los usuarios):  \n" + "  \n".join(lineas_limite))
+    st.session_state.cobertura = st.sidebar.checkbox(
+        "**Respaldo con Flash si Pro tarda (hedging)**",
+        value=False, key="cobertura_sidebar",
+        help="Si gemini-2.5-pro no responde en el presupuesto, se lanza la misma petición a gemini-2.5-flash "
+             "y se usa la primera respuesta. Solo en llamadas sin streaming, como la auditoría estructurada."
+    )
+    st.session_state.presupuesto_cobertura = st.sidebar.number_input(
+        "**Presupuesto de latencia de Pro (s)**",
+        min_value=5, max_value=300, value=45, step=5, key="presupuesto_cobertura_sidebar",
+        disabled=not st.session_state.cobertura
+    )
+    st.session_state.streaming = st.sidebar.checkbox(
+        "**Mostrar respuestas en tiempo real (streaming)**",
+        value=True, key="streaming_sidebar",
+        help="Las respuestas del modelo aparecen a medida que se generan."
+    )
 
-    # --- SISTEMA DE PROMPTS CENTRALIZADO ---
-    def get_master_prompt_system(contexto_narrativo):
-        bloom_text = ""
-        for level, data in bloom_taxonomy_detallada.items():
-            bloom_text += f"\n### {level}: {data['definicion']}\n"
-            for subprocess, sub_data in data.get('subprocesos', {}).items():
-                alt_names = sub_data.get('nombres_alternativos', '')
-                bloom_text += f"- **{subprocess} ({alt_names}):** {sub_data.get('definicion_ejemplo', '')}\n"
+    st.session_state.auditoria_estructurada = st.sidebar.checkbox(
+        "**Auditoría estructurada (JSON)**",
+        value=True, key="auditoria_estructurada_sidebar",
+        help="Veredicto por criterio en JSON compacto. Si falla, se usa el informe de texto libre."
+    )
 
-        return f"""
-# MODELO PEDAGÓGICO INTEGRAL
-## CAPA 0: CONTEXTO NARRATIVO
-Toda la actividad debe estar inmersa en esta historia:
----
-{contexto_narrativo}
----
-## CAPA 1: FILOSOFÍA (Círculos de Aprendizaje)
-Entorno colaborativo. El facilitador guía con preguntas.
-## CAPA 2: ESTRUCTURA (Bruner)
-Viaje: Enactivo (hacer) -> Icónico (representar) -> Simbólico (abstraer).
-## CAPA 3: COHESIÓN (Hilo Conductor)
-El producto de una fase es el insumo de la siguiente.
-## CAPA 4: DIFERENCIACIÓN (Piso Bajo, Techo Alto)
-Accesible para todos, desafiante para los más avanzados.
-## CAPA 5: INTENCIÓN COGNITIVA (Bloom)
-Las tareas deben provocar procesos de pensamiento específicos y ascender en la taxonomía.
-## CAPA 6: DETALLE DE PROCESOS COGNITIVOS
-Usa los siguientes verbos y definiciones con precisión.
-{bloom_text}
-"""
+    st.session_state.validacion_local = st.sidebar.checkbox(
+        "**Validación local antes de auditar**",
+        value=True, key="validacion_local_sidebar",
+        help="Comprueba secciones obligatorias y verbos de Bloom sin llamar al modelo; si falla, se regenera sin auditar."
+    )
+    stats_validacion = obtener_estadisticas_validacion()
+    if stats_validacion.evaluadas:
+        st.sidebar.caption(
+            f"Validación local: {stats_validacion.rechazadas} de {stats_validacion.evaluadas} actividades rechazadas "
+            f"({stats_validacion.rechazadas} auditorías remotas evitadas)."
+        )
 
-    # --- FUNCIONES DE UTILIDAD Y LÓGICA DE LA APP ---
+    st.session_state.refinamiento_por_secciones = st.sidebar.checkbox(
+        "**Refinar solo las secciones rechazadas**",
+        value=True, key="refinamiento_por_secciones_sidebar",
+        help="Tras un rechazo de la auditoría, reescribe solo las secciones ligadas a los criterios fallidos en lugar de toda la actividad."
+    )
 
-    def leer_docx(file):
-        try:
-            doc = docx.Document(io.BytesIO(file.read()))
-            return '\n'.join([para.text for para in doc.paragraphs])
-        except Exception as e:
-            st.error(f"Error al leer el archivo Word: {e}")
-            return ""
+    st.session_state.especulativa = st.sidebar.checkbox(
+        "**Pregenerar mientras revisas el plan**",
+        value=os.environ.get("ESPECULACION", "").lower() in ("1", "true", "si", "sí"), key="especulativa_sidebar",
+        help="En cuanto se muestra el plan, las sesiones empiezan a generarse con el nivel de entrada por defecto. "
+             "Si apruebas el plan sin cambios se reutilizan; si cambias algo, se descartan."
+    )
+    if st.session_state.especulativa:
+        tope_usd, ventana_segundos = tope_especulativo_configurado()
+        st.sidebar.caption(f"Gasto máximo en pregeneración: {tope_usd:.2f} USD por usuario cada {ventana_segundos // 3600} h.")
 
-    def generar_texto_con_vertex(model_name, prompt):
-        try:
-            modelo = GenerativeModel(model_name)
-            response = modelo.generate_content(prompt)
-            return response.text
-        except Exception as e:
-            st.error(f"Ocurrió un error al llamar al modelo {model_name} en Vertex AI: {e}")
-            return None
+    # --- BLOQUE DE CACHÉ DE RESPUESTAS ---
+    st.sidebar.subheader("Caché de Respuestas")
+    st.session_state.usar_cache = not st.sidebar.checkbox(
+        "**Regenerar (ignorar caché)**",
+        value=False, key="regenerar_sidebar",
+        help="Fuerza nuevas llamadas al modelo. Las respuestas nuevas reemplazan a las guardadas."
+    )
+    cache_respuestas = obtener_cache_respuestas()
+    almacen = obtener_almacen_artefactos()
+    stats_cache = cache_respuestas.estadisticas()
+    col_aciertos, col_fallos = st.sidebar.columns(2)
+    col_aciertos.metric("Aciertos", stats_cache["aciertos_memoria"] + stats_cache["aciertos_disco"],
+                        help=f"Memoria: {stats_cache['aciertos_memoria']} · Disco: {stats_cache['aciertos_disco']}")
+    col_fallos.metric("Fallos", stats_cache["fallos"])
+    st.sidebar.caption(f"{stats_cache['entradas_disco']} respuestas guardadas ({stats_cache['bytes_disco'] / (1024 * 1024):.1f} MB)")
+    if st.sidebar.button("Vaciar caché", key="vaciar_cache_btn"):
+        cache_respuestas.vaciar()
+        st.rerun()
+    stats_artefactos = almacen.estadisticas()
+    st.sidebar.caption(
+        f"{stats_artefactos['entradas']} artefactos compartidos "
+        f"({stats_artefactos['bytes'] / (1024 * 1024):.1f} MB comprimidos de {stats_artefactos['bytes_originales'] / (1024 * 1024):.1f} MB)"
+    )
+
+    # --- BLOQUE DE MÉTRICAS ---
+    metricas = obtener_metricas()
+
+    def panel_metricas():
+        st.subheader("Métricas de Llamadas")
+        st.metric("Coste estimado (USD)", f"{metricas.coste_total():.4f}")
+        por_etapa = metricas.resumen_por_etapa()
+        if not por_etapa:
+            st.caption("Aún no hay llamadas registradas.")
+            return
+        st.dataframe(por_etapa, hide_index=True, width="stretch")
+        if st.session_state.trabajo_id:
+            por_sesion = metricas.resumen_por_sesion(st.session_state.trabajo_id)
+            if por_sesion:
+                st.caption("Sesiones de la secuencia actual")
+                st.dataframe([{k: v for k, v in s.items() if k != "secuencia"} for s in por_sesion],
+                             hide_index=True, width="stretch")
+
+    with st.sidebar:
+        # Mientras hay un trabajo en curso el panel se refresca solo, sin rerun de toda la página.
+        st.fragment(run_every=2.0 if st.session_state.trabajo_id else None)(panel_metricas)()
+
+    reintentos = PoliticaReintentos(
+        max_intentos=int(os.environ.get("LLM_MAX_INTENTOS", "4")),
+        plazo_llamada=float(os.environ.get("LLM_PLAZO_LLAMADA_S", "180")),
+    )
+    cobertura = {"gemini-2.5-pro": ("gemini-2.5-flash", st.session_state.presupuesto_cobertura)} if st.session_state.cobertura else None
+    llm = ClienteLLM(backend, cache=cache_respuestas, limitador_para=obtener_limitador, metricas=metricas,
+                     reintentos=reintentos, cobertura=cobertura)
+    gestor_trabajos = obtener_gestor_trabajos()
+
+    # --- REENGANCHE A UN TRABAJO EN CURSO (p. ej. tras recargar el navegador) ---
+    trabajo_en_url = st.query_params.get("trabajo")
+    if trabajo_en_url and not st.session_state.trabajo_id:
+        trabajo = gestor_trabajos.obtener(trabajo_en_url)
+        if trabajo is not None:
+            st.session_state.trabajo_id = trabajo.id
+            params = trabajo.lista_params[0]
+            st.session_state.plan_id = params.get("plan_id") or almacen.guardar(params["plan_secuencia"])
+            st.session_state.num_actividades = len(trabajo.lista_params)
+            st.session_state.stage = "generation"
+        else:
+            del st.query_params["trabajo"]
+    
+    # --- FUNCIONES DE UTILIDAD Y LÓGICA DE LA APP ---
 
     def set_stage(stage_name):
         st.session_state.stage = stage_name
 
-    # --- NUEVA FUNCIÓN "CEREBRO" PARA PLANIFICAR LA SECUENCIA ---
-    def planificar_secuencia(inspiration_text, num_actividades, nivel_salida_final, model_name):
-        st.info(f"Diseñando un plan de vuelo para {num_actividades} sesiones...")
-        prompt_planificacion = f"""
-        Eres un experto en diseño curricular. Basado en la siguiente inspiración y requisitos, crea un plan de secuencia de aprendizaje.
-
-        **Inspiración Inicial:** {inspiration_text}
-        **Número de Sesiones:** {num_actividades}
-        **Nivel Cognitivo Final Deseado (Bloom):** {nivel_salida_final}
+    def params_de_secuencia(plan_secuencia, nivel_entrada, grupo="Grupo General"):
+        return construir_params_sesiones(
+            plan_secuencia,
+            st.session_state.num_actividades,
+            nivel_entrada,
+            grupo,
+            st.session_state.gen_model_name,
+            st.session_state.audit_model_name,
+            streaming=st.session_state.streaming,
+            usar_cache=st.session_state.usar_cache,
+            auditoria_estructurada=st.session_state.auditoria_estructurada,
+            validacion_local=st.session_state.validacion_local,
+            refinamiento_por_secciones=st.session_state.refinamiento_por_secciones
+        )
 
-        **Tu Tarea:**
-        1.  **Define un Hilo Conductor Narrativo:** Crea una historia o misión global que conecte todas las sesiones.
-        2.  **Secuencia los Objetivos Cognitivos:** Distribuye los niveles de la Taxonomía de Bloom a lo largo de las {num_actividades} sesiones. Empieza con niveles bajos (Recordar, Comprender) y progresa hacia el nivel final ({nivel_salida_final}). Sé explícito sobre qué nivel de Bloom es el foco principal de cada sesión.
-        3.  **Desglosa los Contenidos:** Para cada sesión, define brevemente el sub-tema o concepto específico que se abordará.
+    # --- PREGENERACIÓN ESPECULATIVA ---
+    def descartar_especulacion():
+        if st.session_state.especulacion:
+            gestor_trabajos.cancelar(st.session_state.especulacion["trabajo_id"])
+            st.session_state.especulacion = None
 
-        **Formato de Salida (Usa Markdown):**
-        
-        ### Plan de Secuencia de Aprendizaje
-        
-        **Hilo Conductor Narrativo:** [Describe la historia o misión global aquí.]
-        
-        ---
-        
-        **Sesión 1: [Título de la Sesión 1]**
-        - **Concepto Clave:** [Describe el concepto de esta sesión.]
-        - **Objetivo Cognitivo (Bloom):** COMPRENDER
-        
-        **Sesión 2: [Título de la Sesión 2]**
-        - **Concepto Clave:** [Describe el concepto de esta sesión.]
-        - **Objetivo Cognitivo (Bloom):** APLICAR
-        
-        ... (continúa para todas las sesiones hasta la {num_actividades})
-        """
-        plan = generar_texto_con_vertex(model_name, prompt_planificacion)
-        return plan
-
-    # --- FUNCIÓN DE AUDITORÍA (sin cambios en su lógica interna) ---
-    def auditar_actividad(actividad_generada, nivel_salida_esperado, contexto_narrativo, audit_model_name):
-        master_prompt_ref = get_master_prompt_system(contexto_narrativo)
-        auditoria_prompt = f"""
-        Eres un auditor experto en diseño instruccional. Audita RIGUROSAMENTE la siguiente actividad individual.
-        --- MODELO PEDAGÓGICO DE REFERENCIA ---
-        {master_prompt_ref}
-        --- OBJETIVO COGNITIVO PARA ESTA SESIÓN ---
-        El nivel de salida esperado es **{nivel_salida_esperado}**.
-        --- ACTIVIDAD A AUDITAR ---
-        {actividad_generada}
-        ---
-        **VALIDACIÓN DE CRITERIOS (Responde con ✅/❌ y un comentario breve si es ❌):**
-        1.  **Contexto Narrativo (Capa 0):** ¿La actividad está completamente inmersa en la historia y usa su lenguaje?
-        2.  **Hilo Conductor (Capa 3):** ¿El producto de cada fase se usa explícitamente como insumo de la siguiente?
-        3.  **Intención Cognitiva (Capa 5):** ¿La actividad culmina exitosamente en el nivel de **{nivel_salida_esperado}** en la fase simbólica?
-        **DICTAMEN FINAL:** [✅ CUMPLE / ❌ RECHAZADO]
-        **OBSERVACIONES FINALES:** [Si es ❌, sé específico en qué capa del modelo falló.]
-        """
-        return generar_texto_con_vertex(audit_model_name, auditoria_prompt)
-
-    # --- FUNCIÓN DE GENERACIÓN (PROMPT ACTUALIZADO) ---
-    def generar_actividad_con_auditoria(params):
-        # El contexto narrativo ahora es el plan de secuencia completo
-        master_prompt = get_master_prompt_system(params["plan_secuencia"]) 
-        current_activity_text = ""
-        audit_observations = ""
-        max_attempts = 3
-        attempt = 0
-
-        gen_model = params["gen_model"]
-        audit_model = params["audit_model"]
-
-        while attempt < max_attempts:
-            attempt += 1
-            st.info(f"--- Generando/Refinando Sesión {params['session_num']} (Intento {attempt}/{max_attempts}) ---")
-            
-            # PROMPT ACTUALIZADO PARA GENERAR DOBLE GUÍA
-            prompt_generacion = f"""
-            Eres un diseñador instruccional de élite. Tu tarea es generar UNA ÚNICA actividad detallada que forma parte de una secuencia mayor.
-
-            ---
-            **PLAN DE SECUENCIA GLOBAL (CONTEXTO GENERAL):**
-            {params["plan_secuencia"]}
-            ---
-            **TAREA ESPECÍFICA: Generar la Sesión número {params["session_num"]}**
-            ---
-            - **Grupo:** {params["grupo"]}
-            - **Nivel de Entrada para esta sesión:** {params["nivel_entrada"]}
-            - **Modelo Pedagógico Base:** {master_prompt}
-            ---
-
-            **FORMATO ESTRICTO DE SALIDA (Genera AMBOS documentos usando Markdown):**
-
-            ---
-            ### GUÍA RÁPIDA (PARA EL AULA / FICHA)
-            - **Sesión:** {params["session_num"]}
-            - **Título:** [Título Atractivo]
-            - **Propósito (1-2 líneas):** [Resumen muy breve del objetivo de la sesión.]
-            - **Materiales Esenciales:** [Lista simple.]
-            - **Momentos Clave (Tiempos Aprox.):**
-                - **Momento Enactivo (Hacer):** [Descripción breve de la actividad principal.] (20 min)
-                - **Momento Icónico (Representar):** [Descripción breve de cómo se visualizará.] (20 min)
-                - **Momento Simbólico (Abstraer):** [Descripción breve de la formalización.] (15 min)
-                - **Cierre (Reflexionar):** [Descripción breve.] (5 min)
-            ---
-            ### GUÍA PARA EL DOCENTE (ACOMPAÑAMIENTO)
-
-            **1. Descripción Detallada:**
-               - **Propósito Pedagógico:** [Explicación detallada del porqué de esta actividad.]
-               - **Pasos por Fase:**
-                 - **Enactiva:** [Instrucciones detalladas, preguntas del facilitador, variantes piso-medio-techo.]
-                 - **Icónica:** [Instrucciones detalladas, preguntas, variantes.]
-                 - **Simbólica:** [Instrucciones detalladas, preguntas, variantes.]
-               - **Cierre:** [Instrucciones para guiar la síntesis, metacognición y próximos pasos.]
-
-            **2. Evaluación Formativa:**
-               - **Evidencias a Observar:** [Qué deben producir o decir los estudiantes en cada fase como prueba de comprensión.]
-               - **Logros (Criterios de Desempeño):** [Cómo saber si el grupo alcanzó el objetivo cognitivo de la sesión.]
-               - **Errores Típicos y Microintervenciones:** [Lista de 2-3 errores comunes y cómo el docente puede intervenir sutilmente.]
-
-            **3. Cohesión y Metacognición:**
-               - **Bitácora de Secuencia:** [Cómo esta actividad conecta con la sesión ANTERIOR y prepara la SIGUIENTE.]
-               - **Prompts de Metacognición:** [2-3 preguntas específicas para que los estudiantes reflexionen sobre su proceso de aprendizaje al final.]
-
-            **4. Herramientas de Evaluación:**
-               - **Rúbrica Analítica Simple:** [Tabla con 2-3 criterios y descriptores observables para las fases clave (ej. Enactiva y Simbólica).]
-            """
-
-            if attempt > 1:
-                prompt_generacion += f"\n--- RETROALIMENTACIÓN PARA REFINAMIENTO ---\nLa versión anterior fue rechazada. Observaciones del auditor: {audit_observations}\nPor favor, genera una nueva versión que corrija estos puntos.\n"
-
-            current_activity_text = generar_texto_con_vertex(gen_model, prompt_generacion)
-            if not current_activity_text:
-                st.error("Fallo en la generación de texto.")
-                break
+    def especular(plan_secuencia):
+        # Idempotente en cada rerun: solo lanza un trabajo nuevo si el plan o la configuración cambiaron.
+        lista_params = params_de_secuencia(plan_secuencia, NIVEL_ENTRADA_POR_DEFECTO)
+        huella = huella_params(lista_params)
+        if st.session_state.especulacion and st.session_state.especulacion["huella"] == huella:
+            return
+        descartar_especulacion()
+        usuario = identificar_usuario()
+        tope_usd, ventana_segundos = tope_especulativo_configurado()
+        gastado = gestor_trabajos.gasto_especulativo(usuario, time.time() - ventana_segundos)
+        if gastado >= tope_usd:
+            st.caption(f"Pregeneración desactivada: ya se alcanzó el gasto máximo ({gastado:.2f} USD).")
+            return
+        presupuesto = crear_presupuesto_especulativo(gestor_trabajos, usuario, tope_usd, ventana_segundos)
+        trabajo_id = gestor_trabajos.enviar(llm, lista_params, st.session_state.max_concurrencia, presupuesto=presupuesto, usuario=usuario)
+        st.session_state.especulacion = {"trabajo_id": trabajo_id, "huella": huella}
 
-            with st.expander(f"Ver Actividad Generada - Sesión {params['session_num']} (Intento {attempt})", expanded=False):
-                st.markdown(current_activity_text)
-            
-            # La auditoría ahora usa el plan como contexto narrativo
-            auditoria_resultado = auditar_actividad(current_activity_text, params["nivel_salida"], params["plan_secuencia"], audit_model)
-            if not auditoria_resultado:
-                st.error("Fallo en la auditoría.")
-                break
+    def adoptar_especulacion(lista_params):
+        # Devuelve el trabajo pregenerado si se hizo con exactamente estos parámetros; si no, lo cancela.
+        especulacion, st.session_state.especulacion = st.session_state.especulacion, None
+        if not especulacion:
+            return None
+        if especulacion["huella"] != huella_params(lista_params):
+            gestor_trabajos.cancelar(especulacion["trabajo_id"])
+            return None
+        # Desde aquí es un trabajo normal: sus sesiones dejan de contar para el tope de la pregeneración.
+        return gestor_trabajos.adoptar(llm, especulacion["trabajo_id"])
 
-            with st.expander(f"Ver Resultado de Auditoría - Sesión {params['session_num']} (Intento {attempt})", expanded=True):
-                st.markdown(auditoria_resultado)
+    # --- SEGUIMIENTO DEL TRABAJO EN SEGUNDO PLANO ---
+    # Se refresca cada segundo sin rerun completo de la app. El trabajo sigue corriendo
+    # aunque el usuario recargue la página o se caiga la conexión.
+    @st.fragment(run_every=1.0)
+    def monitorear_trabajo(trabajo_id):
+        trabajo = gestor_trabajos.obtener(trabajo_id)
+        if trabajo is None:
+            st.error(f"No se encontró el trabajo {trabajo_id}.")
+            st.session_state.trabajo_id = None
+            return
+        vista = trabajo.instantanea()
+        total = len(vista["lista_params"])
+        completadas = sum(1 for resultado in vista["resultados"] if resultado is not None)
+        st.caption(f"Trabajo `{trabajo_id}` — puedes recargar la página o volver más tarde: la generación continúa en el servidor.")
+        st.progress(completadas / total, text=f"{completadas}/{total} sesiones completadas")
 
-            if "✅ CUMPLE" in auditoria_resultado:
-                st.success(f"¡Sesión {params['session_num']} generada y aprobada en el intento {attempt}!")
-                # Extraemos el título para mostrarlo en el expander final
-                title_search = re.search(r"\*\*Título:\s*(.*)", current_activity_text)
-                title = title_search.group(1) if title_search else f"Sesión {params['session_num']}"
-                return {"activity_text": current_activity_text, "status": "✅ CUMPLE", "title": title}
+        for indice, params in enumerate(vista["lista_params"]):
+            resultado = vista["resultados"][indice]
+            if resultado is not None:
+                etiqueta = f"Sesión {params['session_num']}: {resultado['title']} ({resultado['status']})"
+                estado = "complete" if resultado["status"] == "✅ CUMPLE" else "error"
+            elif indice in vista["en_curso"]:
+                etiqueta, estado = f"Sesión {params['session_num']}: generando...", "running"
             else:
-                observaciones_start = auditoria_resultado.find("OBSERVACIONES FINALES:")
-                audit_observations = auditoria_resultado[observaciones_start:] if observaciones_start != -1 else "No se pudo extraer observaciones."
-                st.warning(f"La Sesión {params['session_num']} necesita refinamiento...")
-        
-        st.error(f"No se pudo generar una actividad aprobada para la Sesión {params['session_num']} después de {max_attempts} intentos.")
-        return {"activity_text": current_activity_text, "status": "❌ RECHAZADO", "title": f"Sesión {params['session_num']} (Fallida)"}
-
-    # --- FUNCIÓN DE EXPORTACIÓN A WORD (ACTUALIZADA PARA SECUENCIAS) ---
-    def exportar_secuencia_a_word(sequence_data):
-        doc = docx.Document()
-        doc.add_heading('Secuencia de Aprendizaje Generada con IA', level=1)
-        
-        # Opcional: Añadir el plan de secuencia al inicio del documento
-        if st.session_state.sequence_plan:
-            doc.add_heading('Plan de Vuelo de la Secuencia', level=2)
-            doc.add_paragraph(st.session_state.sequence_plan)
-            doc.add_page_break()
+                etiqueta, estado = f"Sesión {params['session_num']}: en cola...", "running"
+            with st.status(etiqueta, state=estado, expanded=False):
+                notificar = crear_notificador_en_pantalla()
+                for tipo, texto, titulo, expandido in vista["registro"][indice]:
+                    notificar(tipo, texto, titulo, expandido)
 
-        for i, activity_data in enumerate(sequence_data):
-            doc.add_heading(f"Actividad de la Sesión {i+1}", level=2)
-            
-            activity_text = activity_data.get("activity_text", "")
-            
-            # Lógica para separar las guías (simple split)
-            parts = re.split(r'---+\s*### GUÍA PARA EL DOCENTE', activity_text, flags=re.IGNORECASE)
-            guia_rapida_text = parts[0].replace("### GUÍA RÁPIDA (PARA EL AULA / FICHA)", "").strip()
-            guia_docente_text = ""
-            if len(parts) > 1:
-                guia_docente_text = parts[1].strip()
-
-            doc.add_heading('Guía Rápida (Ficha de Aula)', level=3)
-            doc.add_paragraph(guia_rapida_text)
-            
-            doc.add_heading('Guía para el Docente (Acompañamiento)', level=3)
-            doc.add_paragraph(guia_docente_text)
-            
-            if i < len(sequence_data) - 1:
-                doc.add_page_break()
-        
-        buffer = io.BytesIO()
-        doc.save(buffer)
-        buffer.seek(0)
-        return buffer
+        if vista["estado"] in ESTADOS_TERMINALES:
+            st.session_state.processed_sequence = [
+                resultado or {"status": "❌ RECHAZADO", "title": f"Sesión {params['session_num']} (Interrumpida)"}
+                for resultado, params in zip(vista["resultados"], vista["lista_params"])
+            ]
+            set_stage("display_sequence")
+            st.rerun()
 
     # --- INTERFAZ DE USUARIO POR ETAPAS ---
 
@@ -337,8 +2967,7 @@ Usa los siguientes verbos y definiciones con precisión.
         
         def handle_inspiration_submit(inspiration_text):
             if inspiration_text:
-                st.session_state.inspiration_text = inspiration_text
-                st.session_state.num_actividades = st.session_state.get('num_act_input', 1)
+                st.session_state.inspiracion_id = almacen.guardar(inspiration_text)
                 set_stage("planning")
                 st.rerun()
             else:
@@ -362,7 +2991,28 @@ Usa los siguientes verbos y definiciones con precisión.
             if st.button("Usar este Archivo y Continuar", key="file_btn"):
                 if uploaded_file:
                     st.session_state.num_actividades = num_act_input_3
-                    handle_inspiration_submit(leer_docx(uploaded_file))
+                    # Los documentos grandes se resumen (map-reduce) en una inspiración de tamaño acotado.
+                    try:
+                        with st.spinner("Procesando el documento..."):
+                            inspiracion = preparar_inspiracion_desde_docx(
+                                llm, uploaded_file, st.session_state.gen_model_name, cache=cache_respuestas,
+                                usar_cache=st.session_state.usar_cache
+                            )
+                    except Exception as e:
+                        st.error(f"Error al leer el archivo Word: {e}")
+                    else:
+                        if inspiracion["desde_cache"]:
+                            st.session_state.nota_inspiracion = "Resumen del documento recuperado de la caché (ya se había procesado)."
+                        elif inspiracion["resumido"]:
+                            st.session_state.nota_inspiracion = (
+                                f"Documento de {inspiracion['caracteres_originales']:,} caracteres resumido en "
+                                f"{len(inspiracion['texto']):,} para la planificación."
+                            )
+                        else:
+                            st.session_state.nota_inspiracion = None
+                        if inspiracion["truncado"]:
+                            st.session_state.nota_inspiracion = (st.session_state.nota_inspiracion or "") + " El documento superaba el límite de texto y se truncó."
+                        handle_inspiration_submit(inspiracion["texto"])
 
 
     elif st.session_state.stage == "planning":
@@ -370,27 +3020,45 @@ Usa los siguientes verbos y definiciones con precisión.
         st.markdown("Define los parámetros generales y deja que la IA diseñe una ruta de aprendizaje para la secuencia completa.")
 
         st.info("**Inspiración proporcionada:**")
-        st.text_area("", value=st.session_state.inspiration_text, height=100, disabled=True)
+        inspiracion = almacen.obtener(st.session_state.inspiracion_id)
+        st.text_area("", value=inspiracion or "", height=100, disabled=True)
+        if st.session_state.nota_inspiracion:
+            st.caption(st.session_state.nota_inspiracion)
         
         nivel_salida_final = st.selectbox("Máxima habilidad de Bloom a alcanzar AL FINAL de la secuencia", options=list(bloom_taxonomy_detallada.keys()), index=len(bloom_taxonomy_detallada) - 1)
 
         if st.button("🗺️ Generar Plan de Secuencia", type="primary"):
-            with st.spinner("Creando el plan maestro..."):
-                st.session_state.sequence_plan = planificar_secuencia(
-                    st.session_state.inspiration_text, 
+            # El plan se va escribiendo en un marcador temporal que se limpia al terminar,
+            # porque justo debajo se muestra el plan definitivo.
+            marcador_plan = st.empty()
+            with marcador_plan.container(), st.spinner("Creando el plan maestro..."):
+                plan = planificar_secuencia(
+                    llm,
+                    inspiracion or "",
                     st.session_state.num_actividades,
                     nivel_salida_final,
-                    st.session_state.gen_model_name
+                    st.session_state.gen_model_name,
+                    streaming=st.session_state.streaming,
+                    usar_cache=st.session_state.usar_cache
                 )
-        
-        if st.session_state.sequence_plan:
+            marcador_plan.empty()
+            st.session_state.plan_id = almacen.guardar(plan) if plan else None
+
+        plan_secuencia = almacen.obtener(st.session_state.plan_id)
+        if plan_secuencia:
             st.subheader("Plan de Secuencia Propuesto")
-            st.markdown(st.session_state.sequence_plan)
+            st.markdown(plan_secuencia)
+            # Mientras el docente lee el plan, las sesiones se van generando con el nivel de entrada por defecto.
+            if st.session_state.especulativa:
+                especular(plan_secuencia)
+            else:
+                descartar_especulacion()
             if st.button("✅ Me parece bien, ¡a generar las actividades!"):
                 set_stage("generation")
                 st.rerun()
 
         if st.button("Volver a Inspiración"):
+            descartar_especulacion()
             set_stage("inspiration")
             st.rerun()
 
@@ -398,81 +3066,117 @@ Usa los siguientes verbos y definiciones con precisión.
     elif st.session_state.stage in ["generation", "display_sequence"]:
         st.header("ETAPA 3: Generación de la Secuencia 📚")
         
+        plan_secuencia = almacen.obtener(st.session_state.plan_id)
         with st.expander("Ver Plan de Secuencia Final", expanded=False):
-            st.markdown(st.session_state.sequence_plan)
+            st.markdown(plan_secuencia or "⚠️ El plan ya no está disponible en el almacén (caducó).")
         
         st.subheader("Parámetros Pedagógicos")
         
         # Valores temporales para que el código siga funcionando
         subcategoria_seleccionada = "Grupo General" 
-        nivel_entrada_usuario = st.text_input("Nivel de entrada para la PRIMERA sesión", placeholder="Ej: Los estudiantes pueden describir un objeto simple.")
+        # Con la pregeneración activa se propone el nivel por defecto, que es con el que ya se están generando las sesiones.
+        # Se siembra una sola vez: con una clave fija, lo que escriba el docente no se pierde cuando la especulación cambia.
+        if "nivel_entrada" not in st.session_state:
+            st.session_state.nivel_entrada = NIVEL_ENTRADA_POR_DEFECTO if st.session_state.especulacion else ""
+        nivel_entrada_usuario = st.text_input(
+            "Nivel de entrada para la PRIMERA sesión",
+            key="nivel_entrada",
+            placeholder=f"Ej: {NIVEL_ENTRADA_POR_DEFECTO}"
+        )
+        if st.session_state.especulacion and not st.session_state.trabajo_id:
+            vista = gestor_trabajos.obtener(st.session_state.especulacion["trabajo_id"]).instantanea()
+            listas = sum(1 for resultado in vista["resultados"] if resultado is not None)
+            st.caption(f"⚡ {listas}/{len(vista['resultados'])} sesiones ya pregeneradas con este nivel de entrada; "
+                       "si lo cambias, se descartarán.")
 
        
-        if st.button("🚀 Generar SECUENCIA COMPLETA con Auditoría", type="primary"):
-            if not all([st.session_state.sequence_plan, nivel_entrada_usuario]):
+        trabajo_activo = st.session_state.stage == "generation" and st.session_state.trabajo_id
+        if st.button("🚀 Generar SECUENCIA COMPLETA con Auditoría", type="primary", disabled=bool(trabajo_activo)):
+            if not all([plan_secuencia, nivel_entrada_usuario]):
                 st.error("Por favor, asegúrate de tener un plan de secuencia y de definir el nivel de entrada.")
             else:
-                with st.spinner(f"Generando y auditando las {st.session_state.num_actividades} actividades... Esto puede tardar."):
-                    lista_actividades = []
-                    
-                    # Extraer los niveles de Bloom del plan
-                    bloom_levels_per_session = re.findall(r"\*\*Objetivo Cognitivo \(Bloom\):\s*(\w+)", st.session_state.sequence_plan)
-
-                    for i in range(1, st.session_state.num_actividades + 1):
-                        params = {
-                            "plan_secuencia": st.session_state.sequence_plan,
-                            "session_num": i,
-                            "grupo": subcategoria_seleccionada,
-                            "nivel_entrada": nivel_entrada_usuario, # Se puede hacer más dinámico en el futuro
-                            "nivel_salida": bloom_levels_per_session[i-1] if i-1 < len(bloom_levels_per_session) else "CREAR",
-                            "gen_model": st.session_state.gen_model_name,
-                            "audit_model": st.session_state.audit_model_name
-                        }
-                        actividad_generada = generar_actividad_con_auditoria(params)
-                        lista_actividades.append(actividad_generada)
-                
-                st.session_state.processed_sequence = lista_actividades
-                set_stage("display_sequence")
+                lista_params = params_de_secuencia(plan_secuencia, nivel_entrada_usuario, subcategoria_seleccionada)
+                # La generación se encola como trabajo (o se adopta el pregenerado si coincide); el ID queda
+                # en la sesión y en la URL para poder reengancharse a él tras un rerun o una recarga del navegador.
+                st.session_state.trabajo_id = (
+                    adoptar_especulacion(lista_params)
+                    or gestor_trabajos.enviar(llm, lista_params, st.session_state.max_concurrencia)
+                )
+                st.query_params["trabajo"] = st.session_state.trabajo_id
+                set_stage("generation")
                 st.rerun()
 
+        if trabajo_activo:
+            monitorear_trabajo(st.session_state.trabajo_id)
+
         if st.session_state.stage == "display_sequence" and st.session_state.processed_sequence:
             st.markdown("---")
             st.header("ETAPA 4: Secuencia de Aprendizaje Generada 🗺️")
             st.success("¡La secuencia completa ha sido generada!")
 
+            def reanudar_trabajo(indices=None):
+                # Cada sesión quedó guardada al terminar: solo se vuelven a generar las indicadas.
+                nuevo_id = gestor_trabajos.reanudar(llm, st.session_state.trabajo_id, indices, st.session_state.max_concurrencia)
+                if nuevo_id:
+                    st.session_state.trabajo_id = nuevo_id
+                    st.query_params["trabajo"] = nuevo_id
+                    set_stage("generation")
+                    st.rerun()
+
+            pendientes = [i for i, a in enumerate(st.session_state.processed_sequence) if a.get("status") != "✅ CUMPLE"]
+            if pendientes and st.session_state.trabajo_id:
+                st.warning(f"{len(pendientes)} sesión(es) sin aprobar o sin terminar.")
+                if st.button("▶️ Reanudar: generar solo las sesiones pendientes o fallidas", key="reanudar_btn"):
+                    reanudar_trabajo()
+
             for i, actividad_data in enumerate(st.session_state.processed_sequence):
-                with st.expander(f"**Sesión {i+1}: {actividad_data.get('title', 'Sin Título')}** ({actividad_data.get('status', '❓')})"):
-                    
-                    texto_completo = actividad_data["activity_text"]
-                    # Lógica para separar las guías
-                    parts = re.split(r'---+\s*### GUÍA PARA EL DOCENTE', texto_completo, flags=re.IGNORECASE)
-                    guia_rapida = parts[0].replace("### GUÍA RÁPIDA (PARA EL AULA / FICHA)", "").strip()
-                    guia_docente = ""
-                    if len(parts) > 1:
-                        guia_docente = parts[1].strip()
-                    else:
-                        guia_rapida = texto_completo # Fallback si no encuentra el separador
+                # Solo la sesión desplegada se carga del almacén; el resto de la página no toca los textos.
+                expander = st.expander(
+                    f"**Sesión {i+1}: {actividad_data.get('title', 'Sin Título')}** ({actividad_data.get('status', '❓')})",
+                    key=f"sesion_{i}", on_change="rerun"
+                )
+                if not expander.open:
+                    continue
+                with expander:
+                    if st.session_state.trabajo_id and st.button("🔄 Regenerar esta sesión", key=f"regenerar_sesion_{i}"):
+                        reanudar_trabajo([i])
+
+                    actividad = almacen.cargar_actividad(actividad_data)
+                    if actividad.get("caducada"):
+                        st.warning("El texto de esta sesión ya no está en el almacén (caducó). Regenérala para recuperarlo.")
+                        continue
+                    # Resultados guardados antes de existir la estructura: se calcula al vuelo.
+                    estructura = actividad.get("estructura") or estructurar_actividad(actividad.get("activity_text"))
 
                     tab1, tab2 = st.tabs(["Guía Rápida (Aula)", "Guía Docente (Acompañamiento)"])
                     with tab1:
-                        st.markdown(guia_rapida)
+                        st.markdown(estructura["guia_rapida"])
                     with tab2:
-                        st.markdown(guia_docente)
+                        st.markdown(estructura["guia_docente"])
 
             st.markdown("---")
             st.subheader("✅ Exportar Secuencia Completa")
-            word_buffer = exportar_secuencia_a_word(st.session_state.processed_sequence)
+            # El .docx se construye solo al pulsar el botón, cargando del almacén el plan y las actividades,
+            # y queda memorizado por huella del contenido.
+            cache_documentos = obtener_cache_documentos()
+            plan_id = st.session_state.plan_id
+            secuencia_exportada = list(st.session_state.processed_sequence)
             st.download_button(
                 label="Descargar Secuencia Completa en Word",
-                data=word_buffer,
+                data=lambda: cache_documentos.docx_de_secuencia(
+                    almacen.obtener(plan_id) or "", [almacen.cargar_actividad(a) for a in secuencia_exportada]
+                ),
                 file_name=f"secuencia_{subcategoria_seleccionada.replace(' ', '_')}.docx",
                 mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
             )
 
         if st.session_state.stage in ["planning", "generation", "display_sequence"]:
             if st.button("Reiniciar y Empezar de Nuevo"):
+                descartar_especulacion()
+                # El gasto en pregeneración está en SQLite, por usuario: reiniciar no lo pone a cero.
                 for key in list(st.session_state.keys()):
                     del st.session_state[key]
+                st.query_params.clear()
                 st.rerun()
 
 # --- Punto de Entrada del Script ---
@@ -0,0 +1,167 @@
+"""Benchmark de latencia extremo a extremo: planificación -> generación -> auditoría.
+
+Recorre el mismo pipeline que la app (planificar_secuencia y generar_actividad_con_auditoria)
+sin interfaz y contra el BackendSimulado, así que no necesita un proyecto de GCP.
+Para cada número de usuarios concurrentes informa el p50/p95 de la latencia por secuencia,
+las llamadas al modelo por secuencia y el rendimiento (secuencias por minuto).
+
+Ejemplo:
+
+    python benchmark.py --usuarios 1 4 16 --secuencias 3 --sesiones 5 --max-p95 12
+
+Debajo de cada fila se desglosa la latencia, los tokens y el coste estimado por etapa.
+Con --max-p95 el script termina con código 1 si alguna configuración lo supera, para
+detectar regresiones de rendimiento en CI.
+"""
+import argparse
+import json
+import math
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import app
+
+
+def percentil(valores, p):
+    # Percentil por rango más cercano: sin interpolación, estable con pocas muestras.
+    ordenados = sorted(valores)
+    if not ordenados:
+        return 0.0
+    rango = max(1, math.ceil(p / 100 * len(ordenados)))
+    return ordenados[rango - 1]
+
+
+def ejecutar_secuencia(llm, args, etiqueta):
+    inicio = time.perf_counter()
+    plan = app.planificar_secuencia(
+        llm, f"El tema central es: {etiqueta}.", args.sesiones, args.nivel_final,
+        args.modelo_generacion, usar_cache=False, notificar=app.notificar_nada
+    )
+    if not plan:
+        return {"latencia": time.perf_counter() - inicio, "aprobadas": 0, "fallidas": args.sesiones}
+
+    lista_params = app.construir_params_sesiones(
+        plan, args.sesiones, app.NIVEL_ENTRADA_POR_DEFECTO, "Grupo General",
+        args.modelo_generacion, args.modelo_auditoria, usar_cache=False,
+        refinamiento_por_secciones=not args.sin_refinamiento_por_secciones
+    )
+    with ThreadPoolExecutor(max_workers=args.concurrencia_sesiones) as executor:
+        resultados = list(executor.map(
+            lambda params: app.generar_actividad_con_auditoria(llm, params, app.notificar_nada), lista_params
+        ))
+    aprobadas = sum(1 for resultado in resultados if resultado["status"] == "✅ CUMPLE")
+    return {"latencia": time.perf_counter() - inicio, "aprobadas": aprobadas, "fallidas": len(resultados) - aprobadas}
+
+
+def ejecutar_carga(args, usuarios):
+    backend = app.BackendSimulado(
+        latencias={
+            "plan": app.latencia_lognormal(args.latencia_plan, args.sigma),
+            "actividad": app.latencia_lognormal(args.latencia_actividad, args.sigma),
+            "auditoria": app.latencia_lognormal(args.latencia_auditoria, args.sigma),
+            "refinamiento": app.latencia_lognormal(args.latencia_refinamiento, args.sigma),
+        },
+        tasa_aprobacion=args.tasa_aprobacion,
+        tasa_429=args.tasa_429,
+        tasa_fallos=args.tasa_fallos,
+        tasa_actividad_incompleta=args.tasa_actividad_incompleta,
+        semilla=args.semilla,
+    )
+    # Sin caché de respuestas ni límite de tasa: se mide el pipeline, no la caché.
+    metricas = app.MetricasLLM()
+    reintentos = app.PoliticaReintentos(
+        max_intentos=args.max_intentos, espera_base=args.espera_base, espera_maxima=args.espera_base * 30,
+        plazo_llamada=args.plazo_llamada, plazo_total=args.plazo_llamada * args.max_intentos
+    )
+    cobertura = {args.modelo_auditoria: (args.modelo_generacion, args.cobertura)} if args.cobertura else None
+    llm = app.ClienteLLM(backend, metricas=metricas, reintentos=reintentos, cobertura=cobertura)
+
+    def usuario(n):
+        return [ejecutar_secuencia(llm, args, f"usuario {n}, secuencia {i}") for i in range(args.secuencias)]
+
+    validacion = app.obtener_estadisticas_validacion()
+    rechazos_previos = validacion.rechazadas
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=usuarios) as executor:
+        secuencias = [s for resultado in executor.map(usuario, range(usuarios)) for s in resultado]
+    duracion = time.perf_counter() - inicio
+
+    latencias = [s["latencia"] for s in secuencias]
+    sesiones = len(secuencias) * args.sesiones
+    return {
+        "usuarios": usuarios,
+        "secuencias": len(secuencias),
+        "p50_s": round(percentil(latencias, 50), 3),
+        "p95_s": round(percentil(latencias, 95), 3),
+        "llamadas_por_secuencia": round(backend.llamadas / len(secuencias), 2),
+        "llamadas_por_tipo": dict(backend.llamadas_por_tipo),
+        "secuencias_por_minuto": round(len(secuencias) / duracion * 60, 2),
+        "auditorias_evitadas_por_validacion": validacion.rechazadas - rechazos_previos,
+        "sesiones_fallidas_pct": round(100 * sum(s["fallidas"] for s in secuencias) / sesiones, 1),
+        "duracion_s": round(duracion, 2),
+        "reintentos": sum(etapa["reintentos"] for etapa in metricas.resumen_por_etapa()),
+        "coberturas": sum(etapa["coberturas"] for etapa in metricas.resumen_por_etapa()),
+        "por_etapa": metricas.resumen_por_etapa(),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--usuarios", type=int, nargs="+", default=[1, 4, 16], help="Usuarios concurrentes a probar.")
+    parser.add_argument("--secuencias", type=int, default=2, help="Secuencias que genera cada usuario.")
+    parser.add_argument("--sesiones", type=int, default=5, help="Sesiones por secuencia.")
+    parser.add_argument("--concurrencia-sesiones", type=int, default=4, help="Sesiones en paralelo dentro de una secuencia.")
+    parser.add_argument("--nivel-final", default="CREAR", choices=list(app.bloom_taxonomy_detallada))
+    parser.add_argument("--modelo-generacion", default="gemini-2.5-flash")
+    parser.add_argument("--modelo-auditoria", default="gemini-2.5-pro")
+    parser.add_argument("--latencia-plan", type=float, default=0.2, help="Mediana en segundos.")
+    parser.add_argument("--latencia-actividad", type=float, default=0.3, help="Mediana en segundos.")
+    parser.add_argument("--latencia-auditoria", type=float, default=0.2, help="Mediana en segundos.")
+    parser.add_argument("--latencia-refinamiento", type=float, default=0.1, help="Mediana en segundos.")
+    parser.add_argument("--sigma", type=float, default=0.5, help="Dispersión de la distribución log-normal.")
+    parser.add_argument("--tasa-aprobacion", type=float, default=0.7)
+    parser.add_argument("--tasa-429", type=float, default=0.0)
+    parser.add_argument("--tasa-fallos", type=float, default=0.0)
+    parser.add_argument("--tasa-actividad-incompleta", type=float, default=0.0, help="Actividades sin Guía para el Docente.")
+    parser.add_argument("--sin-refinamiento-por-secciones", action="store_true",
+                        help="Regenera la actividad entera tras un rechazo, como antes del refinamiento por secciones.")
+    parser.add_argument("--max-intentos", type=int, default=4, help="Intentos por llamada al modelo (1 = sin reintentos).")
+    parser.add_argument("--espera-base", type=float, default=0.05,
+                        help="Base del backoff en segundos (escalada a las latencias simuladas).")
+    parser.add_argument("--plazo-llamada", type=float, default=10.0, help="Plazo de cada intento en segundos.")
+    parser.add_argument("--cobertura", type=float, default=None,
+                        help="Presupuesto en segundos tras el que la auditoría se cubre con el modelo de generación.")
+    parser.add_argument("--semilla", type=int, default=0)
+    parser.add_argument("--max-p95", type=float, default=None, help="Falla (código 1) si algún p95 lo supera.")
+    parser.add_argument("--json", dest="salida_json", default=None, help="Guarda los resultados en este archivo.")
+    parser.add_argument("--metricas-log", default=None,
+                        help='Escribe una línea JSON por llamada al modelo ("stderr" o un archivo); por defecto, METRICAS_LOG.')
+    args = parser.parse_args(argv)
+    app.configurar_registro_metricas(args.metricas_log)
+
+    resultados = []
+    print(f"{'usuarios':>8} {'secuencias':>10} {'p50 (s)':>8} {'p95 (s)':>8} {'llamadas/sec':>12} {'sec/min':>8} {'fallidas %':>10}")
+    for usuarios in args.usuarios:
+        r = ejecutar_carga(args, usuarios)
+        resultados.append(r)
+        print(f"{r['usuarios']:>8} {r['secuencias']:>10} {r['p50_s']:>8} {r['p95_s']:>8} "
+              f"{r['llamadas_por_secuencia']:>12} {r['secuencias_por_minuto']:>8} {r['sesiones_fallidas_pct']:>10}")
+        for etapa in r["por_etapa"]:
+            print(f"{'':>8} {etapa['etapa']:>12}: p50 {etapa['p50_s']}s, p95 {etapa['p95_s']}s, {etapa['llamadas']} llamadas, "
+                  f"{etapa['reintentos']} reintentos, {etapa['coberturas']} coberturas, {etapa['tokens']} tokens, {etapa['coste_usd']} USD")
+
+    if args.salida_json:
+        with open(args.salida_json, "w", encoding="utf-8") as f:
+            json.dump({"parametros": vars(args), "resultados": resultados}, f, ensure_ascii=False, indent=2)
+
+    if args.max_p95 is not None:
+        excedidos = [r for r in resultados if r["p95_s"] > args.max_p95]
+        if excedidos:
+            print(f"p95 por encima de {args.max_p95}s con {[r['usuarios'] for r in excedidos]} usuarios.", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,290 @@
+"""Generación por lotes sin interfaz: muchas secuencias a partir de un archivo de temas.
+
+Recorre el mismo pipeline que la app (planificar_secuencia, generar_actividad_con_auditoria y
+exportar_secuencia_a_word) para cada fila de un CSV (con cabecera) o de un JSONL. Columnas:
+`tema` (obligatoria), `sesiones`, `nivel_final`, `nivel_entrada`, `grupo` e `id`.
+
+Ejemplo:
+
+    python lote.py temas.csv --salida unidades --unidades-concurrentes 8 --rpm 300
+
+Por cada unidad se escriben `<id>.docx` y `<id>.json`, un manifiesto con el plan, el estado y
+el texto de cada sesión. El manifiesto se reescribe al terminar cada sesión: si el lote se
+interrumpe, al relanzarlo se omiten las unidades completas y en las demás solo se generan las
+sesiones que faltan o que no se aprobaron. Todas las unidades comparten un limitador de tasa
+por modelo, de modo que la concurrencia no se traduce en 429 contra la cuota de Vertex.
+Con LLM_BACKEND=simulado se ejecuta contra el BackendSimulado, sin proyecto de GCP.
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import re
+import sys
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import app
+
+ESTADO_APROBADA = "✅ CUMPLE"
+
+
+def identificador(numero, tema):
+    # Nombre de archivo estable y legible: número de fila + tema sin acentos ni símbolos.
+    ascii_ = unicodedata.normalize("NFKD", tema).encode("ascii", "ignore").decode("ascii")
+    slug = re.sub(r"[^a-z0-9]+", "-", ascii_.lower()).strip("-")[:40]
+    return f"{numero:04d}-{slug or 'unidad'}"
+
+
+def leer_unidades(ruta, nivel_entrada, grupo):
+    """Devuelve (unidades, errores) a partir de un CSV o JSONL; las filas inválidas van a `errores`."""
+    with open(ruta, encoding="utf-8-sig", newline="") as f:
+        if ruta.lower().endswith((".jsonl", ".json")):
+            filas = [json.loads(linea) for linea in f if linea.strip()]
+        else:
+            filas = list(csv.DictReader(f))
+
+    unidades, errores, vistos = [], [], set()
+    for numero, fila in enumerate(filas, start=1):
+        tema = str(fila.get("tema") or "").strip()
+        nivel_final = str(fila.get("nivel_final") or "CREAR").strip().upper()
+        try:
+            sesiones = int(fila.get("sesiones") or 3)
+        except (TypeError, ValueError):
+            sesiones = 0
+        unidad_id = str(fila.get("id") or "").strip() or identificador(numero, tema)
+        if not tema:
+            errores.append(f"Fila {numero}: falta el tema.")
+        elif not 1 <= sesiones <= 10:
+            errores.append(f"Fila {numero}: el número de sesiones debe estar entre 1 y 10.")
+        elif nivel_final not in app.bloom_taxonomy_detallada:
+            errores.append(f"Fila {numero}: nivel de Bloom desconocido '{nivel_final}'.")
+        elif unidad_id in vistos:
+            errores.append(f"Fila {numero}: id repetido '{unidad_id}'.")
+        else:
+            vistos.add(unidad_id)
+            unidades.append({
+                "id": unidad_id,
+                "tema": tema,
+                "sesiones": sesiones,
+                "nivel_final": nivel_final,
+                "nivel_entrada": str(fila.get("nivel_entrada") or nivel_entrada).strip(),
+                "grupo": str(fila.get("grupo") or grupo).strip(),
+            })
+    return unidades, errores
+
+
+def escribir_atomico(ruta, datos):
+    # Se escribe en un temporal y se renombra: una interrupción nunca deja un archivo a medias.
+    temporal = f"{ruta}.tmp"
+    with open(temporal, "wb") as f:
+        f.write(datos)
+    os.replace(temporal, ruta)
+
+
+def cargar_manifiesto(ruta, unidad):
+    """Manifiesto previo de la unidad, o None si no existe o se generó con otros parámetros."""
+    try:
+        with open(ruta, encoding="utf-8") as f:
+            manifiesto = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if any(manifiesto.get(campo) != valor for campo, valor in unidad.items()):
+        return None
+    return manifiesto
+
+
+def crear_cliente(args):
+    if os.environ.get("LLM_BACKEND", "vertex").lower() == "simulado":
+        backend = app.obtener_backend_simulado()
+    else:
+        project, location = os.environ.get("GCP_PROJECT"), os.environ.get("GCP_LOCATION")
+        if not project or not location:
+            raise SystemExit("Variables de entorno GCP_PROJECT y GCP_LOCATION no encontradas.")
+        backend = app.BackendVertex(app.obtener_registro_vertex(project, location))
+
+    # Un limitador por modelo compartido por todas las unidades: la cuota es por modelo, no por unidad.
+    limitadores, lock = {}, threading.Lock()
+
+    def limitador_para(model_name):
+        with lock:
+            if model_name not in limitadores:
+                limitadores[model_name] = app.LimitadorDeTasa(args.rpm or app.llamadas_por_minuto_configuradas(model_name), args.rafaga)
+            return limitadores[model_name]
+
+    metricas = app.MetricasLLM()
+    reintentos = app.PoliticaReintentos(max_intentos=args.max_intentos)
+    cache = None if args.sin_cache else app.obtener_cache_respuestas()
+    return app.ClienteLLM(backend, cache=cache, limitador_para=limitador_para, metricas=metricas, reintentos=reintentos), metricas
+
+
+def procesar_unidad(llm, metricas, unidad, args, detener):
+    """Genera (o completa) una unidad y devuelve su manifiesto final.
+
+    Si se activa `detener`, no se empiezan sesiones nuevas y la unidad queda `interrumpida`.
+    """
+    inicio = time.perf_counter()
+    ruta_manifiesto = os.path.join(args.salida, f"{unidad['id']}.json")
+    ruta_docx = os.path.join(args.salida, f"{unidad['id']}.docx")
+    manifiesto = cargar_manifiesto(ruta_manifiesto, unidad)
+    if manifiesto and manifiesto["estado"] == "completada" and os.path.exists(ruta_docx):
+        return {**manifiesto, "omitida": True}
+
+    manifiesto = manifiesto or {**unidad, "plan": None, "actividades": [None] * unidad["sesiones"]}
+    manifiesto.update(estado="en_curso", error=None, docx=os.path.basename(ruta_docx))
+    lock = threading.Lock()
+
+    def persistir():
+        with lock:
+            manifiesto["actualizado"] = datetime.datetime.now().isoformat(timespec="seconds")
+            datos = json.dumps(manifiesto, ensure_ascii=False, indent=2).encode("utf-8")
+            escribir_atomico(ruta_manifiesto, datos)
+
+    try:
+        if not manifiesto["plan"]:
+            manifiesto["plan"] = app.planificar_secuencia(
+                llm, f"El tema central es: {unidad['tema']}.", unidad["sesiones"], unidad["nivel_final"],
+                args.modelo_generacion, usar_cache=not args.sin_cache, notificar=app.notificar_nada, secuencia=unidad["id"]
+            )
+            if not manifiesto["plan"]:
+                raise RuntimeError("El modelo no devolvió un plan de secuencia.")
+            persistir()
+
+        lista_params = app.construir_params_sesiones(
+            manifiesto["plan"], unidad["sesiones"], unidad["nivel_entrada"], unidad["grupo"],
+            args.modelo_generacion, args.modelo_auditoria, usar_cache=not args.sin_cache
+        )
+        # Solo se generan las sesiones que faltan o que no se aprobaron en una ejecución anterior.
+        pendientes = [i for i, a in enumerate(manifiesto["actividades"]) if not a or a["status"] != ESTADO_APROBADA]
+        for indice in pendientes:
+            # Como en GestorTrabajos.reanudar: con caché, una sesión rechazada repetiría exactamente los mismos intentos.
+            if manifiesto["actividades"][indice]:
+                lista_params[indice]["usar_cache"] = False
+
+        def generar_sesion(indice):
+            if detener.is_set():
+                return
+            params = {**lista_params[indice], "trabajo_id": unidad["id"]}
+            try:
+                resultado = app.generar_actividad_con_auditoria(llm, params, app.notificar_nada)
+            except Exception as e:
+                resultado = {"activity_text": "", "status": "❌ RECHAZADO", "title": f"Sesión {indice + 1} (Fallida)", "error": str(e)}
+            manifiesto["actividades"][indice] = {
+                "session_num": indice + 1,
+                "title": resultado["title"],
+                "status": resultado["status"],
+                "activity_text": resultado["activity_text"],
+                **({"error": resultado["error"]} if "error" in resultado else {}),
+            }
+            persistir()
+
+        with ThreadPoolExecutor(max_workers=args.concurrencia_sesiones) as executor:
+            list(executor.map(generar_sesion, pendientes))
+        if None in manifiesto["actividades"]:
+            raise InterruptedError("Lote interrumpido; se completará al relanzarlo.")
+
+        escribir_atomico(ruta_docx, app.exportar_secuencia_a_word(manifiesto["plan"], manifiesto["actividades"]))
+        aprobadas = all(a["status"] == ESTADO_APROBADA for a in manifiesto["actividades"])
+        manifiesto["estado"] = "completada" if aprobadas else "incompleta"
+    except InterruptedError as e:
+        manifiesto.update(estado="interrumpida", error=str(e))
+    except Exception as e:
+        manifiesto.update(estado="fallida", error=str(e))
+
+    manifiesto["coste_usd"] = round(metricas.coste_secuencia(unidad["id"]), 4)
+    manifiesto["duracion_s"] = round(time.perf_counter() - inicio, 2)
+    persistir()
+    return manifiesto
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("entrada", help="CSV con cabecera o JSONL de unidades.")
+    parser.add_argument("--salida", default="unidades", help="Carpeta de los .docx y manifiestos.")
+    parser.add_argument("--unidades-concurrentes", type=int, default=4, help="Unidades generándose a la vez.")
+    parser.add_argument("--concurrencia-sesiones", type=int, default=4, help="Sesiones en paralelo dentro de una unidad.")
+    parser.add_argument("--rpm", type=int, default=None,
+                        help="Solicitudes por minuto y modelo (por defecto, LLM_RPM o LLM_RPM_<MODELO>, como la app).")
+    parser.add_argument("--rafaga", type=int, default=5, help="Solicitudes que se admiten de golpe por modelo.")
+    parser.add_argument("--max-intentos", type=int, default=int(os.environ.get("LLM_MAX_INTENTOS", "4")))
+    parser.add_argument("--modelo-generacion", default="gemini-2.5-flash")
+    parser.add_argument("--modelo-auditoria", default="gemini-2.5-pro")
+    parser.add_argument("--nivel-entrada", default=app.NIVEL_ENTRADA_POR_DEFECTO,
+                        help="Nivel de entrada de la primera sesión si la fila no lo indica.")
+    parser.add_argument("--grupo", default="Grupo General")
+    parser.add_argument("--sin-cache", action="store_true", help="No lee ni escribe la caché de respuestas.")
+    parser.add_argument("--json", dest="salida_json", default=None, help="Guarda el resumen del lote en este archivo.")
+    parser.add_argument("--metricas-log", default=None,
+                        help='Escribe una línea JSON por llamada al modelo ("stderr" o un archivo); por defecto, METRICAS_LOG.')
+    args = parser.parse_args(argv)
+    app.configurar_registro_metricas(args.metricas_log)
+
+    unidades, errores = leer_unidades(args.entrada, args.nivel_entrada, args.grupo)
+    for error in errores:
+        print(error, file=sys.stderr)
+    os.makedirs(args.salida, exist_ok=True)
+    llm, metricas = crear_cliente(args)
+
+    detener = threading.Event()
+    inicio = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.unidades_concurrentes) as executor:
+        futuros = [executor.submit(procesar_unidad, llm, metricas, unidad, args, detener) for unidad in unidades]
+        try:
+            for n, futuro in enumerate(as_completed(futuros), start=1):
+                m = futuro.result()
+                aprobadas = sum(1 for a in m["actividades"] if a and a["status"] == ESTADO_APROBADA)
+                estado = "omitida" if m.get("omitida") else m["estado"]
+                print(f"[{n}/{len(unidades)}] {m['id']}: {estado}, {aprobadas}/{m['sesiones']} sesiones aprobadas"
+                      + (f" — {m['error']}" if m.get("error") else ""))
+        except KeyboardInterrupt:
+            # Ctrl+C: las unidades en cola se descartan y las que están en marcha terminan la sesión actual.
+            print("Interrumpiendo: se esperan las sesiones en curso...", file=sys.stderr)
+            detener.set()
+            for futuro in futuros:
+                futuro.cancel()
+    duracion = time.perf_counter() - inicio
+    manifiestos = [futuro.result() for futuro in futuros if not futuro.cancelled()]
+
+    generadas = [m for m in manifiestos if not m.get("omitida")]
+    sesiones = [a for m in generadas for a in m["actividades"] if a]
+    por_estado = {estado: sum(1 for m in generadas if m["estado"] == estado) for estado in ("completada", "incompleta", "interrumpida", "fallida")}
+    resumen = {
+        "unidades": len(unidades),
+        **por_estado,
+        "omitidas": len(manifiestos) - len(generadas),
+        "pendientes": len(unidades) - len(manifiestos),
+        "filas_invalidas": len(errores),
+        "sesiones_generadas": len(sesiones),
+        "sesiones_aprobadas": sum(1 for a in sesiones if a["status"] == ESTADO_APROBADA),
+        "duracion_s": round(duracion, 2),
+        "unidades_por_hora": round(len(generadas) / duracion * 3600, 1) if duracion else 0.0,
+        "sesiones_por_minuto": round(len(sesiones) / duracion * 60, 2) if duracion else 0.0,
+        "coste_usd": round(metricas.coste_total(), 4),
+        "por_etapa": metricas.resumen_por_etapa(),
+    }
+
+    print(f"\n{resumen['unidades']} unidades: {resumen['completada']} completadas, {resumen['incompleta']} incompletas, "
+          f"{resumen['fallida']} fallidas, {resumen['interrumpida']} interrumpidas, {resumen['omitidas']} omitidas (ya completas), {resumen['pendientes']} sin empezar, {resumen['filas_invalidas']} filas inválidas.")
+    print(f"{resumen['sesiones_aprobadas']}/{resumen['sesiones_generadas']} sesiones aprobadas en {resumen['duracion_s']}s: "
+          f"{resumen['unidades_por_hora']} unidades/hora, {resumen['sesiones_por_minuto']} sesiones/min, {resumen['coste_usd']} USD.")
+    for etapa in resumen["por_etapa"]:
+        # Una etapa servida solo desde la caché no tiene latencias del modelo.
+        p50, p95 = (f"{etapa[p]}s" if etapa[p] is not None else "-" for p in ("p50_s", "p95_s"))
+        print(f"{etapa['etapa']:>12}: p50 {p50}, p95 {p95}, {etapa['llamadas']} llamadas, "
+              f"{etapa['reintentos']} reintentos, {etapa['errores']} errores, {etapa['coste_usd']} USD")
+
+    if args.salida_json:
+        with open(args.salida_json, "w", encoding="utf-8") as f:
+            json.dump({"parametros": vars(args), "resumen": resumen}, f, ensure_ascii=False, indent=2)
+
+    # Código 1 si algo no se pudo generar, para que un cron o CI lo detecte; relanzar completa lo pendiente.
+    if detener.is_set():
+        return 130
+    return 1 if resumen["fallida"] or resumen["incompleta"] or errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
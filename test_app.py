@@ -0,0 +1,316 @@
+"""Pruebas de las piezas deterministas del pipeline, con BackendSimulado en lugar de Vertex AI.
+
+    python -m pytest -q
+"""
+import json
+import re
+import time
+
+import pytest
+
+import app
+
+
+SIN_LATENCIA = {tipo: app.latencia_fija(0) for tipo in ("plan", "actividad", "auditoria", "refinamiento", "resumen")}
+
+
+def crear_llm(backend=None, metricas=None):
+    backend = backend or app.BackendSimulado(latencias=SIN_LATENCIA, tasa_aprobacion=1.0)
+    return app.ClienteLLM(backend, metricas=metricas or app.MetricasLLM(),
+                          reintentos=app.PoliticaReintentos(max_intentos=2, espera_base=0.01))
+
+
+def esperar_trabajo(gestor, trabajo_id, plazo=10):
+    limite = time.time() + plazo
+    trabajo = gestor.obtener(trabajo_id)
+    while trabajo.estado not in app.ESTADOS_TERMINALES:
+        assert time.time() < limite, f"El trabajo {trabajo_id} no terminó a tiempo."
+        time.sleep(0.02)
+    return trabajo
+
+
+class BackendFijo(app.BackendLLM):
+    """Devuelve siempre la misma respuesta."""
+
+    def __init__(self, respuesta):
+        self.respuesta = respuesta
+
+    def generar(self, model_name, prompt, prefijo=None, generation_config=None, uso=None):
+        return self.respuesta
+
+
+ACTIVIDAD = app.BackendSimulado._actividad_simulada("2", "ANALIZAR")
+PLAN = app.BackendSimulado._plan_simulado("**Número de Sesiones:** 3\n**Nivel Cognitivo Final Deseado (Bloom):** CREAR")
+
+
+# --- AUDITORÍA ESTRUCTURADA ---
+def auditoria_json(cumplen, dictamen="CUMPLE", omitir=()):
+    return json.dumps({
+        "criterios": [{"criterio": clave, "cumple": clave in cumplen, "comentario": f"sobre {clave}"}
+                      for clave, _, _ in app.CRITERIOS_AUDITORIA if clave not in omitir],
+        "dictamen": dictamen,
+        "correcciones": ["uno", "dos", "tres", "cuatro"],
+    })
+
+
+def test_auditoria_json_aprueba_solo_con_todos_los_criterios():
+    claves = [clave for clave, _, _ in app.CRITERIOS_AUDITORIA]
+    resultado = app.interpretar_auditoria_json(auditoria_json(claves))
+    assert resultado["aprobada"] and resultado["criterios_fallidos"] == []
+    assert "✅ CUMPLE" in resultado["informe"]
+
+
+def test_auditoria_json_rechaza_por_criterio():
+    resultado = app.interpretar_auditoria_json(auditoria_json(["contexto_narrativo", "intencion_cognitiva"], dictamen="RECHAZADO"))
+    assert not resultado["aprobada"]
+    assert resultado["criterios_fallidos"] == ["hilo_conductor"]
+    assert "sobre hilo_conductor" in resultado["observaciones"] and "cuatro" not in resultado["observaciones"]
+
+
+@pytest.mark.parametrize("respuesta", [
+    auditoria_json(["contexto_narrativo", "hilo_conductor"], omitir=("intencion_cognitiva",)),
+    auditoria_json(["contexto_narrativo", "hilo_conductor", "intencion_cognitiva"], dictamen="QUIZÁ"),
+    "no es JSON",
+    json.dumps({"criterios": []}),
+])
+def test_auditoria_json_invalida_devuelve_none(respuesta):
+    assert app.interpretar_auditoria_json(respuesta) is None
+
+
+# --- PLAN Y ACTIVIDAD ESTRUCTURADOS ---
+def test_interpretar_plan():
+    plan = app.interpretar_plan(PLAN)
+    assert plan["hilo_conductor"].startswith("Una expedición simulada")
+    assert [sesion["numero"] for sesion in plan["sesiones"]] == [1, 2, 3]
+    assert plan["sesiones"][-1]["nivel_bloom"] == "CREAR"
+    assert plan["sesiones"][0]["concepto"] == "Concepto simulado 1."
+    assert app.interpretar_plan("texto libre")["sesiones"] == []
+
+
+def test_estructurar_actividad():
+    actividad = app.estructurar_actividad(ACTIVIDAD)
+    assert actividad["titulo"] == "Etapa 2 de la expedición"
+    assert set(actividad["fases"]) == {"enactiva", "iconica", "simbolica"}
+    assert "diferenciar" in actividad["fases"]["simbolica"]
+    assert actividad["rubrica"]["encabezados"] == ["Criterio", "Inicial", "Logrado"]
+    assert len(actividad["rubrica"]["filas"]) == 2
+    assert "GUÍA PARA EL DOCENTE" not in actividad["guia_rapida"]
+
+
+# --- VALIDACIÓN LOCAL ---
+def test_validacion_local_acepta_la_actividad_de_plantilla():
+    assert app.validar_actividad_localmente(ACTIVIDAD, "ANALIZAR") == []
+
+
+def test_validacion_local_detecta_secciones_y_verbos():
+    truncada = ACTIVIDAD.split("### GUÍA PARA EL DOCENTE")[0]
+    assert any("GUÍA PARA EL DOCENTE" in problema for problema in app.validar_actividad_localmente(truncada, "ANALIZAR"))
+    sin_verbo = ACTIVIDAD.replace("diferenciar y justificar", "repetir la regla")
+    assert any("ANALIZAR" in problema for problema in app.validar_actividad_localmente(sin_verbo, "ANALIZAR"))
+
+
+
+SIMBOLICA_ANIDADA = """     - **Simbólica:**
+       - **Instrucciones:** Cada equipo debe diferenciar los datos relevantes de los accesorios.
+       - **Preguntas:** ¿Cómo organizarían las pistas? ¿A qué causa atribuyen el cambio?
+       - **Variantes:** Con apoyo, pueden ordenar las pistas en una tabla.
+   - **Cierre:** Síntesis guiada."""
+
+
+def test_validacion_local_lee_las_subvinetas_de_la_fase_simbolica():
+    actividad = ACTIVIDAD.replace("Formalizan una regla.", "Cierran la misión.")
+    actividad = re.sub(r"     - \*\*Simbólica:\*\*.*\n   - \*\*Cierre:\*\* Síntesis guiada\.", SIMBOLICA_ANIDADA, actividad)
+    assert "diferenciar los datos" in actividad
+    assert app.validar_actividad_localmente(actividad, "ANALIZAR") == []
+    fases = dict(app.extraer_fases(actividad))
+    assert "atribuyen el cambio" in fases["simbolica"] and "Síntesis guiada" not in fases["simbolica"]
+    assert "atribuyen" in app.estructurar_actividad(actividad)["fases"]["simbolica"]
+
+
+@pytest.mark.parametrize("nivel, texto, cumple", [
+    ("CREAR", "Un repaso general y creativo de lo aprendido.", False),
+    ("CREAR", "Los equipos generan una propuesta.", True),
+    ("APLICAR", "Se llevan el material a casa.", False),
+    ("APLICAR", "Llevan a cabo el experimento.", True),
+    ("ANALIZAR", "La organización del aula.", False),
+    ("ANALIZAR", "Deben organizarlas por causa.", True),
+])
+def test_verbos_bloom_solo_como_verbos(nivel, texto, cumple):
+    actividad = ACTIVIDAD.replace("los equipos deben diferenciar y justificar.", texto)
+    assert (app.validar_actividad_localmente(actividad, nivel) == []) is cumple
+
+
+@pytest.mark.parametrize("nivel", list(app.bloom_taxonomy_detallada))
+def test_validacion_local_acepta_cada_nivel(nivel):
+    assert app.validar_actividad_localmente(app.BackendSimulado._actividad_simulada("1", nivel), nivel) == []
+
+# --- REFINAMIENTO POR SECCIONES ---
+def test_dividir_en_secciones_reconstruye_el_texto():
+    secciones = app.dividir_en_secciones(ACTIVIDAD)
+    assert list(secciones)[1:] == [clave for clave, _, _ in app.SECCIONES_ACTIVIDAD]
+    assert "".join(secciones.values()) == ACTIVIDAD
+    assert app.dividir_en_secciones(ACTIVIDAD.replace("**3. Cohesión", "**3. Otra")) is None
+
+
+def test_refinar_secciones_solo_reemplaza_las_pedidas():
+    nueva = "**3. Cohesión y Metacognición:**\n   - **Bitácora de Secuencia:** Texto nuevo.\n"
+    respuesta = f"<<<cohesion>>>\n{nueva}\n<<<guia_rapida>>>\n### GUÍA RÁPIDA cambiada\n"
+    params = app.construir_params_sesiones(PLAN, 3, app.NIVEL_ENTRADA_POR_DEFECTO, "G", "gemini-2.5-flash", "gemini-2.5-pro")[1]
+    refinada = app.refinar_secciones(crear_llm(BackendFijo(respuesta)), ACTIVIDAD, ["hilo_conductor"], "obs", params,
+                                     app.get_master_prompt_system(), app.notificar_nada)
+    original, resultado = app.dividir_en_secciones(ACTIVIDAD), app.dividir_en_secciones(refinada)
+    assert resultado["cohesion"].startswith(nueva.rstrip("\n"))
+    assert resultado["cohesion"].endswith(app._separar_cola(original["cohesion"])[1])
+    # La Guía Rápida no estaba entre las secciones del criterio fallido: se conserva.
+    assert all(resultado[clave] == original[clave] for clave in original if clave != "cohesion")
+
+
+def test_refinar_secciones_sin_secciones_utiles_devuelve_none():
+    params = app.construir_params_sesiones(PLAN, 3, app.NIVEL_ENTRADA_POR_DEFECTO, "G", "gemini-2.5-flash", "gemini-2.5-pro")[1]
+    llm = crear_llm(BackendFijo("<<<cohesion>>>\nsin encabezado\n"))
+    assert app.refinar_secciones(llm, ACTIVIDAD, ["hilo_conductor"], "obs", params, "", app.notificar_nada) is None
+
+
+# --- LIMITADOR, REINTENTOS Y CACHÉ ---
+def test_limitador_se_adapta_a_los_429():
+    limitador = app.LimitadorDeTasa(llamadas_por_minuto=600)
+    limitador.penalizar()
+    assert limitador.llamadas_por_minuto == pytest.approx(300)
+    for _ in range(10):
+        limitador.penalizar()
+    assert limitador.llamadas_por_minuto == pytest.approx(60)
+    for _ in range(100):
+        limitador.registrar_exito()
+    assert limitador.llamadas_por_minuto == pytest.approx(600)
+
+
+def test_limitador_respeta_la_rafaga():
+    limitador = app.LimitadorDeTasa(llamadas_por_minuto=600, rafaga=2)
+    inicio = time.monotonic()
+    for _ in range(3):
+        limitador.esperar_turno()
+    assert time.monotonic() - inicio >= 0.05
+
+
+def test_politica_reintentos_crece_con_tope():
+    politica = app.PoliticaReintentos(espera_base=1.0, espera_maxima=8.0)
+    for intento in range(1, 8):
+        tope = min(8.0, 2 ** (intento - 1))
+        assert tope / 2 <= politica.espera(intento, "transitorio") <= tope
+    assert politica.espera(1, "limite") >= 2.0
+
+
+def test_cache_respuestas_caducidad(tmp_path):
+    cache = app.CacheRespuestas(str(tmp_path / "cache.sqlite3"), ttl_segundos=0.05)
+    cache.guardar("a", "respuesta")
+    assert cache.obtener("a") == "respuesta"
+    time.sleep(0.1)
+    assert cache.obtener("a") is None
+    assert cache.estadisticas()["entradas_disco"] == 0
+
+
+def test_cache_respuestas_expulsa_lo_menos_usado(tmp_path):
+    cache = app.CacheRespuestas(str(tmp_path / "cache.sqlite3"), max_entradas_memoria=2, max_bytes_disco=20)
+    for clave in "abc":
+        cache.guardar(clave, "x" * 10)
+    # En disco caben dos entradas de 10 bytes; "a" era la menos usada.
+    assert cache.estadisticas()["entradas_disco"] == 2
+    assert cache.obtener("a") is None
+    assert cache.obtener("c") == "x" * 10
+    assert cache.aciertos_memoria == 1
+
+
+# --- MÉTRICAS ---
+@pytest.fixture
+def registro_metricas_limpio():
+    yield app.registro_metricas
+    for handler in list(app.registro_metricas.handlers):
+        app.registro_metricas.removeHandler(handler)
+        handler.close()
+
+
+def test_registro_metricas_escribe_una_linea_por_span(tmp_path, registro_metricas_limpio):
+    ruta = tmp_path / "spans.jsonl"
+    app.configurar_registro_metricas(str(ruta))
+    app.configurar_registro_metricas(str(ruta))
+    metricas = app.MetricasLLM()
+    plan = app.planificar_secuencia(crear_llm(metricas=metricas), "agua", 3, "CREAR", "gemini-2.5-flash",
+                                    notificar=app.notificar_nada, secuencia="unidad-1")
+    assert plan
+    spans = [json.loads(linea) for linea in ruta.read_text(encoding="utf-8").splitlines()]
+    assert len(spans) == 1
+    assert spans[0]["etapa"] == "plan" and spans[0]["secuencia"] == "unidad-1" and spans[0]["coste_usd"] > 0
+    # El plan cuenta en el coste de la secuencia, pero no aparece como una sesión.
+    assert metricas.coste_secuencia("unidad-1") == pytest.approx(spans[0]["coste_usd"])
+    assert metricas.resumen_por_sesion("unidad-1") == []
+
+
+# --- TRABAJOS EN SEGUNDO PLANO ---
+@pytest.fixture
+def gestor(tmp_path):
+    almacen = app.AlmacenArtefactos(str(tmp_path / "artefactos.sqlite3"))
+    return app.GestorTrabajos(str(tmp_path / "trabajos.sqlite3"), almacen=almacen, max_trabajos_especulativos=1)
+
+
+def params_de_prueba(num_sesiones=4):
+    return app.construir_params_sesiones(
+        app.BackendSimulado._plan_simulado(f"**Número de Sesiones:** {num_sesiones}"), num_sesiones,
+        app.NIVEL_ENTRADA_POR_DEFECTO, "G", "gemini-2.5-flash", "gemini-2.5-pro", usar_cache=True
+    )
+
+
+def test_gestor_genera_y_reanuda_sin_cache(gestor):
+    llm = crear_llm()
+    trabajo = esperar_trabajo(gestor, gestor.enviar(llm, params_de_prueba(), 2))
+    assert trabajo.estado == "completado" and None not in trabajo.resultados
+    assert "plan_secuencia" not in trabajo.lista_params[0]
+
+    nuevo = esperar_trabajo(gestor, gestor.reanudar(llm, trabajo.id, indices=[1]))
+    assert nuevo.estado == "completado"
+    assert nuevo.lista_params[1]["usar_cache"] is False and nuevo.lista_params[0]["usar_cache"] is True
+    assert nuevo.resultados[0] == trabajo.resultados[0]
+
+
+def test_adoptar_hereda_las_sesiones_en_curso(gestor):
+    metricas = app.MetricasLLM()
+    backend = app.BackendSimulado(latencias={**SIN_LATENCIA, "actividad": app.latencia_fija(0.2)}, tasa_aprobacion=1.0)
+    llm = crear_llm(backend, metricas)
+    consultas = []
+
+    def presupuesto(trabajo):
+        # Deja empezar dos sesiones y corta el resto.
+        consultas.append(trabajo.id)
+        return len(consultas) <= 2
+
+    especulativo = gestor.enviar(llm, params_de_prueba(), 4, presupuesto=presupuesto)
+    time.sleep(0.1)
+    adoptado = gestor.adoptar(llm, especulativo)
+    assert adoptado != especulativo
+
+    trabajo = esperar_trabajo(gestor, adoptado)
+    assert trabajo.estado == "completado" and None not in trabajo.resultados
+    generadas_antes = {sesion["sesion"] for sesion in metricas.resumen_por_sesion(especulativo)}
+    generadas_despues = {sesion["sesion"] for sesion in metricas.resumen_por_sesion(adoptado)}
+    assert generadas_antes == {1, 2} and generadas_despues == {3, 4}
+
+
+def test_tope_especulativo_persiste_por_usuario(tmp_path):
+    ruta = str(tmp_path / "trabajos.sqlite3")
+    gestor = app.GestorTrabajos(ruta)
+    llm = crear_llm()
+    presupuesto = app.crear_presupuesto_especulativo(gestor, "ana", 0.0001, 3600)
+    # Con una sesión cada vez, la primera agota el tope y el resto ya no se genera.
+    trabajo = esperar_trabajo(gestor, gestor.enviar(llm, params_de_prueba(), 1, presupuesto=presupuesto, usuario="ana"))
+    assert trabajo.estado == "cancelado"
+    assert sum(resultado is not None for resultado in trabajo.resultados) == 1
+    gastado = gestor.gasto_especulativo("ana")
+    assert gastado > 0.0001 and gestor.gasto_especulativo("luis") == 0
+
+    # El gasto está en SQLite: otro gestor (un proceso nuevo, o la misma persona tras recargar) lo ve.
+    gestor = app.GestorTrabajos(ruta)
+    assert gestor.gasto_especulativo("ana") == pytest.approx(gastado)
+    presupuesto = app.crear_presupuesto_especulativo(gestor, "ana", 0.0001, 3600)
+    trabajo = esperar_trabajo(gestor, gestor.enviar(llm, params_de_prueba(), 1, presupuesto=presupuesto, usuario="ana"))
+    assert trabajo.resultados == [None] * 4
+    # Fuera de la ventana, el gasto antiguo ya no cuenta.
+    assert gestor.gasto_especulativo("ana", time.time() + 1) == 0